@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Memory benchmark for LogAnalyzer on a log with high url cardinality, made by ``loggen.py``
+
+Usage: python benchmarks/bench_memory.py [--lines 300000] [--url-groups 200]
+           [generator options, see loggen.py]
+
+By default almost every url is unique, and every request is a slow "GET" with status 200.
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loggen import add_generator_arguments, make_generator
+from uwsgi_sloth.analyzer import LogAnalyzer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark for LogAnalyzer')
+    parser.add_argument('--lines', type=int, default=300000, help='Lines of synthetic log')
+    add_generator_arguments(parser)
+    parser.set_defaults(urls_per_group=10 ** 9, slow_ratio=1.0, methods='GET', statuses='200',
+                        malformed_ratio=0)
+    args = parser.parse_args()
+
+    generator = make_generator(args)
+    analyzer = LogAnalyzer(min_msecs=generator.min_msecs)
+    tracemalloc.start()
+    start_time = time.time()
+    for line in generator.iter_lines(args.lines):
+        analyzer.analyze_line(line)
+    elapsed = time.time() - start_time
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    urls = sum(len(d['urls']) for d in analyzer.data.values())
+    print('lines: %s, urls: %s, elapsed: %.2fs' % (args.lines, urls, elapsed))
+    print('memory: %.1f MiB, peak: %.1f MiB, %.0f bytes per url' % (
+        current / 1048576.0, peak / 1048576.0, current / float(urls or 1)))
+
+
+if __name__ == '__main__':
+    main()
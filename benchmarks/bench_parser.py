@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for UWSGILogParser, compares lines/sec with the original regex + strptime parser,
+and the text pipeline with the bytes pipeline(file read with a big buffer, bytes lines).
+Parsers of custom logformat and JSON lines are benchmarked with the same requests.
+
+Usage: python benchmarks/bench_parser.py [--lines 10000000] [--log /tmp/uwsgi-sloth-bench.log]
+           [generator options, see loggen.py]
+
+Logs are generated by ``loggen.py``, logs in other formats are generated to "<log>.logformat" and "<log>.json".
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loggen import LOG_FORMATS, add_generator_arguments, make_generator
+from uwsgi_sloth.analyzer import UWSGILogParser
+from uwsgi_sloth.parsers import make_log_parser
+from uwsgi_sloth.settings import FILTER_METHODS, FILTER_STATUS
+
+
+class OriginalUWSGILogParser(object):
+    """The parser before fast path was introduced"""
+    DATETIME_FORMAT = UWSGILogParser.DATETIME_FORMAT
+    RE_LOG_LINE = UWSGILogParser.RE_LOG_LINE
+
+    def parse(self, line):
+        matched = self.RE_LOG_LINE.search(line)
+        if matched:
+            matched_dict = matched.groupdict()
+            method = matched_dict['request_method']
+            status = matched_dict['resp_status']
+            if not method in FILTER_METHODS or status not in FILTER_STATUS:
+                return
+
+            url = matched_dict['request_uri'].replace('//', '/')
+            url_path = url.split('?')[0]
+            resp_time = int(matched_dict['resp_msecs'])
+            request_datetime = datetime.datetime.strptime(matched_dict['datetime'],
+                                                          self.DATETIME_FORMAT)
+            return {
+                'method': method,
+                'url': url,
+                'url_path': url_path,
+                'resp_time': resp_time,
+                'status': status,
+                'request_datetime': request_datetime
+            }
+
+
+def generate_log(file_path, lines, generator):
+    with open(file_path, 'w') as fp:
+        generator.write(fp, lines)
+
+
+def bench(parser, file_path):
+    start_time = time.time()
+    lines = 0
+    with open(file_path, 'r') as fp:
+        for line in fp:
+            parser.parse(line.strip())
+            lines += 1
+    return lines / (time.time() - start_time)
+
+
+def bench_bytes(parser, file_path):
+    start_time = time.time()
+    lines = 0
+    with open(file_path, 'rb', buffering=1024 * 1024) as fp:
+        for line in fp:
+            parser.parse(line)
+            lines += 1
+    return lines / (time.time() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark uwsgi log parser')
+    parser.add_argument('--lines', type=int, default=10000000, help='Lines of synthetic log')
+    parser.add_argument('--log', default='/tmp/uwsgi-sloth-bench.log', help='Path of synthetic log')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    generators, log_paths = {}, {'default': args.log}
+    for log_format in LOG_FORMATS:
+        generators[log_format] = make_generator(args, log_format)
+        if log_format != 'default':
+            log_paths[log_format] = '%s.%s' % (args.log, log_format)
+    for log_format, log_path in sorted(log_paths.items()):
+        if not os.path.exists(log_path):
+            print('Generating %s lines to %s...' % (args.lines, log_path))
+            generate_log(log_path, args.lines, generators[log_format])
+
+    for name, bench_func, log_parser, log_format in (
+            ('original', bench, OriginalUWSGILogParser(), 'default'),
+            ('text', bench, UWSGILogParser(), 'default'),
+            ('bytes', bench_bytes, UWSGILogParser(), 'default'),
+            ('logformat', bench_bytes, make_log_parser(generators['logformat'].get_parser_format()),
+             'logformat'),
+            ('json', bench_bytes, make_log_parser(generators['json'].get_parser_format()), 'json')):
+        print('%-10s %12.0f lines/sec' % (name, bench_func(log_parser, log_paths[log_format])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for storage of requests data, compares save/load time and file size of the
+storage format with pickle, on data of a day with many urls analyzed from a log made by
+``loggen.py``.
+
+Usage: python benchmarks/bench_storage.py [--lines 2000000] [--url-groups 1000] [--dir /tmp]
+           [generator options, see loggen.py]
+
+By default almost every url is unique, and every request is a slow "GET" with status 200.
+"""
+import gc
+import os
+import sys
+import time
+import pickle
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loggen import add_generator_arguments, make_generator
+from uwsgi_sloth.analyzer import LogAnalyzer
+from uwsgi_sloth.storage import write_requests_data, read_requests_data
+from uwsgi_sloth.models import atomic_dump
+
+
+def make_requests_data(generator, lines):
+    """Make requests data of a day by analyzing lines, all urls are kept"""
+    analyzer = LogAnalyzer(min_msecs=generator.min_msecs, max_urls_per_group=0)
+    for line in generator.iter_lines(lines):
+        analyzer.analyze_line(line)
+    return analyzer.get_data()
+
+
+def timeit(func, *args):
+    # Collections caused by objects of previous steps are not counted
+    gc.collect()
+    start_time = time.time()
+    result = func(*args)
+    return time.time() - start_time, result
+
+
+def load_pickle(file_path):
+    with open(file_path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark for storage of requests data')
+    parser.add_argument('--lines', type=int, default=2000000, help='Lines of synthetic log')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='Directory for data files')
+    add_generator_arguments(parser)
+    parser.set_defaults(url_groups=1000, urls_per_group=10 ** 9, slow_ratio=1.0, methods='GET',
+                        statuses='200', malformed_ratio=0)
+    args = parser.parse_args()
+
+    elapsed, data = timeit(make_requests_data, make_generator(args), args.lines)
+    urls = sum(len(d['urls']) for d in data['data_details'].values())
+    print('urls: %s, groups: %s, analyzed in %.2fs' % (urls, len(data['data_details']), elapsed))
+
+    pickle_path = os.path.join(args.dir, 'uwsgi-sloth-bench.pickle')
+    storage_path = os.path.join(args.dir, 'uwsgi-sloth-bench.db')
+    try:
+        results = [
+            ('pickle', timeit(atomic_dump, [data], pickle_path)[0],
+             timeit(load_pickle, pickle_path)[0], os.path.getsize(pickle_path)),
+            ('storage', timeit(write_requests_data, storage_path, data)[0],
+             timeit(read_requests_data, storage_path)[0], os.path.getsize(storage_path)),
+        ]
+        print('%-10s %10s %10s %12s' % ('format', 'save', 'load', 'size'))
+        for name, save_time, load_time, size in results:
+            print('%-10s %9.2fs %9.2fs %10.1fMB' % (name, save_time, load_time, size / 1048576.0))
+    finally:
+        for file_path in (pickle_path, storage_path):
+            if os.path.exists(file_path):
+                os.unlink(file_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite for the hot paths of analyzing, on logs made by ``loggen.py``.
+
+Every benchmark runs in a new process, so its peak RSS(including its generated input) is not
+affected by others. The best CPU time of ``--repeat`` runs is taken. Results can be saved as
+JSON and compared with results of an earlier run on the same machine, the exit status is 1 if
+there are regressions.
+
+Usage: python benchmarks/bench_suite.py [--lines 200000] [--only parse,analyze_line]
+           [--output results.json] [--compare baseline.json] [--threshold 0.2]
+           [generator options, see loggen.py]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import datetime
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loggen import add_generator_arguments, make_generator
+from uwsgi_sloth.analyzer import UWSGILogParser, URLClassifier, LogAnalyzer, format_data
+from uwsgi_sloth.template import render_template
+from uwsgi_sloth.models import merge_requests_data_to
+
+RESULTS_VERSION = 1
+# Number of parts for merging, every part is analyzed from the same number of lines
+MERGE_PARTS = 10
+
+
+def generate_lines(generator, lines):
+    """Lines as bytes, like lines read from log files"""
+    return [line.encode('utf-8') for line in generator.iter_lines(lines)]
+
+
+def analyze_lines(generator, lines):
+    analyzer = LogAnalyzer(min_msecs=generator.min_msecs)
+    for line in lines:
+        analyzer.analyze_line(line)
+    return analyzer.get_data()
+
+
+def bench_parse(generator, lines):
+    parse = UWSGILogParser().parse
+    start_time = time.process_time()
+    for line in lines:
+        parse(line)
+    return len(lines), 'lines', time.process_time() - start_time
+
+
+def bench_classify(generator, lines):
+    parse = UWSGILogParser().parse
+    url_paths = [result['url_path'] for result in map(parse, lines) if result]
+    classify = URLClassifier().classify
+    start_time = time.process_time()
+    for url_path in url_paths:
+        classify(url_path)
+    return len(url_paths), 'urls', time.process_time() - start_time
+
+
+def bench_analyze_line(generator, lines):
+    analyzer = LogAnalyzer(min_msecs=generator.min_msecs)
+    start_time = time.process_time()
+    for line in lines:
+        analyzer.analyze_line(line)
+    return len(lines), 'lines', time.process_time() - start_time
+
+
+def bench_format_data(generator, lines, calls=20):
+    data = analyze_lines(generator, lines)
+    start_time = time.process_time()
+    for _ in range(calls):
+        format_data(data)
+    return calls, 'calls', time.process_time() - start_time
+
+
+def bench_render_template(generator, lines, calls=5):
+    data = format_data(analyze_lines(generator, lines))
+    data.update({'domain': None, 'input_filename': 'bench.log', 'min_duration': generator.min_msecs})
+    start_time = time.process_time()
+    for _ in range(calls):
+        render_template('report.html', data)
+    return calls, 'calls', time.process_time() - start_time
+
+
+def bench_merge_requests_data_to(generator, lines):
+    size = len(lines) // MERGE_PARTS + 1
+    parts = [analyze_lines(generator, lines[i:i + size]) for i in range(0, len(lines), size)]
+    start_time = time.process_time()
+    merged = {}
+    for part in parts:
+        merge_requests_data_to(merged, part)
+    return len(lines), 'lines', time.process_time() - start_time
+
+
+BENCHMARKS = (
+    ('parse', bench_parse),
+    ('classify', bench_classify),
+    ('analyze_line', bench_analyze_line),
+    ('format_data', bench_format_data),
+    ('render_template', bench_render_template),
+    ('merge_requests_data_to', bench_merge_requests_data_to),
+)
+
+
+def get_peak_rss():
+    """Peak RSS of current process in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB on others
+    return peak / 1048576.0 if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_benchmark(task):
+    """Run a benchmark in a new process"""
+    name, generator, lines, repeat = task
+    bench_func = dict(BENCHMARKS)[name]
+    lines = generate_lines(generator, lines)
+    best = None
+    for _ in range(repeat):
+        operations, unit, seconds = bench_func(generator, lines)
+        if best is None or seconds < best:
+            best = seconds
+    return {
+        'operations': operations,
+        'unit': unit,
+        'seconds': best,
+        'rate': operations / best if best else 0,
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+
+def run_suite(names, generator, lines, repeat):
+    # Processes are spawned instead of forked, so they do not share memory of the parent
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in names:
+        pool = context.Pool(1)
+        try:
+            results[name] = pool.apply(run_benchmark, ((name, generator, lines, repeat), ))
+        finally:
+            pool.close()
+            pool.join()
+        result = results[name]
+        print('%-24s %14.1f %s/sec %8.1f MiB' % (name, result['rate'], result['unit'],
+                                                result['peak_rss_mb']))
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    """Compare results with baseline, regressions are slower rates or larger peak RSS by
+    more than ``threshold``(a ratio)
+
+    :returns: list of (name, metric, value, baseline value, change)
+    """
+    regressions = []
+    print('\n%-24s %10s %10s  %10s %10s' % ('compared with baseline', 'rate', 'change',
+                                             'peak rss', 'change'))
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        rate_change = result['rate'] / base['rate'] - 1 if base['rate'] else 0
+        rss_change = result['peak_rss_mb'] / base['peak_rss_mb'] - 1 if base['peak_rss_mb'] else 0
+        flags = []
+        if rate_change < -threshold:
+            regressions.append((name, 'rate', result['rate'], base['rate'], rate_change))
+            flags.append('SLOWER')
+        if rss_change > threshold:
+            regressions.append((name, 'peak_rss_mb', result['peak_rss_mb'], base['peak_rss_mb'],
+                                rss_change))
+            flags.append('MORE MEMORY')
+        print('%-24s %10.1f %+9.1f%%  %10.1f %+9.1f%%  %s' % (
+            name, result['rate'], rate_change * 100, result['peak_rss_mb'], rss_change * 100,
+            ' '.join(flags)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite of uwsgi-sloth')
+    parser.add_argument('--lines', type=int, default=200000, help='Lines of synthetic log')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every benchmark, the best is taken')
+    parser.add_argument('--only', type=lambda value: value.split(','), default=None,
+                        help='Comma separated names of benchmarks to run, default: all')
+    parser.add_argument('--output', help='Save results to this JSON file')
+    parser.add_argument('--compare', help='Compare results with this JSON file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Changes larger than this ratio are regressions, default: 0.2')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name for name, _ in BENCHMARKS]
+    if args.only:
+        unknown = set(args.only) - set(names)
+        if unknown:
+            parser.error('Unknown benchmarks: %s, available: %s' % (', '.join(sorted(unknown)),
+                                                                   ', '.join(names)))
+        names = [name for name in names if name in args.only]
+
+    generator = make_generator(args)
+    options = dict(generator.get_options(), lines=args.lines, repeat=args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('version') != RESULTS_VERSION:
+            parser.error('Unsupported results version of %s' % args.compare)
+        if baseline['options'] != options:
+            print('WARNING: options are different from baseline, results may be incomparable')
+
+    results = run_suite(names, generator, args.lines, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'version': RESULTS_VERSION,
+                'created_at': datetime.datetime.now().replace(microsecond=0).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': options,
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print('\n%s regressions found' % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
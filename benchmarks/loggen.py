@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Deterministic generator of synthetic uwsgi logs for benchmarks, the same options always
+generate the same lines.
+
+Usage: python benchmarks/loggen.py --lines 1000000 --output /tmp/uwsgi-sloth-bench.log
+           [--url-groups 200] [--urls-per-group 1000] [--slow-ratio 0.3]
+           [--methods GET:6,POST:2,HEAD:1] [--statuses 200:8,302:1,404:1]
+           [--malformed-ratio 0.01] [--seed 42]
+"""
+import sys
+import json
+import random
+import argparse
+import datetime
+
+LOG_LINE = ('[pid: 94153|app: 0|req: %d/%d] 10.0.0.%d () {40 vars in 880 bytes} [%s] %s %s => '
+            'generated %d bytes in %d msecs (HTTP/1.1 %s) 4 headers in 285 bytes '
+            '(1 switches on core 0)')
+# Lines of "logformat" format are written by this uwsgi logformat
+LOG_FORMAT = '%(addr) - %(user) [%(ltime)] "%(method) %(uri) %(proto)" %(status) %(size) %(msecs)ms'
+LOG_FORMAT_LINE = '10.0.0.%d - - [%s] "%s %s HTTP/1.1" %s %d %dms'
+# Formats of generated lines: default uwsgi log format, ``LOG_FORMAT`` and JSON lines
+LOG_FORMATS = ('default', 'logformat', 'json')
+# Lines which are not requests, written by uwsgi itself
+NON_REQUEST_LINES = (
+    '*** uWSGI is running in multiple interpreter mode ***',
+    'spawned uWSGI worker 1 (pid: 94153, cores: 1)',
+    '!!! uWSGI process 94153 got Segmentation Fault !!!',
+)
+START_DATETIME = datetime.datetime(2014, 6, 24)
+
+
+def parse_weights(value):
+    """Parse weighted choices like "GET:6,POST:2" to a list for ``random.choice``"""
+    choices = []
+    for item in value.split(','):
+        name, _, weight = item.strip().partition(':')
+        choices.extend([name] * int(weight or 1))
+    return choices
+
+
+def make_group_name(index):
+    """Name of url group without digits, so groups will not be merged by url classifier"""
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(ord('a') + remainder) + name
+    return name
+
+
+class LogGenerator(object):
+    """Generator of synthetic uwsgi log lines
+
+    :param url_groups: number of url groups, urls in a group only differ by digits
+    :param urls_per_group: number of distinct urls in every url group
+    :param slow_ratio: ratio of requests not faster than ``min_msecs``
+    :param methods: weighted methods like "GET:6,POST:2"
+    :param statuses: weighted response statuses like "200:8,404:1"
+    :param malformed_ratio: ratio of malformed lines: truncated lines, lines which are not
+                            requests and random text
+    :param requests_per_second: datetime of requests is increased by one second every this
+                                many lines
+    :param log_format: one of ``LOG_FORMATS``
+    """
+
+    def __init__(self, seed=42, url_groups=200, urls_per_group=1000, slow_ratio=0.3, min_msecs=200,
+                 methods='GET:6,POST:2,HEAD:1,OPTIONS:1', statuses='200:8,302:1,404:1',
+                 malformed_ratio=0.01, requests_per_second=10, log_format='default'):
+        self.seed = seed
+        self.url_groups = url_groups
+        self.urls_per_group = urls_per_group
+        self.slow_ratio = slow_ratio
+        self.min_msecs = min_msecs
+        self.methods = parse_weights(methods)
+        self.statuses = parse_weights(statuses)
+        self.malformed_ratio = malformed_ratio
+        self.requests_per_second = requests_per_second
+        self.log_format = log_format
+        self.group_names = [make_group_name(i) for i in range(url_groups)]
+
+    def get_options(self):
+        """Options of generator, results are only comparable with the same options"""
+        return {
+            'seed': self.seed,
+            'url_groups': self.url_groups,
+            'urls_per_group': self.urls_per_group,
+            'slow_ratio': self.slow_ratio,
+            'min_msecs': self.min_msecs,
+            'methods': ','.join(sorted(set(self.methods))),
+            'statuses': ','.join(sorted(set(self.statuses))),
+            'malformed_ratio': self.malformed_ratio,
+            'requests_per_second': self.requests_per_second,
+            'log_format': self.log_format,
+        }
+
+    def get_parser_format(self):
+        """Log format for ``uwsgi_sloth.parsers.make_log_parser``"""
+        return {'logformat': LOG_FORMAT, 'json': 'json'}.get(self.log_format)
+
+    def make_request_line(self, rand, i, request_datetime):
+        url = '/api/%s/%d/' % (rand.choice(self.group_names), rand.randrange(self.urls_per_group))
+        if rand.random() < self.slow_ratio:
+            msecs = self.min_msecs + int(rand.expovariate(1 / 500.0))
+        else:
+            msecs = rand.randrange(self.min_msecs)
+        method, size, status = rand.choice(self.methods), rand.randint(100, 50000), \
+            rand.choice(self.statuses)
+        if self.log_format == 'json':
+            return json.dumps({'addr': '10.0.0.%d' % (i % 256), 'method': method, 'uri': url,
+                               'time': int(request_datetime.timestamp()), 'status': int(status),
+                               'size': size, 'msecs': msecs})
+        elif self.log_format == 'logformat':
+            return LOG_FORMAT_LINE % (i % 256, request_datetime.strftime('%d/%b/%Y:%H:%M:%S +0000'),
+                                      method, url, status, size, msecs)
+        return LOG_LINE % (i, i, i % 256, request_datetime.strftime('%a %b %d %H:%M:%S %Y'),
+                           method, url, size, msecs, status)
+
+    def make_malformed_line(self, rand, i, request_datetime):
+        kind = rand.randrange(3)
+        if kind == 0:
+            line = self.make_request_line(rand, i, request_datetime)
+            return line[:rand.randrange(len(line))]
+        elif kind == 1:
+            return rand.choice(NON_REQUEST_LINES)
+        return ''.join(chr(rand.randint(32, 126)) for _ in range(rand.randint(1, 200)))
+
+    def iter_lines(self, lines):
+        """Yield ``lines`` lines without line terminators"""
+        rand = random.Random(self.seed)
+        request_datetime = START_DATETIME
+        for i in range(lines):
+            if i % self.requests_per_second == 0:
+                request_datetime += datetime.timedelta(seconds=1)
+            if rand.random() < self.malformed_ratio:
+                yield self.make_malformed_line(rand, i, request_datetime)
+            else:
+                yield self.make_request_line(rand, i, request_datetime)
+
+    def write(self, fp, lines):
+        for line in self.iter_lines(lines):
+            fp.write(line + '\n')
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--seed', type=int, default=42, help='Seed of random numbers')
+    parser.add_argument('--url-groups', dest='url_groups', type=int, default=200,
+                        help='Number of url groups')
+    parser.add_argument('--urls-per-group', dest='urls_per_group', type=int, default=1000,
+                        help='Number of distinct urls in every url group')
+    parser.add_argument('--slow-ratio', dest='slow_ratio', type=float, default=0.3,
+                        help='Ratio of slow requests')
+    parser.add_argument('--min-msecs', dest='min_msecs', type=int, default=200,
+                        help='Requests not faster than this are slow')
+    parser.add_argument('--methods', default='GET:6,POST:2,HEAD:1,OPTIONS:1',
+                        help='Weighted request methods')
+    parser.add_argument('--statuses', default='200:8,302:1,404:1',
+                        help='Weighted response statuses')
+    parser.add_argument('--malformed-ratio', dest='malformed_ratio', type=float, default=0.01,
+                        help='Ratio of malformed lines')
+    parser.add_argument('--requests-per-second', dest='requests_per_second', type=int, default=10,
+                        help='Requests in every second')
+
+
+def make_generator(args, log_format='default'):
+    return LogGenerator(seed=args.seed, url_groups=args.url_groups,
+                        urls_per_group=args.urls_per_group, slow_ratio=args.slow_ratio,
+                        min_msecs=args.min_msecs, methods=args.methods, statuses=args.statuses,
+                        malformed_ratio=args.malformed_ratio,
+                        requests_per_second=args.requests_per_second, log_format=log_format)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic uwsgi log')
+    parser.add_argument('--lines', type=int, default=1000000, help='Number of lines')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='Log file path, default: stdout')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+    make_generator(args).write(args.output, args.lines)
+    args.output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -35,5 +35,8 @@ setup(
         'jinja2',
         'configobj'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     scripts=['uwsgi_sloth/uwsgi-sloth']
 )
@@ -2,11 +2,18 @@
 """Analyzer for uwsgi log"""
 import re
 import copy
+import heapq
+import logging
 import datetime
-from uwsgi_sloth.utils import total_seconds
-from uwsgi_sloth.structures import ValuesAggregation
+from collections import OrderedDict
+from uwsgi_sloth.structures import ValuesAggregation, TopURLsAggregation, TimeSeries, \
+                                   datetime_to_timestamp
 from uwsgi_sloth.settings import FILTER_METHODS, FILTER_STATUS, LIMIT_URL_GROUPS, \
-                                 LIMIT_PER_URL_GROUP, ROOT, REALTIME_UPDATE_INTERVAL
+                                 LIMIT_PER_URL_GROUP, ROOT, URL_CLASSIFY_CACHE_SIZE, \
+                                 MAX_URLS_PER_GROUP, REALTIME_WINDOW_SLOTS, REALTIME_SLOT_SECONDS
+from uwsgi_sloth.models import merge_requests_data_to
+
+logger = logging.getLogger(__name__)
 
 
 class UWSGILogParser(object):
@@ -17,6 +24,8 @@ class UWSGILogParser(object):
                  generated 1053 bytes in 2767 msecs (HTTP/1.1 200) 4 headers in 282 bytes \
                  (1 switches on core 0)"
 
+    Lines can be either text or bytes, for bytes lines, only fields in result are decoded.
+
     Returns:
     ~~~~~~~~
 
@@ -26,11 +35,33 @@ class UWSGILogParser(object):
     RE_LOG_LINE = re.compile(r'''}\ \[(?P<datetime>.*?)\]\ (?P<request_method>POST|GET|DELETE|PUT|PATCH)\s
         (?P<request_uri>[^ ]*?)\ =>\ generated\ (?:.*?)\ in\ (?P<resp_msecs>\d+)\ msecs\s
         \(HTTP/[\d.]+\ (?P<resp_status>\d+)\)''', re.VERBOSE)
+    RE_LOG_LINE_BYTES = re.compile(RE_LOG_LINE.pattern.encode('ascii'), re.VERBOSE)
+    FILTER_METHODS_BYTES = tuple(method.encode('ascii') for method in FILTER_METHODS)
+    FILTER_STATUS_BYTES = tuple(status.encode('ascii') for status in FILTER_STATUS)
+    MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+              'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+    MAX_DATETIME_CACHE_SIZE = 1024
 
     def __init__(self):
-        pass
+        self.datetime_cache = {}
 
     def parse(self, line):
+        if isinstance(line, bytes):
+            return self.parse_bytes(line)
+
+        # Fast path: reject lines by status and method using plain string scanning, which
+        # is much cheaper than running the full regex
+        status_pos = line.find(' msecs (HTTP/')
+        if status_pos != -1:
+            status_pos = line.find(' ', status_pos + 13) + 1
+            if line[status_pos:line.find(')', status_pos)] not in FILTER_STATUS:
+                return
+            method_pos = line.find('] ', line.find('} [')) + 2
+            if line[method_pos:line.find(' ', method_pos)] not in FILTER_METHODS:
+                return
+        elif ' msecs' not in line:
+            return
+
         matched = self.RE_LOG_LINE.search(line)
         if matched:
             matched_dict = matched.groupdict()
@@ -42,8 +73,7 @@ class UWSGILogParser(object):
             url = matched_dict['request_uri'].replace('//', '/')
             url_path = url.split('?')[0]
             resp_time = int(matched_dict['resp_msecs'])
-            request_datetime = datetime.datetime.strptime(matched_dict['datetime'], 
-                                                          self.DATETIME_FORMAT)
+            request_datetime = self.parse_datetime(matched_dict['datetime'])
             return {
                 'method': method,
                 'url': url,
@@ -54,46 +84,197 @@ class UWSGILogParser(object):
             }
         return
 
+    def parse_bytes(self, line):
+        """Parse bytes line, the same as ``parse``"""
+        status_pos = line.find(b' msecs (HTTP/')
+        if status_pos != -1:
+            status_pos = line.find(b' ', status_pos + 13) + 1
+            if line[status_pos:line.find(b')', status_pos)] not in self.FILTER_STATUS_BYTES:
+                return
+            method_pos = line.find(b'] ', line.find(b'} [')) + 2
+            if line[method_pos:line.find(b' ', method_pos)] not in self.FILTER_METHODS_BYTES:
+                return
+        elif b' msecs' not in line:
+            return
+
+        matched = self.RE_LOG_LINE_BYTES.search(line)
+        if matched:
+            method, status, uri, msecs, request_datetime = matched.group(
+                'request_method', 'resp_status', 'request_uri', 'resp_msecs', 'datetime')
+            if not method in self.FILTER_METHODS_BYTES or status not in self.FILTER_STATUS_BYTES:
+                return
+
+            # Invalid characters in url should not break the analyzing
+            url = uri.replace(b'//', b'/').decode('utf-8', 'replace')
+            return {
+                'method': method.decode('ascii'),
+                'url': url,
+                'url_path': url.split('?')[0],
+                'resp_time': int(msecs),
+                'status': status.decode('ascii'),
+                'request_datetime': self.parse_datetime(request_datetime)
+            }
+        return
+
+    def parse_line_datetime(self, line):
+        """Only parse datetime of given line, return None if not found"""
+        start_mark, end_mark = (b'} [', b']') if isinstance(line, bytes) else ('} [', ']')
+        start = line.find(start_mark)
+        if start == -1:
+            return
+        end = line.find(end_mark, start + 3)
+        if end == -1:
+            return
+        try:
+            return self.parse_datetime(line[start + 3:end])
+        except ValueError:
+            return
+
+    def parse_datetime(self, value):
+        """Parse datetime string like "Tue Apr 29 00:13:10 2014", results are cached because
+        lots of lines share the same second."""
+        try:
+            return self.datetime_cache[value]
+        except KeyError:
+            pass
+
+        text = value.decode('ascii', 'replace') if isinstance(value, bytes) else value
+        try:
+            _, month, day, time, year = text.split()
+            hour, minute, second = time.split(':')
+            result = datetime.datetime(int(year), self.MONTHS[month], int(day),
+                                       int(hour), int(minute), int(second))
+        except (ValueError, KeyError):
+            result = datetime.datetime.strptime(text, self.DATETIME_FORMAT)
+
+        if len(self.datetime_cache) >= self.MAX_DATETIME_CACHE_SIZE:
+            self.datetime_cache.clear()
+        self.datetime_cache[value] = result
+        return result
+
 
 class URLClassifier(object):
     """A simple url classifier, current rules:
         
     - replacing sequential digits part by '(\d+)'    
+
+    Classified results are cached in a LRU cache, user defined rules will be combined into
+    one regex so a cache miss only costs one regex pass.
     """
 
     RE_SIMPLIFY_URL = re.compile(r'(?<=/)\d+(/|$)')
+    RE_NAMED_GROUP = re.compile(r'(?<!\\)\(\?P<\w+>')
+    RE_BACKREFERENCE = re.compile(r'\(\?P=|\\[1-9]')
 
-    def __init__(self, user_defined_rules=[]):
+    def __init__(self, user_defined_rules=[], cache_size=URL_CLASSIFY_CACHE_SIZE):
         self.user_defined_rules = user_defined_rules
+        self.re_combined_rules, self.combined_rule_names = self.combine_rules(user_defined_rules)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def combine_rules(self, user_defined_rules):
+        """Combine user defined rules into one regex, use named group to find out which rule
+        was matched.
+
+        :returns: (combined regex, {group name: rule}), regex will be None if rules can not
+                  be combined, e.g. a rule contains backreference.
+        """
+        if not user_defined_rules:
+            return None, {}
+        flags = set(dict_api_url['re'].flags for dict_api_url in user_defined_rules)
+        if len(flags) != 1:
+            return None, {}
+
+        patterns = []
+        rule_names = {}
+        for i, dict_api_url in enumerate(user_defined_rules):
+            pattern = dict_api_url['re'].pattern
+            if self.RE_BACKREFERENCE.search(pattern):
+                return None, {}
+            name = '_rule_%d' % i
+            # Named groups in different rules may have the same names, turn them into
+            # unnamed groups
+            patterns.append('(?P<%s>%s)' % (name, self.RE_NAMED_GROUP.sub('(', pattern)))
+            rule_names[name] = dict_api_url['str']
+        try:
+            return re.compile('|'.join(patterns), flags.pop()), rule_names
+        except re.error:
+            logger.warning('Unable to combine url rules, fallback to match them one by one.')
+            return None, {}
 
     def classify(self, url_path):
         """Classify an url"""
-        for dict_api_url in self.user_defined_rules:
-            api_url = dict_api_url['str']
-            re_api_url = dict_api_url['re']
-            if re_api_url.match(url_path[1:]):
-                return api_url
+        try:
+            result = self.cache[url_path]
+        except KeyError:
+            pass
+        else:
+            self.cache_hits += 1
+            self.cache.move_to_end(url_path)
+            return result
+
+        self.cache_misses += 1
+        result = self._classify(url_path)
+        if self.cache_size:
+            self.cache[url_path] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def _classify(self, url_path):
+        if self.re_combined_rules:
+            matched = self.re_combined_rules.match(url_path[1:])
+            if matched:
+                return self.combined_rule_names[matched.lastgroup]
+        else:
+            for dict_api_url in self.user_defined_rules:
+                api_url = dict_api_url['str']
+                re_api_url = dict_api_url['re']
+                if re_api_url.match(url_path[1:]):
+                    return api_url
 
         return self.RE_SIMPLIFY_URL.sub(r'(\\d+)/', url_path)
 
+    def get_cache_stats(self):
+        """Get a readable string of cache stats"""
+        total = self.cache_hits + self.cache_misses
+        return 'url classify cache hits: %s, misses: %s, hit rate: %s' % (
+            self.cache_hits, self.cache_misses,
+            format(self.cache_hits / float(total), '.2%') if total else '-')
+
+
+def new_url_group_data(max_urls_per_group=MAX_URLS_PER_GROUP):
+    """Make an empty data of url group"""
+    return {
+        'urls': TopURLsAggregation(max_urls_per_group),
+        'duration_agr_data': ValuesAggregation(with_sketch=True),
+        'time_series': TimeSeries(),
+    }
+
 
 class LogAnalyzer(object):
     """Log analyzer"""
 
-    def __init__(self, url_classifier=None, min_msecs=200, start_from_datetime=None):
+    def __init__(self, url_classifier=None, min_msecs=200, start_from_datetime=None,
+                 max_urls_per_group=MAX_URLS_PER_GROUP, log_parser=None):
         self.data = {}
         self.requests_counter = {'normal': 0, 'slow': 0}
         self.total_slow_duration = 0
 
         self.min_msecs = min_msecs
         self.start_from_datetime = start_from_datetime
+        self.max_urls_per_group = max_urls_per_group
         self.datetime_range = [None, None]
+        # Slow requests of all url groups by time
+        self.time_series = TimeSeries(with_sketch=True)
 
         self.url_classifier = url_classifier or URLClassifier()
-        self.log_parser = UWSGILogParser()
+        self.log_parser = log_parser or UWSGILogParser()
 
     def analyze_line(self, line):
-        line = line.strip()
         result = self.log_parser.parse(line)
         # Ignore invalid log
         if not result:
@@ -103,9 +284,12 @@ class LogAnalyzer(object):
 
         self.requests_counter['normal'] += 1
 
-        if not self.datetime_range[0]:
-            self.datetime_range[0] = result['request_datetime']
-        self.datetime_range[1] = result['request_datetime']
+        # Lines may be a little out of order, range covers all of them
+        request_datetime, datetime_range = result['request_datetime'], self.datetime_range
+        if not datetime_range[0] or request_datetime < datetime_range[0]:
+            datetime_range[0] = request_datetime
+        if not datetime_range[1] or request_datetime > datetime_range[1]:
+            datetime_range[1] = request_datetime
         if result['resp_time'] < self.min_msecs:
             return
 
@@ -114,13 +298,16 @@ class LogAnalyzer(object):
         # Use url_classifier to classify url
         matched_url_rule = self.url_classifier.classify(result['url_path'])
 
-        big_d = self.data.setdefault((result['method'], matched_url_rule), {
-            'urls': {},
-            'duration_agr_data': ValuesAggregation(),
-        })
+        url_group = (result['method'], matched_url_rule)
+        big_d = self.data.get(url_group)
+        if big_d is None:
+            big_d = self.data[url_group] = new_url_group_data(self.max_urls_per_group)
 
+        timestamp = datetime_to_timestamp(result['request_datetime'])
         big_d['duration_agr_data'].add_value(resp_time)
-        big_d['urls'].setdefault(result['url'], ValuesAggregation()).add_value(resp_time)
+        big_d['urls'].add_value(result['url'], resp_time)
+        big_d['time_series'].add_value(timestamp, resp_time)
+        self.time_series.add_value(timestamp, resp_time)
         
         self.requests_counter['slow'] += 1
         self.total_slow_duration += resp_time
@@ -130,85 +317,202 @@ class LogAnalyzer(object):
             'requests_counter': self.requests_counter,
             'total_slow_duration': self.total_slow_duration,
             'datetime_range': self.datetime_range,
+            'time_series': self.time_series,
             'data_details': self.data
         }
 
 
-class RealtimeLogAnalyzer(object):
-    """Log analyzer for realtime support"""
-
-    default_data = {
+def new_requests_data():
+    """Make an empty requests data for realtime analyzing"""
+    return {
         'requests_counter': {'normal': 0, 'slow': 0},
         'total_slow_duration': 0,
-        'data_details': {}
+        'data_details': {},
+        'time_series': TimeSeries(with_sketch=True),
     }
 
-    def __init__(self, url_classifier=None, min_msecs=200, start_from_datetime=None):
+
+class RealtimeLogAnalyzer(object):
+    """Log analyzer for realtime support
+
+    Requests are analyzed to data of the day(today and yesterday) and a sliding window. The
+    window is a ring of ``window_slots`` slots, every slot holds data of ``slot_seconds``, so
+    data of last N minutes can be got exactly by merging slots.
+
+    Dates are cached and only updated by ``tick()``, it will be called automatically when a
+    request of a newer day was found, once for every newer day, so requests dated in the
+    future(clock skew) do not get the clock on every line. Dates are also updated by
+    ``tick(now)`` of "uwsgi-sloth start" at every interval.
+
+    ``take_snapshot()`` hands data over for persisting and rendering in another thread, data
+    of days is detached and window slots are copied before modified, so snapshots are never
+    modified by analyzing.
+    """
+
+    def __init__(self, url_classifier=None, min_msecs=200, start_from_datetime=None,
+                 max_urls_per_group=MAX_URLS_PER_GROUP, window_slots=REALTIME_WINDOW_SLOTS,
+                 slot_seconds=REALTIME_SLOT_SECONDS, metrics=None, log_parser=None):
         self.data = {}
+        # Optional ``RequestMetrics``, all requests are counted to it
+        self.metrics = metrics
         self.min_msecs = min_msecs
         self.start_from_datetime = start_from_datetime
+        self.max_urls_per_group = max_urls_per_group
         self.last_analyzed_datetime = None
 
+        self.window_slots = window_slots
+        self.slot_seconds = slot_seconds
+        self.slot_ids = [None] * window_slots
+        self.slots = [None] * window_slots
+        self.latest_slot_id = None
+        # Ids of slots shared with snapshots
+        self.shared_slot_ids = set()
+        # Increased every time data changed
+        self.revision = 0
+
         self.url_classifier = url_classifier or URLClassifier()
-        self.log_parser = UWSGILogParser()
+        self.log_parser = log_parser or UWSGILogParser()
+        # Newest date of requests which caused a tick
+        self.ticked_date = None
+        self.tick()
+
+    def tick(self, now=None):
+        """Update cached dates"""
+        now = now or datetime.datetime.now()
+        self.today = now.date()
+        self.yesterday = self.today - datetime.timedelta(days=1)
+        self.today_name = self.today.isoformat()
+        self.yesterday_name = self.yesterday.isoformat()
 
     def analyze_line(self, line):
-        line = line.strip()
         result = self.log_parser.parse(line)
         # Ignore invalid log
         if not result:
             return
-        if self.start_from_datetime and result['request_datetime'] <= self.start_from_datetime:
-            return
         request_datetime = result['request_datetime']
-        self.last_analyzed_datetime = request_datetime
-        groups = self.get_result_group_names(request_datetime)
-        if not groups:
+        if self.start_from_datetime and request_datetime <= self.start_from_datetime:
             return
+        self.last_analyzed_datetime = request_datetime
 
-        for group in groups:
-            if group not in self.data:
-                self.data[group] = copy.deepcopy(self.default_data)
+        matched_url_rule = None
+        if self.metrics is not None:
+            matched_url_rule = self.url_classifier.classify(result['url_path'])
+            self.metrics.observe(result['method'], matched_url_rule, result['resp_time'],
+                                 result['resp_time'] >= self.min_msecs, request_datetime)
 
-        for group in groups:
-            self.data[group]['requests_counter']['normal'] += 1
+        request_date = request_datetime.date()
+        if request_date > self.today and (self.ticked_date is None or
+                                          request_date > self.ticked_date):
+            self.ticked_date = request_date
+            self.tick()
+        targets = []
+        if request_date == self.today:
+            targets.append(self.get_day_data(self.today_name))
+        elif request_date == self.yesterday:
+            targets.append(self.get_day_data(self.yesterday_name))
+        timestamp = datetime_to_timestamp(request_datetime)
+        slot = self.get_slot_data(timestamp)
+        if slot is not None:
+            targets.append(slot)
+        if not targets:
+            return
+
+        self.revision += 1
+        for data in targets:
+            data['requests_counter']['normal'] += 1
         if result['resp_time'] < self.min_msecs:
             return
 
         resp_time = result['resp_time']
 
         # Use url_classifier to classify url
-        matched_url_rule = self.url_classifier.classify(result['url_path'])
+        if matched_url_rule is None:
+            matched_url_rule = self.url_classifier.classify(result['url_path'])
 
-        for group in groups:
-            big_d = self.data[group]['data_details'].setdefault((result['method'], matched_url_rule), {
-                'urls': {},
-                'duration_agr_data': ValuesAggregation(),
-            })
+        url_group = (result['method'], matched_url_rule)
+        for data in targets:
+            data_details = data['data_details']
+            big_d = data_details.get(url_group)
+            if big_d is None:
+                big_d = data_details[url_group] = new_url_group_data(self.max_urls_per_group)
 
             big_d['duration_agr_data'].add_value(resp_time)
-            big_d['urls'].setdefault(result['url'], ValuesAggregation()).add_value(resp_time)
-            
-            self.data[group]['requests_counter']['slow'] += 1
-            self.data[group]['total_slow_duration'] += resp_time
-
-    def get_result_group_names(self, request_datetime):
-        """Only today/yesterday/last interval are valid datetime"""
-        request_date = request_datetime.date()
-        today = datetime.date.today()
-        yesterday = datetime.date.today() - datetime.timedelta(days=1)
-        result = []
-        if total_seconds(datetime.datetime.now() - request_datetime) < REALTIME_UPDATE_INTERVAL:
-            result.append('last_interval')
-        if request_date == today:
-            result.append(today.isoformat())
-        elif request_date == yesterday:
-            result.append(yesterday.isoformat())
-        return result
+            big_d['urls'].add_value(result['url'], resp_time)
+            big_d['time_series'].add_value(timestamp, resp_time)
+            data['time_series'].add_value(timestamp, resp_time)
+
+            data['requests_counter']['slow'] += 1
+            data['total_slow_duration'] += resp_time
+
+    def get_day_data(self, date_name):
+        data = self.data.get(date_name)
+        if data is None:
+            data = self.data[date_name] = new_requests_data()
+        return data
+
+    def get_slot_data(self, timestamp):
+        """Get data of the window slot for ``timestamp``, returns None if it is older than
+        the window."""
+        slot_id = timestamp // self.slot_seconds
+        if self.latest_slot_id is None or slot_id > self.latest_slot_id:
+            self.latest_slot_id = slot_id
+        elif slot_id <= self.latest_slot_id - self.window_slots:
+            return None
+        index = slot_id % self.window_slots
+        if self.slot_ids[index] != slot_id:
+            self.slot_ids[index] = slot_id
+            self.slots[index] = new_requests_data()
+        elif slot_id in self.shared_slot_ids:
+            # Copy on write
+            self.shared_slot_ids.discard(slot_id)
+            self.slots[index] = copy.deepcopy(self.slots[index])
+        return self.slots[index]
+
+    def get_window_data(self, seconds, now=None, slots=None):
+        """Get merged data of requests in last ``seconds``, it should not be longer than the
+        window.
+
+        :param slots: slots of a snapshot, default to current slots
+        """
+        now_slot_id = datetime_to_timestamp(now or datetime.datetime.now()) // self.slot_seconds
+        min_slot_id = now_slot_id - seconds // self.slot_seconds
+        if slots is None:
+            slots = zip(self.slot_ids, self.slots)
+        data = new_requests_data()
+        for slot_id, slot in sorted((slot_id, slot) for slot_id, slot in slots
+                                    if slot_id is not None and min_slot_id < slot_id <= now_slot_id):
+            merge_requests_data_to(data, slot)
+        return data
+
+    def take_snapshot(self):
+        """Take data analyzed since last snapshot and current window slots, analyzing continues
+        with empty data of days.
+
+        :returns: (data of days, [(slot_id, slot), ...])
+        """
+        days_data, self.data = self.data, {}
+        if days_data:
+            self.revision += 1
+        return days_data, self.share_slots()
+
+    def share_slots(self):
+        """Get current window slots, they will be copied before modified by analyzing
+
+        :returns: [(slot_id, slot), ...]
+        """
+        slots = [(slot_id, slot) for slot_id, slot in zip(self.slot_ids, self.slots)
+                 if slot_id is not None]
+        # Slots not in the window anymore are never modified again
+        self.shared_slot_ids = set(slot_id for slot_id, _ in slots)
+        return slots
+
+    def get_result_date_names(self):
+        """Names of dates which are still being analyzed: today and yesterday"""
+        return [self.today_name, self.yesterday_name]
 
     def get_data(self, key=None):
         if key:
-            return self.data.get(key, self.default_data)
+            return self.data.get(key) or new_requests_data()
         return self.data
 
     def clean_data_by_key(self, key):
@@ -216,19 +520,46 @@ class RealtimeLogAnalyzer(object):
             del self.data[key]
         except KeyError:
             pass
+        else:
+            self.revision += 1
 
 
-def format_data(raw_data, limit_per_url_group=LIMIT_PER_URL_GROUP, limit_url_groups=LIMIT_URL_GROUPS):
-    """Fomat data from LogAnalyzer for render purpose"""
-    data = copy.deepcopy(raw_data)
-    for k, v in list(data['data_details'].items()):
-        # Only reserve first ``limit_per_url_group`` items
-        v['urls'] = sorted(list(v['urls'].items()), key=lambda k_v: k_v[1].total,
-                           reverse=True)[:limit_per_url_group]
+def format_data(raw_data, limit_per_url_group=LIMIT_PER_URL_GROUP, limit_url_groups=LIMIT_URL_GROUPS,
+                cache=None):
+    """Fomat data from LogAnalyzer for render purpose, ``raw_data`` will not be modified.
 
-    data_details = sorted(iter(data['data_details'].items()),
-                          key=lambda k_v1: k_v1[1]["duration_agr_data"].total, 
-                          reverse=True)[:limit_url_groups]
+    :param cache: optional dict for caching top urls of url groups, top urls will be reused
+                  by next call if the url group has no new requests.
+    """
+    data = dict(raw_data)
+    data_details = heapq.nlargest(limit_url_groups, raw_data['data_details'].items(),
+                                  key=lambda k_v1: k_v1[1]["duration_agr_data"].total)
+
+    # Trends of url groups are aligned to the time range of all requests
+    time_series = raw_data.get('time_series')
+    if time_series is not None and time_series.start is not None:
+        trend_range = (time_series.start, time_series.end)
+    else:
+        trend_range = None
+
+    new_cache = {}
+    for i, (k, v) in enumerate(data_details):
+        agr = v['duration_agr_data']
+        cached = cache.get(k) if cache is not None else None
+        if cached and cached[0] is agr and cached[1] == agr.count:
+            urls = cached[2]
+        else:
+            # Only reserve first ``limit_per_url_group`` items
+            urls = heapq.nlargest(limit_per_url_group, v['urls'].items(), key=lambda k_v: k_v[1].total)
+        new_cache[k] = (agr, agr.count, urls)
+        trend = None
+        if trend_range and v.get('time_series') is not None:
+            trend = format_trend_line(v['time_series'], trend_range, TREND_LINE_SIZE)
+        data_details[i] = (k, dict(v, urls=urls, trend=trend))
+
+    if cache is not None:
+        cache.clear()
+        cache.update(new_cache)
 
     if data['requests_counter']['normal']:
         slow_rate = format(data['requests_counter']['slow'] / \
@@ -238,7 +569,55 @@ def format_data(raw_data, limit_per_url_group=LIMIT_PER_URL_GROUP, limit_url_gro
     data.update({
         'slow_rate': slow_rate,
         'data_details': data_details,
+        'trend_chart': format_trend_chart(time_series, TREND_CHART_SIZE) if trend_range else None,
     })
     return data
 
 
+# (width, height) of trend charts in pixels
+TREND_CHART_SIZE = (900, 160)
+TREND_LINE_SIZE = (120, 24)
+
+
+def format_trend_chart(time_series, size):
+    """Make data for rendering trend chart of slow requests: a bar for number of requests and
+    a line for P95 duration of every bucket."""
+    width, height = size
+    points = time_series.get_points()
+    bar_width = width / float(len(points))
+    max_count = max(point['count'] for point in points) or 1
+    max_duration = max(point['p95'] or point['avg'] for point in points) or 1
+
+    bars, line = [], []
+    for i, point in enumerate(points):
+        bar_height = height * point['count'] / float(max_count)
+        bars.append(dict(point, x=i * bar_width, y=height - bar_height, width=bar_width,
+                         height=bar_height))
+        if point['count']:
+            duration = point['p95'] or point['avg']
+            line.append('%.1f,%.1f' % ((i + 0.5) * bar_width, height - height * duration / max_duration))
+    return {
+        'width': width,
+        'height': height,
+        'bars': bars,
+        'line': ' '.join(line),
+        'max_count': max_count,
+        'max_duration': max_duration,
+        'bucket_minutes': time_series.bucket_seconds // 60,
+    }
+
+
+def format_trend_line(time_series, trend_range, size):
+    """Make points of a polyline for number of requests of ``time_series`` in ``trend_range``"""
+    width, height = size
+    start, end = trend_range
+    max_count = max(time_series.counts) if time_series.counts else 0
+    if not max_count:
+        return ''
+    points = []
+    for i, count in enumerate(time_series.counts):
+        # Middle of the bucket
+        timestamp = time_series.start + (i + 0.5) * time_series.bucket_seconds
+        x = width * (timestamp - start) / float(end - start)
+        points.append('%.1f,%.1f' % (x, height - height * count / float(max_count)))
+    return ' '.join(points)
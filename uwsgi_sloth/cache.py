@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Cache of analyzed results of log files"""
+import os
+import pickle
+import hashlib
+import logging
+
+from uwsgi_sloth.models import atomic_dump
+from uwsgi_sloth.utils import makedir_if_none_exists
+
+logger = logging.getLogger(__name__)
+
+# Size of file head used for identifying a file
+FINGERPRINT_SIZE = 4096
+
+
+def get_default_cache_dir():
+    """Default cache directory: $XDG_CACHE_HOME/uwsgi-sloth or ~/.cache/uwsgi-sloth"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'uwsgi-sloth')
+
+
+def get_file_info(file_path, fingerprint_size=FINGERPRINT_SIZE):
+    """Get info for identifying a file and checking whether it was modified"""
+    with open(file_path, 'rb') as fp:
+        file_stat = os.fstat(fp.fileno())
+        head = fp.read(fingerprint_size)
+    return {
+        'ino': file_stat.st_ino,
+        'dev': file_stat.st_dev,
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'fingerprint': hashlib.sha1(head).hexdigest(),
+        'fingerprint_size': len(head),
+    }
+
+
+class ResultCache(object):
+    """Analyzed results of log files are cached by file path and the options which affect
+    results, options only affect rendering(like limits of url groups) are not included.
+
+    Every cache records the file info when it was analyzed and the offset analyzed to. If the
+    file was only appended since then(same inode and same head), lines after the offset can
+    be analyzed and merged to the cached result.
+
+    :param cache_dir: directory for storing cache files
+    :param options: tuple of options which affect analyzed results
+    """
+    format_version = 3
+
+    def __init__(self, cache_dir, options):
+        self.cache_dir = cache_dir
+        self.options = options
+        makedir_if_none_exists(cache_dir)
+
+    def make_key(self, file_path):
+        return (self.format_version, os.path.abspath(file_path), self.options)
+
+    def get_cache_path(self, file_path):
+        digest = hashlib.sha1(repr(self.make_key(file_path)).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '%s.pickle' % digest)
+
+    def load(self, file_path):
+        """Load cache of log file
+
+        :returns: (header, data), (None, None) if not cached
+        """
+        cache_path = self.get_cache_path(file_path)
+        try:
+            with open(cache_path, 'rb') as fp:
+                header = pickle.load(fp)
+                if header['key'] != self.make_key(file_path):
+                    return None, None
+                return header, pickle.load(fp)
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError) as e:
+            if os.path.exists(cache_path):
+                logger.warning('Unable to load cache file %s: %s' % (cache_path, e))
+            return None, None
+
+    def lookup(self, file_path, file_info):
+        """Lookup cached result of log file
+
+        :param file_info: current info of the file, see ``get_file_info``
+        :returns: (data, offset), data is None if there is no usable cache, offset is None if
+                  the file was not modified since cached, otherwise lines after offset should
+                  be analyzed.
+        """
+        header, data = self.load(file_path)
+        if header is None:
+            return None, 0
+        cached_info = header['file_info']
+        if all(cached_info[name] == file_info[name] for name in ('ino', 'dev', 'size', 'mtime_ns')):
+            return data, None
+
+        # Check whether the file was only appended
+        offset = header['offset']
+        if offset is None or (cached_info['ino'], cached_info['dev']) != \
+                (file_info['ino'], file_info['dev']) or file_info['size'] < cached_info['size']:
+            return None, 0
+        if get_file_info(file_path, cached_info['fingerprint_size'])['fingerprint'] != \
+                cached_info['fingerprint']:
+            return None, 0
+        return data, offset
+
+    def set(self, file_path, data, file_info, offset=None):
+        """Cache result of log file
+
+        :param file_info: info of the file taken before analyzing, so modifications made
+                          during analyzing will not be hidden by cache.
+        :param offset: offset analyzed to, None if analyzing can not be resumed(compressed file)
+        """
+        header = {'key': self.make_key(file_path), 'file_info': file_info, 'offset': offset}
+        atomic_dump([header, data], self.get_cache_path(file_path))
+
+
+def make_cache_options(min_msecs, max_urls_per_group, url_rules, log_format=None):
+    """Make options tuple for ``ResultCache``"""
+    return (min_msecs, max_urls_per_group, tuple(rule['str'] for rule in url_rules),
+            log_format or 'default')
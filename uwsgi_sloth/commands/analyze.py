@@ -1,57 +1,389 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
+import glob
 import time
 import logging
 import argparse
+import multiprocessing
 
-from uwsgi_sloth.settings import LIMIT_URL_GROUPS, LIMIT_PER_URL_GROUP
+from uwsgi_sloth.settings import LIMIT_URL_GROUPS, LIMIT_PER_URL_GROUP, MAX_URLS_PER_GROUP
 from uwsgi_sloth.analyzer import URLClassifier, LogAnalyzer, format_data
 from uwsgi_sloth.template import render_template
 from uwsgi_sloth.utils import parse_url_rules
+from uwsgi_sloth.models import merge_requests_data_to, union_datetime_range
+from uwsgi_sloth.compression import detect_compression, detect_file_compression, open_decompressed, \
+                                    iter_line_blocks, UnsupportedCompression
+from uwsgi_sloth.cache import ResultCache, make_cache_options, get_file_info, get_default_cache_dir
+from uwsgi_sloth.parsers import make_log_parser, InvalidLogFormat
+from uwsgi_sloth.export import write_export, make_export_header, get_host_name
+from uwsgi_sloth.profiling import StageProfiler, profile_stage, start_cprofile, dump_cprofile
 
 logger = logging.getLogger('uwsgi_sloth.analyze')
 
+# Log file is read in binary mode with a big buffer
+READ_BUFFER_SIZE = 1024 * 1024
+FIND_BLOCK_SIZE = 64 * 1024
 
-def analyze_log(fp, configs, url_rules):
-    """Analyze log file"""
+
+def analyze_log(fp, configs, url_rules, profiler=None):
+    """Analyze log file, compressed file will be decompressed on the fly
+
+    :param profiler: a ``StageProfiler`` for measuring stages of analyzing
+    """
     url_classifier = URLClassifier(url_rules)
-    analyzer = LogAnalyzer(url_classifier=url_classifier, min_msecs=configs.min_msecs)
-    for line in fp:
-        analyzer.analyze_line(line)
+    analyzer = LogAnalyzer(url_classifier=url_classifier, min_msecs=configs.min_msecs,
+                           max_urls_per_group=configs.max_urls_per_group,
+                           log_parser=make_log_parser(configs.log_format))
+    if profiler is not None:
+        profiler.instrument_analyzer(analyzer)
+    compression = detect_compression(fp)
+    if compression:
+        logger.info('Decompressing %s compressed log file...' % compression)
+        blocks = iter_line_blocks(open_decompressed(fp, compression))
+        if profiler is not None:
+            blocks = profiler.iter_timed(blocks, 'read')
+        for lines in blocks:
+            for line in lines:
+                analyzer.analyze_line(line)
+    else:
+        for line in (fp if profiler is None else profiler.iter_timed(fp, 'read')):
+            analyzer.analyze_line(line)
+    logger.info(url_classifier.get_cache_stats())
     return analyzer.get_data()
 
 
-def analyze(args):
-    # Get custom url rules
-    url_rules = []
-    if args.url_file:
-        url_rules = parse_url_rules(args.url_file)
+def analyze_file(file_path, start, end, min_msecs, max_urls_per_group, url_rules, log_format=None):
+    """Analyze log file of given path, ``start`` and ``end`` are ignored for compressed file"""
+    configs = argparse.Namespace(min_msecs=min_msecs, max_urls_per_group=max_urls_per_group,
+                                 log_format=log_format)
+    data = analyze_single_file(file_path, configs, url_rules, 1, start, end)
+    logger.info('Analyzed log file "%s".' % file_path)
+    return file_path, data
 
-    logger.info('Analyzing log file "%s"...' % args.filepath.name)
-    start_time = time.time()
-    data = analyze_log(args.filepath, args, url_rules)
-    data = format_data(data, args.limit_per_url_group, args.limit_url_groups)
+
+def _analyze_file(task):
+    return analyze_file(*task)
+
+
+def expand_file_paths(patterns):
+    """Expand glob patterns to file paths, duplicated paths are removed"""
+    file_paths = []
+    for pattern in patterns:
+        matched_paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matched_paths:
+            raise ValueError('No log file matches "%s"' % pattern)
+        for file_path in matched_paths:
+            if not os.path.isfile(file_path):
+                raise ValueError('Log file "%s" does not exist' % file_path)
+            if file_path not in file_paths:
+                file_paths.append(file_path)
+    return file_paths
+
+
+def merge_files_data(files_data):
+    """Merge analyzed results of many log files, results are merged in the order of their
+    datetime ranges, so rotated log files can be passed in any order. Datetime ranges may
+    overlap, like logs of different hosts, the merged range covers all of them."""
+    data = None
+    files_data = sorted(files_data, key=lambda d: (d['datetime_range'][0] is None,
+                                                   d['datetime_range'][0]))
+    for file_data in files_data:
+        if data is None:
+            data = file_data
+            continue
+        merge_requests_data_to(data, file_data)
+        union_datetime_range(data['datetime_range'], file_data['datetime_range'])
+    return data
+
+
+def analyze_files(file_paths, configs, url_rules, workers, cache=None, profiler=None):
+    """Analyze many log files using a pool of processes.
+
+    If ``cache`` is given, cached results of unmodified files will be used directly, for
+    files which were only appended, only the new lines will be analyzed. ``profiler`` only
+    measures files analyzed in this process.
+
+    The unterminated last line of an uncompressed file is analyzed but not cached, it may
+    still grow, so it is analyzed again by resuming next time.
+    """
+    files_data = []
+    file_infos = {}
+    cached_files_data = {}
+    # {file_path: (start, end)} of unterminated last lines
+    tails = {}
+    tasks = []
+    for file_path in file_paths:
+        start, end = 0, None
+        if cache:
+            file_info = file_infos[file_path] = get_file_info(file_path)
+            cached_data, offset = cache.lookup(file_path, file_info)
+            if cached_data is not None and offset is None:
+                logger.info('Use cached result of log file "%s".' % file_path)
+                files_data.append(cached_data)
+                continue
+            if not detect_file_compression(file_path):
+                # Analyze to a fixed offset, so the cached result can be resumed exactly
+                end = find_last_line_end(file_path, file_info['size'])
+                if end < file_info['size']:
+                    tails[file_path] = (end, file_info['size'])
+            if cached_data is not None:
+                logger.info('Log file "%s" was appended, analyze it from offset %s.' %
+                            (file_path, offset))
+                cached_files_data[file_path] = cached_data
+                start = offset
+        tasks.append((file_path, start, end, configs.min_msecs, configs.max_urls_per_group,
+                      url_rules, configs.log_format))
+    ends = dict((task[0], task[2]) for task in tasks)
+
+    def handle_results(results):
+        for file_path, data in results:
+            cached_data = cached_files_data.pop(file_path, None)
+            if cached_data is not None:
+                merge_requests_data_to(cached_data, data)
+                union_datetime_range(cached_data['datetime_range'], data['datetime_range'])
+                data = cached_data
+            if cache:
+                file_info = file_infos[file_path]
+                if file_path in tails:
+                    # Cached result does not include the tail, it must never look unmodified
+                    file_info = dict(file_info, size=ends[file_path])
+                cache.set(file_path, data, file_info, offset=ends[file_path])
+            if file_path in tails:
+                start, end = tails[file_path]
+                tail_data = analyze_file_range(file_path, start, end, configs.min_msecs,
+                                               configs.max_urls_per_group, url_rules,
+                                               configs.log_format)
+                merge_requests_data_to(data, tail_data)
+                union_datetime_range(data['datetime_range'], tail_data['datetime_range'])
+            yield data
+
+    if len(tasks) > 1 and workers > 1:
+        logger.info('Analyzing %s log files using %s workers...' % (len(tasks), workers))
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            files_data.extend(handle_results(pool.imap_unordered(_analyze_file, tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = ((task[0], analyze_single_file(task[0], configs, url_rules, workers,
+                                                 task[1], task[2], profiler=profiler))
+                   for task in tasks)
+        files_data.extend(handle_results(results))
+    with profile_stage(profiler, 'merge'):
+        return merge_files_data(files_data)
+
+
+def find_last_line_end(file_path, size):
+    """Find the offset after the last line terminator in first ``size`` bytes of file, so the
+    incomplete line being written will not be cached."""
+    with open(file_path, 'rb') as fp:
+        pos = size
+        while pos > 0:
+            block_start = max(0, pos - FIND_BLOCK_SIZE)
+            fp.seek(block_start)
+            index = fp.read(pos - block_start).rfind(b'\n')
+            if index >= 0:
+                return block_start + index + 1
+            pos = block_start
+    return 0
+
+
+def split_file_ranges(file_path, parts, start=0, end=None):
+    """Split file(or byte range [start, end) of it) into at most ``parts`` byte ranges, every
+    range starts at the beginning of a line.
+
+    :returns: list of (start, end) tuples
+    """
+    if end is None:
+        end = os.path.getsize(file_path)
+    offsets = [start]
+    with open(file_path, 'rb') as fp:
+        for i in range(1, parts):
+            pos = start + (end - start) * i // parts
+            if pos <= offsets[-1]:
+                continue
+            # Move to the beginning of next line
+            fp.seek(pos - 1)
+            fp.readline()
+            pos = fp.tell()
+            if offsets[-1] < pos < end:
+                offsets.append(pos)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def analyze_file_range(file_path, start, end, min_msecs, max_urls_per_group, url_rules,
+                       log_format=None, profiler=None):
+    """Analyze lines between byte range [start, end) of log file"""
+    url_classifier = URLClassifier(url_rules)
+    analyzer = LogAnalyzer(url_classifier=url_classifier, min_msecs=min_msecs,
+                           max_urls_per_group=max_urls_per_group,
+                           log_parser=make_log_parser(log_format))
+    if profiler is not None:
+        profiler.instrument_analyzer(analyzer)
+    with open(file_path, 'rb', buffering=READ_BUFFER_SIZE) as fp:
+        fp.seek(start)
+        pos = start
+        for line in (fp if profiler is None else profiler.iter_timed(fp, 'read')):
+            if pos >= end:
+                break
+            pos += len(line)
+            analyzer.analyze_line(line)
+    logger.info('Range %s-%s: %s' % (start, end, url_classifier.get_cache_stats()))
+    return analyzer.get_data()
+
+
+def _analyze_file_range(task):
+    return analyze_file_range(*task)
+
+
+def analyze_log_parallel(file_path, configs, url_rules, workers, start=0, end=None):
+    """Analyze log file using multiple processes, the file will be splitted into byte ranges
+    and analyzed results of each range will be merged in order."""
+    ranges = split_file_ranges(file_path, workers, start, end)
+    tasks = [(file_path, start, end, configs.min_msecs, configs.max_urls_per_group, url_rules,
+              configs.log_format) for start, end in ranges]
+    logger.info('Analyzing %s parts using %s workers...' % (len(tasks), workers))
+
+    data = None
+    pool = multiprocessing.Pool(workers)
+    try:
+        # Results must be merged in order, so the report will be the same as analyzing
+        # the file in one process.
+        for part_data in pool.imap(_analyze_file_range, tasks):
+            if data is None:
+                data = part_data
+                continue
+            merge_requests_data_to(data, part_data)
+            union_datetime_range(data['datetime_range'], part_data['datetime_range'])
+    finally:
+        pool.close()
+        pool.join()
+    return data
+
+
+def analyze_single_file(file_path, configs, url_rules, workers, start=0, end=None,
+                        profiler=None):
+    """Analyze one log file, uncompressed file will be splitted into byte ranges if
+    ``workers`` is greater than 1.
+
+    :param start: analyze uncompressed file from this offset
+    :param end: analyze uncompressed file to this offset, default to the end of file
+    :param profiler: a ``StageProfiler``, only used when analyzing in this process
+    """
+    if file_path == '-':
+        return analyze_log(sys.stdin.buffer, configs, url_rules, profiler)
+
+    with open(file_path, 'rb', buffering=READ_BUFFER_SIZE) as fp:
+        compression = detect_compression(fp)
+        if compression:
+            if workers > 1:
+                logger.info('Compressed log file can not be splitted, analyzing it in one process.')
+            return analyze_log(fp, configs, url_rules, profiler)
+        if workers <= 1 and not start and end is None:
+            return analyze_log(fp, configs, url_rules, profiler)
+    if workers <= 1:
+        if end is None:
+            end = os.path.getsize(file_path)
+        return analyze_file_range(file_path, start, end, configs.min_msecs,
+                                  configs.max_urls_per_group, url_rules, configs.log_format,
+                                  profiler=profiler)
+    return analyze_log_parallel(file_path, configs, url_rules, workers, start, end)
+
+
+def make_report(args, file_paths, url_rules, profiler=None):
+    """Analyze log files, export analyzed data and render HTML report as ``args`` specifies"""
+    cache = None
+    if not args.no_cache and file_paths != ['-']:
+        cache = ResultCache(args.cache_dir or get_default_cache_dir(), make_cache_options(
+            args.min_msecs, args.max_urls_per_group, url_rules, args.log_format))
+        if profiler is not None:
+            profiler.wrap(cache, 'lookup', 'cache_lookup')
+            profiler.wrap(cache, 'set', 'cache_save')
+    if len(file_paths) == 1 and cache is None:
+        data = analyze_single_file(file_paths[0], args, url_rules, args.workers, profiler=profiler)
+    else:
+        data = analyze_files(file_paths, args, url_rules, args.workers, cache=cache,
+                             profiler=profiler)
+
+    if args.export:
+        header = make_export_header(args.host or get_host_name(), options={
+            'min_msecs': args.min_msecs, 'max_urls_per_group': args.max_urls_per_group,
+            'log_format': args.log_format or 'default'}, datetime_range=data['datetime_range'])
+        with profile_stage(profiler, 'export'):
+            write_export(args.export, data, header)
+        logger.info('Exported to %s.' % args.export)
+        # Report is only rendered when output is given
+        if args.output is None:
+            return
+
+    with profile_stage(profiler, 'format_data'):
+        data = format_data(data, args.limit_per_url_group, args.limit_url_groups)
     data.update({
         'domain': args.domain,
-        'input_filename': args.filepath.name,
+        'input_filename': ', '.join(file_paths),
         'min_duration': args.min_msecs,
     })
 
     # Pre-process data
-    html_data = render_template('report.html', data)
+    with profile_stage(profiler, 'render_template'):
+        html_data = render_template('report.html', data)
+
+    with profile_stage(profiler, 'write'):
+        output = args.output or sys.stdout
+        output.write(html_data)
+        output.close()
+
+
+def analyze(args):
+    # Get custom url rules
+    url_rules = []
+    if args.url_file:
+        url_rules = parse_url_rules(args.url_file)
+
+    try:
+        file_paths = ['-'] if args.filepath == ['-'] else expand_file_paths(args.filepath)
+        # Check log format before analyzing
+        make_log_parser(args.log_format)
+    except (ValueError, InvalidLogFormat) as e:
+        logger.error(str(e))
+        sys.exit(1)
 
-    args.output.write(html_data)
-    args.output.close()
+    profiler = profile = None
+    if args.profile or args.profile_output:
+        profiler = StageProfiler()
+        if args.workers > 1:
+            logger.warning('Profiling only measures this process, analyzing in one process.')
+            args.workers = 1
+        if args.profile_output:
+            profile = start_cprofile()
+
+    logger.info('Analyzing log file "%s"...' % ', '.join(file_paths))
+    start_time = time.time()
+    try:
+        make_report(args, file_paths, url_rules, profiler)
+    except UnsupportedCompression as e:
+        logger.error(str(e))
+        sys.exit(1)
     logger.info('Finished in %.2f seconds.' % (time.time() - start_time))
 
+    if profiler is not None:
+        logger.info('Profile: %s' % profiler.format_report())
+    if profile is not None:
+        stats = dump_cprofile(profile, args.profile_output)
+        logger.info('Saved cProfile stats to %s, top functions:\n%s' % (args.profile_output, stats))
+
 
 def load_subcommand(subparsers):
     """Load this subcommand
     """
     parser_analyze = subparsers.add_parser('analyze', help='Analyze uwsgi log to get report')
-    parser_analyze.add_argument('-f', '--filepath', type=argparse.FileType('r'), dest='filepath',
-                                help='Path of uwsgi log file', required=True)
-    parser_analyze.add_argument('--output', dest="output", type=argparse.FileType('w'), default=sys.stdout, 
+    parser_analyze.add_argument('-f', '--filepath', dest='filepath', nargs='+',
+                                help='Paths or glob patterns of uwsgi log files, gzip/bz2/xz/zstd '
+                                     'compressed files are also supported', required=True)
+    parser_analyze.add_argument('--output', dest="output", type=argparse.FileType('w'), default=None, 
                                 help='HTML report file path')
     parser_analyze.add_argument('--min-msecs', dest="min_msecs", type=int, default=200,
                                 help='Request serve time lower than this value will not be counted, default: 200')
@@ -64,4 +396,33 @@ def load_subcommand(subparsers):
     parser_analyze.add_argument('--limit-per-url-group', dest="limit_per_url_group", type=int,
                                 required=False, default=LIMIT_PER_URL_GROUP,
                                 help='Number of urls per group considered, default: 20')
+    parser_analyze.add_argument('--max-urls-per-group', dest="max_urls_per_group", type=int,
+                                required=False, default=MAX_URLS_PER_GROUP,
+                                help='Number of urls per group tracked, only urls with largest total '
+                                     'durations are kept, 0 means no limit, default: 1000')
+    parser_analyze.add_argument('--log-format', dest="log_format", type=str, required=False,
+                                help='Format of log: "default" for default uwsgi log format, "json" '
+                                     'for JSON lines, or a uwsgi logformat string like '
+                                     '"[%%(ltime)] %%(method) %%(uri) %%(status) %%(msecs)ms", '
+                                     'default: "default"')
+    parser_analyze.add_argument('--workers', dest="workers", type=int, required=False, default=1,
+                                help='Number of processes for analyzing log file, default: 1')
+    parser_analyze.add_argument('--cache-dir', dest="cache_dir", type=str, required=False,
+                                help='Directory for caching analyzed results of log files, a file '
+                                     'will not be analyzed again until it was modified, only '
+                                     'appended lines are analyzed if it was appended, '
+                                     'default: ~/.cache/uwsgi-sloth')
+    parser_analyze.add_argument('--no-cache', dest="no_cache", action='store_true',
+                                help='Do not use cached results and do not cache results')
+    parser_analyze.add_argument('--export', dest="export", type=str, required=False,
+                                help='Export analyzed data to this file for "uwsgi-sloth merge", '
+                                     'HTML report is not rendered unless --output is given')
+    parser_analyze.add_argument('--host', dest="host", type=str, required=False,
+                                help='Host name in export, default: hostname of this machine')
+    parser_analyze.add_argument('--profile', dest="profile", action='store_true',
+                                help='Log counters and time of analyzing stages, files are '
+                                     'analyzed in one process')
+    parser_analyze.add_argument('--profile-output', dest="profile_output", type=str, required=False,
+                                help='Also run with cProfile and save stats to this file for '
+                                     '"python -m pstats", implies --profile')
     parser_analyze.set_defaults(func=analyze)
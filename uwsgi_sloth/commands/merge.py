@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Merge exports of many hosts into one report"""
+import sys
+import time
+import argparse
+import datetime
+
+from uwsgi_sloth.analyzer import format_data
+from uwsgi_sloth.template import render_template
+from uwsgi_sloth.models import merge_requests_data_to, union_datetime_range
+from uwsgi_sloth.export import read_export, InvalidExport
+from uwsgi_sloth.commands.analyze import expand_file_paths
+from uwsgi_sloth.settings import LIMIT_URL_GROUPS, LIMIT_PER_URL_GROUP, LIMIT_HOSTS_PER_URL_GROUP
+
+import logging
+logger = logging.getLogger('uwsgi_sloth.merge')
+
+
+class HostsBreakdown(object):
+    """Requests of every host, in total and by url group. Only counters are kept, so memory
+    is bounded by number of hosts * number of url groups."""
+
+    def __init__(self):
+        self.hosts = {}
+        # {url_group: {host: [count, total, max]}}
+        self.url_groups = {}
+
+    def add(self, host, data):
+        counters = self.hosts.get(host)
+        if counters is None:
+            counters = self.hosts[host] = {'requests_counter': {'normal': 0, 'slow': 0},
+                                           'total_slow_duration': 0}
+        counters['requests_counter']['normal'] += data['requests_counter']['normal']
+        counters['requests_counter']['slow'] += data['requests_counter']['slow']
+        counters['total_slow_duration'] += data['total_slow_duration']
+
+        for url_group, group_data in data['data_details'].items():
+            agr = group_data['duration_agr_data']
+            group_hosts = self.url_groups.setdefault(url_group, {})
+            values = group_hosts.get(host)
+            if values is None:
+                group_hosts[host] = [agr.count, agr.total, agr.max]
+            else:
+                values[0] += agr.count
+                values[1] += agr.total
+                values[2] = max(values[2], agr.max)
+
+    def get_hosts(self):
+        """Hosts sorted by total duration of slow requests"""
+        hosts = []
+        for host, counters in self.hosts.items():
+            normal = counters['requests_counter']['normal']
+            slow_rate = format(counters['requests_counter']['slow'] / float(normal), '.2%') \
+                if normal else '-'
+            hosts.append(dict(counters, host=host, slow_rate=slow_rate))
+        return sorted(hosts, key=lambda host: host['total_slow_duration'], reverse=True)
+
+    def get_url_group_hosts(self, url_group, limit=LIMIT_HOSTS_PER_URL_GROUP):
+        """Hosts of url group with largest total durations"""
+        hosts = sorted(self.url_groups.get(url_group, {}).items(), key=lambda item: item[1][1],
+                       reverse=True)[:limit]
+        return [{'host': host, 'count': count, 'total': total, 'max': max_value,
+                 'avg': total / float(count) if count else 0}
+                for host, (count, total, max_value) in hosts]
+
+
+def merge_exports(file_paths):
+    """Merge export files one by one, only one export is loaded at a time.
+
+    :returns: (merged data, ``HostsBreakdown``, options of exports)
+    """
+    data = None
+    breakdown = HostsBreakdown()
+    datetime_range = [None, None]
+    options = None
+    for file_path in file_paths:
+        try:
+            header, export_data = read_export(file_path)
+        except (OSError, InvalidExport) as e:
+            logger.warning('Skip export "%s": %s' % (file_path, e))
+            continue
+        if options is None:
+            options = header['options']
+        elif header['options'] != options:
+            logger.warning('Options of export "%s" are different: %s' % (file_path, header['options']))
+        if not export_data:
+            continue
+
+        breakdown.add(header['host'], export_data)
+        if header['datetime_range']:
+            union_datetime_range(datetime_range, [
+                datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S') if value else None
+                for value in header['datetime_range']])
+        if data is None:
+            data = export_data
+        else:
+            merge_requests_data_to(data, export_data)
+        logger.info('Merged export of host "%s": %s' % (header['host'], file_path))
+
+    if data is not None:
+        data['datetime_range'] = datetime_range
+    return data, breakdown, options or {}
+
+
+def merge(args):
+    try:
+        file_paths = expand_file_paths(args.filepath)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    start_time = time.time()
+    data, breakdown, options = merge_exports(file_paths)
+    if data is None:
+        logger.error('No data found in exports.')
+        sys.exit(1)
+
+    datetime_range = data.pop('datetime_range')
+    data = format_data(data, args.limit_per_url_group, args.limit_url_groups)
+    data['data_details'] = [(url_group, dict(d, hosts=breakdown.get_url_group_hosts(url_group)))
+                            for url_group, d in data['data_details']]
+    if datetime_range[0]:
+        datetime_range = '%s - %s' % tuple(value.strftime('%Y-%m-%d %H:%M') for value in datetime_range)
+    else:
+        datetime_range = '-'
+    data.update({
+        'domain': args.domain,
+        'input_filename': ', '.join(file_paths),
+        'min_duration': options.get('min_msecs'),
+        'datetime_range': datetime_range,
+        'hosts': breakdown.get_hosts(),
+    })
+    args.output.write(render_template('realtime.html', data))
+    args.output.close()
+    logger.info('Merged %s exports of %s hosts in %.2f seconds.' % (
+        len(file_paths), len(breakdown.hosts), time.time() - start_time))
+
+
+def load_subcommand(subparsers):
+    """Load this subcommand"""
+    parser_merge = subparsers.add_parser('merge', help='Merge exports of many hosts into one report')
+    parser_merge.add_argument('-f', '--filepath', dest='filepath', nargs='+', required=True,
+                              help='Paths or glob patterns of export files, made by "uwsgi-sloth '
+                                   'analyze --export" or "export_dir" of "uwsgi-sloth start"')
+    parser_merge.add_argument('--output', dest="output", type=argparse.FileType('w'),
+                              default=sys.stdout, help='HTML report file path')
+    parser_merge.add_argument('--domain', dest="domain", type=str, required=False,
+                              help='Make url in report become a hyper-link by settings a domain')
+    parser_merge.add_argument('--limit-url-groups', dest="limit_url_groups", type=int,
+                              required=False, default=LIMIT_URL_GROUPS,
+                              help='Number of url groups considered, default: 200')
+    parser_merge.add_argument('--limit-per-url-group', dest="limit_per_url_group", type=int,
+                              required=False, default=LIMIT_PER_URL_GROUP,
+                              help='Number of urls per group considered, default: 20')
+    parser_merge.set_defaults(func=merge)
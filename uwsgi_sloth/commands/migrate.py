@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Convert pickled data files of older versions to the storage format"""
+import os
+import argparse
+
+from configobj import ConfigObj
+
+from uwsgi_sloth.models import SavePoint, RequestsData, LEGACY_EXTENSION
+
+import logging
+logger = logging.getLogger('uwsgi_sloth.migrate')
+
+
+def list_legacy_dates(db_dir):
+    """Dates which have pickled base files or segments"""
+    dates = set()
+    for name in os.listdir(db_dir):
+        path = os.path.join(db_dir, name)
+        if name.endswith(LEGACY_EXTENSION) and name != 'savepoint' + LEGACY_EXTENSION:
+            dates.add(name[:-len(LEGACY_EXTENSION)])
+        elif name.endswith('.segments') and os.path.isdir(path) and any(
+                segment.endswith(LEGACY_EXTENSION) for segment in os.listdir(path)):
+            dates.add(name[:-len('.segments')])
+    return sorted(dates)
+
+
+def migrate_db_dir(db_dir):
+    """Convert pickled files in ``db_dir``, segments of every day are merged into base file,
+    cached rollups are removed and they will be made again when needed.
+
+    :returns: number of converted days
+    """
+    save_point = SavePoint(db_dir)
+    if os.path.exists(save_point.legacy_file_path):
+        save_point.save()
+
+    dates = list_legacy_dates(db_dir)
+    for date in dates:
+        RequestsData(date, db_dir).save()
+        logger.info('Converted data of %s.' % date)
+
+    rollups_dir = os.path.join(db_dir, 'rollups')
+    if os.path.isdir(rollups_dir):
+        for name in os.listdir(rollups_dir):
+            if name.endswith(LEGACY_EXTENSION):
+                os.unlink(os.path.join(rollups_dir, name))
+    return len(dates)
+
+
+def migrate(args):
+    config = ConfigObj(infile=args.config.name)
+    db_dir = os.path.join(config['data_dir'], 'data')
+    converted = migrate_db_dir(db_dir)
+    logger.info('Converted data of %s days in %s.' % (converted, db_dir))
+
+
+def load_subcommand(subparsers):
+    """Load this subcommand"""
+    parser_migrate = subparsers.add_parser(
+        'migrate', help='Convert pickled data stored by older versions to the storage format, '
+                        'stop "uwsgi-sloth start" before migrating.')
+    parser_migrate.add_argument('-c', '--config', type=argparse.FileType('r'), dest='config',
+                                help='uwsgi-sloth config file', required=True)
+    parser_migrate.set_defaults(func=migrate)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Make a report of many days from stored data of realtime analyzing"""
+import os
+import sys
+import time
+import argparse
+import datetime
+import multiprocessing
+
+from configobj import ConfigObj
+
+from uwsgi_sloth.analyzer import format_data
+from uwsgi_sloth.template import render_template
+from uwsgi_sloth.models import RequestsData, RollupData, merge_requests_data_to
+from uwsgi_sloth.settings import LIMIT_URL_GROUPS, LIMIT_PER_URL_GROUP, DEFAULT_MIN_MSECS
+
+import logging
+logger = logging.getLogger('uwsgi_sloth.rollup')
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid date: "%s", format: YYYY-MM-DD' % value)
+
+
+def iter_dates(first_date, last_date):
+    date = first_date
+    while date <= last_date:
+        yield date
+        date += datetime.timedelta(days=1)
+
+
+def split_periods(first_date, last_date):
+    """Split dates into periods: whole months, whole weeks(Monday to Sunday) and single days.
+
+    :returns: list of (name, first date, last date), name is None for single days
+    """
+    periods = []
+    date = first_date
+    while date <= last_date:
+        next_month = (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        week_end = date + datetime.timedelta(days=6)
+        if date.day == 1 and next_month - datetime.timedelta(days=1) <= last_date:
+            periods.append(('month_%s' % date.strftime('%Y-%m'), date,
+                            next_month - datetime.timedelta(days=1)))
+        elif date.weekday() == 0 and week_end <= last_date:
+            periods.append(('week_%s-W%02d' % date.isocalendar()[:2], date, week_end))
+        else:
+            periods.append((None, date, date))
+        date = periods[-1][2] + datetime.timedelta(days=1)
+    return periods
+
+
+def merge_tree(datas):
+    """Merge requests data pairwise like a tree, datas will be modified, empty data are
+    skipped. Returns None if all data are empty."""
+    datas = [data for data in datas if data]
+    while len(datas) > 1:
+        merged = []
+        for i in range(0, len(datas), 2):
+            if i + 1 < len(datas):
+                merge_requests_data_to(datas[i], datas[i + 1])
+            merged.append(datas[i])
+        datas = merged
+    return datas[0] if datas else None
+
+
+def load_period(period, db_dir, use_cache=True):
+    """Load merged data of a period, merged data of weeks and months which have ended are
+    cached and reused until data of any day changed."""
+    name, first_date, last_date = period
+    days = [RequestsData(date.isoformat(), db_dir) for date in iter_dates(first_date, last_date)]
+    if name is None:
+        return days[0].data
+
+    use_cache = use_cache and last_date < datetime.date.today()
+    if use_cache:
+        rollup = RollupData(name, db_dir)
+        signature = tuple((day.date, day.get_signature()) for day in days)
+        data = rollup.load(signature)
+        if data is not None:
+            logger.info('Use cached rollup %s.' % name)
+            return data
+
+    data = merge_tree([day.data for day in days]) or {}
+    if use_cache:
+        rollup.save(signature, data)
+    return data
+
+
+def load_periods(task):
+    """Load and merge data of periods in order"""
+    periods, db_dir, use_cache = task
+    return merge_tree([load_period(period, db_dir, use_cache) for period in periods])
+
+
+def rollup_periods(periods, db_dir, workers=1, use_cache=True):
+    """Merge data of periods, periods are splitted into ``workers`` parts by number of days,
+    every part is merged in a process, then results are merged as a tree."""
+    if workers <= 1 or len(periods) <= 1:
+        return load_periods((periods, db_dir, use_cache))
+
+    total_days = sum((last_date - first_date).days + 1 for _, first_date, last_date in periods)
+    tasks, part, part_days = [], [], 0
+    for period in periods:
+        part.append(period)
+        part_days += (period[2] - period[1]).days + 1
+        if part_days * workers >= total_days * (len(tasks) + 1):
+            tasks.append((part, db_dir, use_cache))
+            part = []
+    if part:
+        tasks.append((part, db_dir, use_cache))
+
+    pool = multiprocessing.Pool(min(workers, len(tasks)))
+    try:
+        return merge_tree(list(pool.imap(load_periods, tasks)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def rollup(args):
+    config = ConfigObj(infile=args.config.name)
+    data_dir = config['data_dir']
+    db_dir = os.path.join(data_dir, 'data')
+    min_msecs = int(config.get('min_msecs', DEFAULT_MIN_MSECS))
+
+    last_date = args.to_date or datetime.date.today()
+    first_date = args.from_date or last_date - datetime.timedelta(days=args.days - 1)
+    if first_date > last_date:
+        logger.error('Start date %s is after end date %s.' % (first_date, last_date))
+        sys.exit(1)
+
+    start_time = time.time()
+    periods = split_periods(first_date, last_date)
+    logger.info('Merging data from %s to %s in %s periods...' % (first_date, last_date, len(periods)))
+    data = rollup_periods(periods, db_dir, args.workers, use_cache=not args.no_cache)
+    if data is None:
+        logger.error('No data found from %s to %s.' % (first_date, last_date))
+        sys.exit(1)
+
+    data = format_data(data, args.limit_per_url_group, args.limit_url_groups)
+    data.update({
+        'domain': config.get('domain'),
+        'input_filename': config.get('uwsgi_log_path'),
+        'min_duration': min_msecs,
+        'datetime_range': '%s - %s' % (first_date, last_date),
+    })
+    output = args.output or os.path.join(data_dir, 'html', 'rollup_%s_%s.html' % (first_date, last_date))
+    with open(output, 'w') as fp:
+        fp.write(render_template('realtime.html', data))
+    logger.info('Report rendered to %s in %.2f seconds.' % (output, time.time() - start_time))
+
+
+def load_subcommand(subparsers):
+    """Load this subcommand"""
+    parser_rollup = subparsers.add_parser(
+        'rollup', help='Make a report of many days from data stored by "uwsgi-sloth start".')
+    parser_rollup.add_argument('-c', '--config', type=argparse.FileType('r'), dest='config',
+                               help='uwsgi-sloth config file', required=True)
+    parser_rollup.add_argument('--days', dest='days', type=int, default=7,
+                               help='Number of days to the end date, default: 7')
+    parser_rollup.add_argument('--from', dest='from_date', type=parse_date, required=False,
+                               help='Start date like 2014-06-01, overrides --days')
+    parser_rollup.add_argument('--to', dest='to_date', type=parse_date, required=False,
+                               help='End date like 2014-06-30, default: today')
+    parser_rollup.add_argument('--output', dest='output', type=str, required=False,
+                               help='HTML report file path, default: '
+                                    '<data_dir>/html/rollup_<from>_<to>.html')
+    parser_rollup.add_argument('--limit-url-groups', dest="limit_url_groups", type=int,
+                               required=False, default=LIMIT_URL_GROUPS,
+                               help='Number of url groups considered, default: 200')
+    parser_rollup.add_argument('--limit-per-url-group', dest="limit_per_url_group", type=int,
+                               required=False, default=LIMIT_PER_URL_GROUP,
+                               help='Number of urls per group considered, default: 20')
+    parser_rollup.add_argument('--workers', dest="workers", type=int, required=False, default=1,
+                               help='Number of processes for merging data, default: 1')
+    parser_rollup.add_argument('--no-cache', dest="no_cache", action='store_true',
+                               help='Do not use cached rollups of weeks and months and do not '
+                                    'cache them')
+    parser_rollup.set_defaults(func=rollup)
@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
 """Start uwsgi-sloth workers"""
 import os
+import re
+import copy
+import sys
+import queue
 import signal
 import argparse
 import datetime
+import threading
 from configobj import ConfigObj
 
-from uwsgi_sloth.analyzer import format_data, RealtimeLogAnalyzer, URLClassifier
+from uwsgi_sloth.analyzer import format_data, RealtimeLogAnalyzer, URLClassifier, new_requests_data
 from uwsgi_sloth.tailer import Tailer, no_new_line
 from uwsgi_sloth.template import render_template
 from uwsgi_sloth.utils import makedir_if_none_exists, total_seconds, parse_url_rules
-from uwsgi_sloth.models import merge_requests_data_to, RequestsData, SavePoint
-from uwsgi_sloth.settings import REALTIME_UPDATE_INTERVAL, DEFAULT_MIN_MSECS
+from uwsgi_sloth.models import RequestsData, SavePoint, merge_requests_data_to
+from uwsgi_sloth.server import ReportServer
+from uwsgi_sloth.metrics import RequestMetrics
+from uwsgi_sloth.parsers import make_log_parser, InvalidLogFormat
+from uwsgi_sloth.export import write_export, make_export_header, get_host_name
+from uwsgi_sloth.profiling import StageProfiler, profile_stage, start_cprofile, dump_cprofile
+from uwsgi_sloth.settings import REALTIME_UPDATE_INTERVAL, DEFAULT_MIN_MSECS, SEEK_DATETIME_SLACK, \
+                                MAX_URLS_PER_GROUP, MAX_SEGMENTS_PER_DAY, REALTIME_WINDOWS, \
+                                WRITER_RETRY_SECONDS
 
 import logging
 logger = logging.getLogger('uwsgi_sloth')
@@ -22,16 +34,308 @@ class HTMLRender(object):
     def __init__(self, html_dir, domain=None):
         self.html_dir = html_dir
         self.domain = domain
+        self.rendered_revisions = {}
+        self.format_caches = {}
 
-    def render_requests_data_to_html(self, data, file_name, context={}):
-        """Render to HTML file"""
+    def render_requests_data_to_html(self, data, file_name, context={}, revision=None):
+        """Render to HTML file
+
+        :param revision: revision of data, rendering will be skipped if the file was rendered
+                         with the same revision.
+        """
         file_path = os.path.join(self.html_dir, file_name)
+        if revision is not None and self.rendered_revisions.get(file_name) == revision and \
+                os.path.exists(file_path):
+            logger.info('Skip rendering HTML file %s, data not changed.' % file_path)
+            return
+
         logger.info('Rendering HTML file %s...' % file_path)
-        data = format_data(data)
+        data = format_data(data, cache=self.format_caches.setdefault(file_name, {}))
         data.update(context)
         data.update(domain=self.domain)
         with open(file_path, 'w') as fp:
             fp.write(render_template('realtime.html', data))
+        self.rendered_revisions[file_name] = revision
+
+    def forget(self, file_name):
+        """Forget caches of file which will not be rendered anymore"""
+        self.rendered_revisions.pop(file_name, None)
+        self.format_caches.pop(file_name, None)
+
+
+class RealtimeReportSource(object):
+    """Source of reports for the built-in HTTP server, reports are made from in-memory data.
+
+    Analyzer and ``pending_days`` must be modified with ``lock`` held, it is also held by
+    analyzing every line, so it is only held for a moment when getting reports. Stored data:
+    ``days_requests_data`` and data of ``pending_days`` must be modified with ``store_lock``
+    held. When both are needed, ``store_lock`` is acquired first.
+
+    ``pending_days`` are data of days taken by snapshots but not merged to
+    ``days_requests_data`` yet.
+    """
+    RE_LATEST = re.compile(r'^latest_(\d+)mins$')
+    RE_DAY = re.compile(r'^day_(\d{4}-\d{2}-\d{2})$')
+
+    def __init__(self, analyzer, days_requests_data):
+        self.analyzer = analyzer
+        self.days_requests_data = days_requests_data
+        self.pending_days = []
+        self.lock = threading.Lock()
+        self.store_lock = threading.Lock()
+
+    def get_window_seconds(self, name):
+        """Seconds of window report "latest_<N>mins", None if not a valid window report"""
+        matched = self.RE_LATEST.match(name)
+        if not matched:
+            return None
+        seconds = int(matched.group(1)) * 60
+        analyzer = self.analyzer
+        if not 0 < seconds <= analyzer.window_slots * analyzer.slot_seconds:
+            return None
+        return seconds
+
+    def get_date(self, name):
+        analyzer = self.analyzer
+        if name == 'today':
+            return analyzer.today_name
+        elif name == 'yesterday':
+            return analyzer.yesterday_name
+        matched = self.RE_DAY.match(name)
+        return matched.group(1) if matched else None
+
+    def get_day_state(self, date, copy_live=False):
+        """Get data of day, must be called with ``store_lock`` held, ``lock`` is only held for
+        getting data being analyzed.
+
+        :param copy_live: copy data being analyzed, it is modified in place by analyzing
+        :returns: (stored data, pending data, data being analyzed, requests being analyzed)
+        """
+        requests_data = self.days_requests_data.get(date)
+        with self.lock:
+            pending = [days_data[date] for days_data in self.pending_days if date in days_data]
+            live = self.analyzer.data.get(date)
+            live_requests = live['requests_counter']['normal'] if live is not None else None
+            if copy_live:
+                live = copy.deepcopy(live)
+        return requests_data, pending, live, live_requests
+
+    def get_report_version(self, name):
+        """Version of report, it changes whenever data of report changed. Getting version is
+        cheap, so cached report can be checked before making it.
+
+        :returns: None if report not found
+        """
+        if self.get_window_seconds(name) is not None:
+            # Window data also changes when time passes
+            return (self.analyzer.revision,
+                    datetime.datetime.now().replace(second=0, microsecond=0))
+
+        date = self.get_date(name)
+        with self.store_lock:
+            requests_data, pending, live, live_requests = self.get_day_state(date)
+        if requests_data is None and not pending and live is None:
+            return None
+        return (id(requests_data), requests_data and requests_data.revision,
+                tuple(id(day_data) for day_data in pending), live_requests)
+
+    def get_report(self, name):
+        """Get report of given name: "latest_<N>mins", "today", "yesterday" or "day_<date>",
+        analyzing is only blocked for copying data being analyzed, data returned will not be
+        modified later.
+
+        :returns: (data, version, context), None if not found
+        """
+        analyzer = self.analyzer
+        seconds = self.get_window_seconds(name)
+        if seconds is not None:
+            now = datetime.datetime.now()
+            with self.lock:
+                version = (analyzer.revision, now.replace(second=0, microsecond=0))
+                slots = analyzer.share_slots()
+            return (analyzer.get_window_data(seconds, now, slots=slots), version,
+                    {'datetime_range': 'Last %s minutes' % (seconds // 60)})
+
+        date = self.get_date(name)
+        data = new_requests_data()
+        with self.store_lock:
+            # Data being analyzed is not more than data of one interval, copying it is cheap
+            requests_data, pending, live, live_requests = self.get_day_state(date, copy_live=True)
+            if requests_data is None and not pending and live is None:
+                return None
+            # Stored data is only replaced but not modified by merging, merged data will not
+            # be modified after ``store_lock`` released.
+            if requests_data is not None:
+                merge_requests_data_to(data, requests_data.data)
+            for day_data in pending:
+                merge_requests_data_to(data, day_data)
+        if live is not None:
+            merge_requests_data_to(data, live)
+        version = (id(requests_data), requests_data and requests_data.revision,
+                   tuple(id(day_data) for day_data in pending), live_requests)
+        return data, version, {'datetime_range': date}
+
+
+class ReportWriter(threading.Thread):
+    """Persist data and render HTML files in a background thread, so analyzing never waits for
+    disk I/O or rendering. Snapshots taken by ``RealtimeLogAnalyzer.take_snapshot()`` are
+    handed over by ``put()``, they are written in order.
+
+    Writing a snapshot is retried until written, steps of writing can be done again, and data
+    of a day is removed from the snapshot once it was written and merged, so a failed write
+    continues where it stopped and data is never written twice.
+
+    :param export_dir: if given, data of changed days are exported to "<date>.export" files
+                       in this directory for "uwsgi-sloth merge"
+    :param export_options: (host, options) in headers of exports
+    :param profiler: a ``StageProfiler`` for measuring stages of writing, its report is logged
+                     after every snapshot written
+    """
+
+    def __init__(self, source, html_render, save_point, db_dir, html_dir, export_dir=None,
+                 export_options=None, profiler=None):
+        threading.Thread.__init__(self, name='uwsgi-sloth-writer')
+        self.source = source
+        self.html_render = html_render
+        self.save_point = save_point
+        self.db_dir = db_dir
+        self.html_dir = html_dir
+        self.export_dir = export_dir
+        self.export_options = export_options
+        self.snapshots = queue.Queue()
+        self.stopping = threading.Event()
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.wrap(html_render, 'render_requests_data_to_html', 'render')
+
+    def put(self, snapshot):
+        self.snapshots.put(snapshot)
+
+    def stop(self):
+        """Stop after all snapshots written, a failed snapshot is only retried once more"""
+        self.stopping.set()
+        self.snapshots.put(None)
+
+    def run(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            self.write_until_done(snapshot)
+            if self.profiler is not None:
+                logger.info('Writer profile: %s' % self.profiler.format_report())
+                self.profiler.reset()
+
+    def write_until_done(self, snapshot):
+        attempts = 0
+        while True:
+            try:
+                self.write(snapshot)
+                return
+            except Exception:
+                attempts += 1
+                logger.exception('Unable to write snapshot taken at %s, attempts: %s' % (
+                    snapshot['now'], attempts))
+            if self.stopping.is_set() and attempts > 1:
+                logger.error('Give up writing snapshot taken at %s.' % snapshot['now'])
+                return
+            self.stopping.wait(WRITER_RETRY_SECONDS)
+
+    def write(self, snapshot):
+        now = snapshot['now']
+        profiler = self.profiler
+        analyzer = self.source.analyzer
+        days_requests_data = self.source.days_requests_data
+        html_render = self.html_render
+        logger.info('Writing snapshot taken at %s, %s snapshots waiting.' % (
+            now, self.snapshots.qsize()))
+
+        # Render HTML files of latest requests
+        for minutes in REALTIME_WINDOWS:
+            html_render.render_requests_data_to_html(
+                analyzer.get_window_data(minutes * 60, now, slots=snapshot['slots']),
+                'latest_%smins.html' % minutes, context={'datetime_range': 'Last %s minutes' % minutes})
+
+        days_data = snapshot['days_data']
+        changed_dates = snapshot.setdefault('changed_dates', list(days_data.keys()))
+        # Dates whose data was written to segments but not merged yet
+        written_dates = snapshot.setdefault('written_dates', set())
+        for date, data in list(days_data.items()):
+            day_requests_data = days_requests_data.get(date)
+            if day_requests_data is None:
+                day_requests_data = RequestsData(date, self.db_dir)
+                # Load data before holding the lock
+                day_requests_data.data
+                with self.source.store_lock:
+                    days_requests_data[date] = day_requests_data
+            # Only new data is written to disk
+            if date not in written_dates:
+                with profile_stage(profiler, 'write_segment'):
+                    day_requests_data.write_segment(data)
+                written_dates.add(date)
+            with self.source.store_lock:
+                day_requests_data.merge(data)
+                del days_data[date]
+        with self.source.store_lock, self.source.lock:
+            self.source.pending_days = [d for d in self.source.pending_days if d is not days_data]
+
+        if self.export_dir:
+            for date in changed_dates:
+                file_path = os.path.join(self.export_dir, '%s.export' % date)
+                with profile_stage(profiler, 'export'):
+                    write_export(file_path, days_requests_data[date].data,
+                                 make_export_header(*self.export_options))
+                logger.info('Exported data of %s to %s.' % (date, file_path))
+
+        for date, day_requests_data in list(days_requests_data.items()):
+            # Render to HTML file
+            html_render.render_requests_data_to_html(day_requests_data.data,
+                'day_%s.html' % date, context={'datetime_range': date},
+                revision=day_requests_data.revision)
+            if len(day_requests_data.segments) >= MAX_SEGMENTS_PER_DAY:
+                with profile_stage(profiler, 'save'):
+                    day_requests_data.save()
+
+        # Release data of days which will not be updated anymore
+        for date in list(days_requests_data.keys()):
+            if date not in snapshot['result_date_names']:
+                with profile_stage(profiler, 'save'):
+                    days_requests_data[date].save()
+                with self.source.store_lock:
+                    days_requests_data.pop(date)
+                html_render.forget('day_%s.html' % date)
+
+        update_html_symlink(self.html_dir)
+        if snapshot['last_analyzed_datetime']:
+            self.save_point.set_last_datetime(snapshot['last_analyzed_datetime'])
+            self.save_point.set_file_position(*snapshot['file_position'])
+            with profile_stage(profiler, 'savepoint'):
+                self.save_point.save()
+
+
+def load_days_requests_data(date_names, db_dir):
+    """Load stored data of days which are still being analyzed, so their reports include data
+    stored before restarting. Days without stored data are skipped."""
+    days_requests_data = {}
+    for date in date_names:
+        requests_data = RequestsData(date, db_dir)
+        if requests_data.data:
+            days_requests_data[date] = requests_data
+    return days_requests_data
+
+
+def start_server(config, source, html_dir, metrics=None):
+    """Start the built-in HTTP server in a thread if "server_port" configured"""
+    if not config.get('server_port'):
+        return None
+    host = config.get('server_host', '127.0.0.1')
+    server = ReportServer((host, int(config['server_port'])), source, html_dir=html_dir,
+                          domain=config.get('domain'), metrics=metrics)
+    thread = threading.Thread(target=server.serve_forever, name='uwsgi-sloth-server')
+    thread.daemon = True
+    thread.start()
+    logger.info('HTTP server started at http://%s:%s/' % server.server_address[:2])
+    return server
 
 
 def update_html_symlink(html_dir):
@@ -50,13 +354,37 @@ def update_html_symlink(html_dir):
         os.symlink(from_date_file_path, symlink_path)
 
 
+def seek_to_savepoint(file_tailer, save_point, last_log_datetime, log_parser):
+    """Seek log file to the position of last savepoint, so we don't have to parse those
+    lines which were already analyzed."""
+    file_stat = os.fstat(file_tailer.file.fileno())
+    position = save_point.get_file_position()
+    if position and position['ino'] == file_stat.st_ino and position['dev'] == file_stat.st_dev \
+            and position['offset'] <= file_stat.st_size:
+        logger.info('Seek log file to last savepoint offset: %s' % position['offset'])
+        file_tailer.seek(position['offset'])
+        return
+
+    # Log file may have been rotated, search by datetime instead
+    offset = file_tailer.seek_datetime(
+        last_log_datetime - datetime.timedelta(seconds=SEEK_DATETIME_SLACK),
+        log_parser.parse_line_datetime)
+    logger.info('Seek log file to offset by datetime: %s' % offset)
+
+
 def start(args):
     # Load config file
     config = ConfigObj(infile=args.config.name)
     data_dir = config['data_dir']
     uwsgi_log_path = config['uwsgi_log_path']
     min_msecs = int(config.get('min_msecs', DEFAULT_MIN_MSECS))
+    max_urls_per_group = int(config.get('max_urls_per_group', MAX_URLS_PER_GROUP))
     url_file = config.get('url_file')
+    try:
+        log_parser = make_log_parser(config.get('log_format'))
+    except InvalidLogFormat as e:
+        logger.error(str(e))
+        sys.exit(1)
 
     # Load custom url rules
     url_rules = []
@@ -76,10 +404,45 @@ def start(args):
 
     last_update_datetime = None
     url_classifier = URLClassifier(user_defined_rules=url_rules)
+    # Metrics are only served by the built-in HTTP server
+    metrics = RequestMetrics() if config.get('server_port') else None
     analyzer = RealtimeLogAnalyzer(url_classifier=url_classifier, min_msecs=min_msecs,
-                                   start_from_datetime=last_log_datetime)
+                                   start_from_datetime=last_log_datetime,
+                                   max_urls_per_group=max_urls_per_group, metrics=metrics,
+                                   log_parser=log_parser)
+    days_requests_data = load_days_requests_data(analyzer.get_result_date_names(), db_dir)
+    profiler = profile = None
+    if args.profile or args.profile_output:
+        profiler = StageProfiler()
+        profiler.instrument_analyzer(analyzer)
+        if args.profile_output:
+            profile = start_cprofile()
     file_tailer = Tailer(uwsgi_log_path)
+    seek_to_savepoint(file_tailer, save_point, last_log_datetime, log_parser)
     html_render = HTMLRender(html_dir, domain=config.get('domain'))
+    report_source = RealtimeReportSource(analyzer, days_requests_data)
+    export_dir = config.get('export_dir')
+    export_options = None
+    if export_dir:
+        makedir_if_none_exists(export_dir)
+        export_options = (config.get('host_name') or get_host_name(), {
+            'min_msecs': min_msecs, 'max_urls_per_group': max_urls_per_group,
+            'log_format': config.get('log_format') or 'default'})
+    writer = ReportWriter(report_source, html_render, save_point, db_dir, html_dir,
+                          export_dir=export_dir, export_options=export_options,
+                          profiler=StageProfiler() if profiler is not None else None)
+    writer.start()
+
+    def get_ingest_lag():
+        """Seconds analyzing is behind the log, 0 if reached end of file"""
+        last_analyzed_datetime = analyzer.last_analyzed_datetime
+        if getattr(file_tailer, 'trailing', False) or last_analyzed_datetime is None:
+            return 0
+        return max(total_seconds(datetime.datetime.now() - last_analyzed_datetime), 0)
+
+    if metrics is not None:
+        metrics.get_ingest_lag = get_ingest_lag
+    server = start_server(config, report_source, html_dir, metrics=metrics)
 
     # Listen INT/TERM signal
     def gracefully_exit(*args):
@@ -87,43 +450,58 @@ def start(args):
         file_tailer.stop_follow()
     signal.signal(signal.SIGINT, gracefully_exit) 
 
-    for line in file_tailer:
-        # Analyze line
-        if line != no_new_line:
-            analyzer.analyze_line(line)
-
-        now = datetime.datetime.now()
-        if not file_tailer.trailing:
-            continue
-        if last_update_datetime and \
-                total_seconds(now - last_update_datetime) < REALTIME_UPDATE_INTERVAL:
-            continue
-
-        # Render HTML file when:
-        # - file_tailer reaches end of file.
-        # - last_update_datetime if over one `interval` from now
-
-        # Render latest interval HTML file
-        html_render.render_requests_data_to_html(analyzer.get_data('last_interval'),
-             'latest_5mins.html', context={'datetime_range': 'Last 5 minutes'})
-        analyzer.clean_data_by_key('last_interval')
-
-        for date in list(analyzer.data.keys()):
-            day_requests_data = RequestsData(date, db_dir)
-            merge_requests_data_to(day_requests_data.data, analyzer.get_data(date))
-            # Render to HTML file
-            html_render.render_requests_data_to_html(day_requests_data.data,
-                'day_%s.html' % date, context={'datetime_range': date})
-            # Save data to pickle file
-            day_requests_data.save()
-            # Reset Everything
-            analyzer.clean_data_by_key(date)
+    lines = file_tailer
+    if profiler is not None:
+        # Waiting for new lines is not reading
+        lines = profiler.iter_timed(file_tailer, 'read', idle_item=no_new_line)
+    try:
+        for line in lines:
+            # Analyze line
+            if line != no_new_line:
+                with report_source.lock:
+                    analyzer.analyze_line(line)
+
+            if not file_tailer.trailing:
+                continue
+            now = datetime.datetime.now()
+            if last_update_datetime and \
+                    total_seconds(now - last_update_datetime) < REALTIME_UPDATE_INTERVAL:
+                continue
 
-        update_html_symlink(html_dir)
-        last_update_datetime = now
-        if analyzer.last_analyzed_datetime:
-            save_point.set_last_datetime(analyzer.last_analyzed_datetime)
-            save_point.save()
+            # Take a snapshot for the writer when:
+            # - file_tailer reaches end of file.
+            # - last_update_datetime if over one `interval` from now
+            analyzer.tick(now)
+            with report_source.lock, profile_stage(profiler, 'snapshot'):
+                days_data, slots = analyzer.take_snapshot()
+                report_source.pending_days.append(days_data)
+            writer.put({
+                'now': now,
+                'days_data': days_data,
+                'slots': slots,
+                'result_date_names': analyzer.get_result_date_names(),
+                'last_analyzed_datetime': analyzer.last_analyzed_datetime,
+                'file_position': (file_tailer.tell(), os.fstat(file_tailer.file.fileno())),
+            })
+            logger.info(url_classifier.get_cache_stats())
+            if profiler is not None:
+                logger.info('Profile: %s; ingest lag %.1fs, %s snapshots waiting for writer' % (
+                    profiler.format_report(), get_ingest_lag(), writer.snapshots.qsize()))
+                profiler.reset()
+            last_update_datetime = now
+    finally:
+        # Writer is not a daemon thread, it must be stopped even if analyzing failed
+        writer.stop()
+        writer.join()
+        if server:
+            server.shutdown()
+            server.server_close()
+    for day_requests_data in days_requests_data.values():
+        day_requests_data.save()
+    if profile is not None:
+        stats = dump_cprofile(profile, args.profile_output)
+        logger.info('Saved cProfile stats of main thread to %s, top functions:\n%s' % (
+            args.profile_output, stats))
 
 
 def load_subcommand(subparsers):
@@ -131,5 +509,10 @@ def load_subcommand(subparsers):
     parser_start = subparsers.add_parser('start', help='Start uwsgi-sloth process for realtime analyzing.')
     parser_start.add_argument('-c', '--config', type=argparse.FileType('r'), dest='config',
                                 help='uwsgi-sloth config file, use "uwsgi-sloth echo_conf" for a default one', required=True)
+    parser_start.add_argument('--profile', dest='profile', action='store_true',
+                              help='Log counters and time of stages every interval, with ingest lag')
+    parser_start.add_argument('--profile-output', dest='profile_output', type=str, required=False,
+                              help='Also run analyzing thread with cProfile and save stats to this '
+                                   'file on exit, implies --profile')
     parser_start.set_defaults(func=start)
 
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Reading compressed log files, compression is detected by magic bytes"""
+import io
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# (name, magic bytes)
+MAGIC_BYTES = (
+    ('gzip', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+)
+MAX_MAGIC_LENGTH = max(len(magic) for _, magic in MAGIC_BYTES)
+
+# Decompressed data is passed to the parsing thread in blocks
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 8
+
+
+class UnsupportedCompression(Exception):
+    pass
+
+
+def detect_compression(fp):
+    """Detect compression of a binary file object, the file position will not be changed.
+
+    :returns: name of compression, None if the file is not compressed
+    """
+    if hasattr(fp, 'peek'):
+        head = fp.peek(MAX_MAGIC_LENGTH)[:MAX_MAGIC_LENGTH]
+    else:
+        pos = fp.tell()
+        head = fp.read(MAX_MAGIC_LENGTH)
+        fp.seek(pos)
+    for name, magic in MAGIC_BYTES:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def detect_file_compression(file_path):
+    """Detect compression of file of given path"""
+    with open(file_path, 'rb') as fp:
+        return detect_compression(fp)
+
+
+def open_decompressed(fp, compression):
+    """Wrap a compressed binary file object to a file object of decompressed data"""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(fp, mode='rb')
+    elif compression == 'xz':
+        return lzma.LZMAFile(fp, mode='rb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise UnsupportedCompression('"zstandard" package is required for zstd compressed file, '
+                                         'install it by "pip install zstandard"')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp))
+    raise UnsupportedCompression('Unknown compression: %s' % compression)
+
+
+def iter_line_blocks(fp, block_size=DECOMPRESS_BLOCK_SIZE, queue_size=DECOMPRESS_QUEUE_SIZE):
+    """Read file in a background thread, yield lists of lines(without line terminators).
+
+    Decompression modules release the GIL while decompressing, so decompressing will be
+    overlapped with parsing in the main thread.
+    """
+    blocks = queue.Queue(queue_size)
+
+    def read_blocks():
+        try:
+            while True:
+                data = fp.read(block_size)
+                blocks.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            blocks.put(e)
+
+    reader = threading.Thread(target=read_blocks, name='uwsgi-sloth-reader')
+    reader.daemon = True
+    reader.start()
+
+    rest = b''
+    while True:
+        data = blocks.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            break
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Exports of analyzed data, for merging data of many hosts into one report.
+
+An export file starts with a JSON header line, followed by gzip compressed requests data in
+the storage format(see ``uwsgi_sloth.storage``), so the header can be read without loading
+data:
+
+    {"format": "uwsgi-sloth-export", "version": 2, "host": "web-1", ...}
+
+Exports may come from other hosts or shared storage, so they are never unpickled.
+"""
+import gzip
+import json
+import socket
+import datetime
+
+from uwsgi_sloth.utils import atomic_write
+from uwsgi_sloth.storage import RequestsDataWriter, read_requests_data, InvalidStorageFile
+
+EXPORT_FORMAT = 'uwsgi-sloth-export'
+EXPORT_VERSION = 2
+EXPORT_COMPRESS_LEVEL = 6
+
+
+class InvalidExport(Exception):
+    pass
+
+
+def get_host_name():
+    return socket.gethostname()
+
+
+def make_export_header(host, options=None, datetime_range=None):
+    """Make header of export
+
+    :param options: dict of options which affect analyzed results, like "min_msecs"
+    """
+    if datetime_range:
+        datetime_range = [value.isoformat() if value else None for value in datetime_range]
+    return {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'host': host,
+        'created_at': datetime.datetime.now().replace(microsecond=0).isoformat(),
+        'options': options or {},
+        'datetime_range': datetime_range,
+    }
+
+
+def write_export(file_path, data, header):
+    """Write export file atomically"""
+    atomic_write([json.dumps(header, sort_keys=True).encode('utf-8') + b'\n',
+                  gzip.compress(RequestsDataWriter(data).tobytes(),
+                                compresslevel=EXPORT_COMPRESS_LEVEL)], file_path)
+
+
+def read_export_header(fp):
+    """Read and check header of export file"""
+    try:
+        header = json.loads(fp.readline().decode('utf-8'))
+    except ValueError:
+        raise InvalidExport('Not an export file')
+    if not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT:
+        raise InvalidExport('Not an export file')
+    if header.get('version') != EXPORT_VERSION:
+        raise InvalidExport('Unsupported export version: %s' % header.get('version'))
+    return header
+
+
+def read_export(file_path):
+    """Read export file
+
+    :returns: (header, data)
+    """
+    with open(file_path, 'rb') as fp:
+        header = read_export_header(fp)
+        try:
+            with gzip.GzipFile(fileobj=fp, mode='rb') as gz:
+                data = read_requests_data(file_path, buffer=gz.read())[1]
+        except (OSError, EOFError, InvalidStorageFile) as e:
+            raise InvalidExport('Broken export file: %s' % e)
+    return header, data
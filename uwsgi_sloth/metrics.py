@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Metrics of requests in Prometheus text format"""
+import time
+import bisect
+
+from uwsgi_sloth.settings import METRICS_BUCKETS, METRICS_MAX_GROUPS
+
+# Label of url groups exceeding METRICS_MAX_GROUPS
+OTHER_GROUP = '(other)'
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class GroupMetrics(object):
+    """Metrics of one url group"""
+    __slots__ = ('requests', 'slow_requests', 'slow_duration', 'buckets', 'duration')
+
+    def __init__(self, buckets_count):
+        self.requests = 0
+        self.slow_requests = 0
+        self.slow_duration = 0
+        # Counts of requests in every bucket, not cumulative
+        self.buckets = [0] * buckets_count
+        self.duration = 0
+
+
+class RequestMetrics(object):
+    """Cumulative metrics of requests by url group, updated by the analyzer for every request.
+
+    Url groups are label values, at most ``max_groups`` groups are tracked, requests of other
+    groups are counted as group "(other)". Rendering takes snapshots of counters without any
+    lock, so it never blocks analyzing.
+
+    :param buckets: upper bounds of histogram buckets, in seconds
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS, max_groups=METRICS_MAX_GROUPS):
+        self.bucket_bounds = list(buckets)
+        self.bucket_bounds_msecs = [bound * 1000 for bound in buckets]
+        self.max_groups = max_groups
+        self.groups = {}
+        self.last_request_datetime = None
+        # Optional function returns seconds analyzing is behind the log
+        self.get_ingest_lag = None
+
+    def observe(self, method, url_group, resp_time, is_slow, request_datetime):
+        """Count a request, ``resp_time`` is in milliseconds"""
+        key = (method, url_group)
+        group = self.groups.get(key)
+        if group is None:
+            if len(self.groups) >= self.max_groups:
+                key = (method, OTHER_GROUP)
+                group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = GroupMetrics(len(self.bucket_bounds) + 1)
+        group.requests += 1
+        group.duration += resp_time
+        group.buckets[bisect.bisect_left(self.bucket_bounds_msecs, resp_time)] += 1
+        if is_slow:
+            group.slow_requests += 1
+            group.slow_duration += resp_time
+        if self.last_request_datetime is None or request_datetime > self.last_request_datetime:
+            self.last_request_datetime = request_datetime
+
+    def render(self):
+        """Render metrics in Prometheus text format"""
+        # Copying dict items is atomic, new groups added when rendering will not break it
+        groups = sorted(list(self.groups.items()))
+        labels = [(key, 'method="%s",group="%s"' % (key[0], escape_label_value(key[1])))
+                  for key, _ in groups]
+        groups = dict(groups)
+
+        lines = []
+
+        def add_metric(name, metric_type, help_text, get_value):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for key, label in labels:
+                lines.append('%s{%s} %s' % (name, label, format_value(get_value(groups[key]))))
+
+        add_metric('uwsgi_sloth_requests_total', 'counter', 'Number of requests.',
+                   lambda group: group.requests)
+        add_metric('uwsgi_sloth_slow_requests_total', 'counter', 'Number of slow requests.',
+                   lambda group: group.slow_requests)
+        add_metric('uwsgi_sloth_slow_requests_duration_seconds_total', 'counter',
+                   'Total duration of slow requests.', lambda group: group.slow_duration / 1000.0)
+
+        name = 'uwsgi_sloth_request_duration_seconds'
+        lines.append('# HELP %s Duration of requests.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for key, label in labels:
+            group = groups[key]
+            count = 0
+            for bound, bucket_count in zip(self.bucket_bounds + [float('inf')], group.buckets):
+                count += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (name, label, format_value(bound), count))
+            lines.append('%s_sum{%s} %s' % (name, label, format_value(group.duration / 1000.0)))
+            lines.append('%s_count{%s} %s' % (name, label, count))
+
+        name = 'uwsgi_sloth_last_request_timestamp_seconds'
+        lines.append('# HELP %s Timestamp of the last analyzed request.' % name)
+        lines.append('# TYPE %s gauge' % name)
+        last_request_datetime = self.last_request_datetime
+        # Datetime in log is local time
+        timestamp = time.mktime(last_request_datetime.timetuple()) if last_request_datetime else 0
+        lines.append('%s %s' % (name, format_value(timestamp)))
+
+        if self.get_ingest_lag is not None:
+            name = 'uwsgi_sloth_ingest_lag_seconds'
+            lines.append('# HELP %s Seconds analyzing is behind the log.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, format_value(float(self.get_ingest_lag()))))
+        return '\n'.join(lines) + '\n'
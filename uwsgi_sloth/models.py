@@ -1,20 +1,49 @@
 # -*- coding: utf-8 -*-
 """Data models functions"""
 import os
+import json
 import logging
 import pickle
 
+from uwsgi_sloth.utils import makedir_if_none_exists, atomic_write
+from uwsgi_sloth.structures import TopURLsAggregation
+from uwsgi_sloth.storage import write_storage_file, read_storage_header, write_requests_data, \
+    read_requests_data, read_requests_data_header, InvalidStorageFile, format_datetime, \
+    parse_datetime
+
 logger = logging.getLogger(__name__)
 
+# Files of older versions are pickled, they are still loaded and will be replaced by files
+# of the storage format(see ``uwsgi_sloth.storage``) when saved.
+LEGACY_EXTENSION = '.pickle'
+EXTENSION = '.db'
+
+
+def atomic_dump(objs, file_path):
+    """Pickle objects to file atomically, the file will never be half written"""
+    atomic_write((pickle.dumps(obj, pickle.HIGHEST_PROTOCOL) for obj in objs), file_path)
+
+
+def remove_if_exists(file_path):
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+
 
 class SavePoint(object):
     """Model: SavePoint"""
-    default_file_name = 'savepoint.pickle'
+    kind = 'savepoint'
+    default_file_name = 'savepoint' + EXTENSION
 
     def __init__(self, db_dir):
         self.db_file_path = os.path.join(db_dir, self.default_file_name)
+        self.legacy_file_path = os.path.join(db_dir, 'savepoint' + LEGACY_EXTENSION)
         if os.path.exists(self.db_file_path):
-            with open(self.db_file_path, 'rb') as fp:
+            self.data = read_storage_header(self.db_file_path, self.kind)
+            self.data['last_datetime'] = parse_datetime(self.data.get('last_datetime'))
+        elif os.path.exists(self.legacy_file_path):
+            with open(self.legacy_file_path, 'rb') as fp:
                 self.data = pickle.load(fp)
         else:
             self.data = {}
@@ -25,35 +54,191 @@ class SavePoint(object):
     def get_last_datetime(self):
         return self.data.get('last_datetime')
 
+    def set_file_position(self, offset, file_stat):
+        """Set position of log file, ``file_stat`` is used to identify the file"""
+        self.data['file_position'] = {
+            'offset': offset,
+            'ino': file_stat.st_ino,
+            'dev': file_stat.st_dev,
+        }
+
+    def get_file_position(self):
+        return self.data.get('file_position')
+
     def save(self):
         logger.info('SavePoint value change to %s' % self.get_last_datetime())
-        with open(self.db_file_path, 'wb') as fp:
-            pickle.dump(self.data, fp)
+        write_storage_file(self.db_file_path, self.kind,
+                           dict(self.data, last_datetime=format_datetime(self.get_last_datetime())))
+        remove_if_exists(self.legacy_file_path)
 
 
 class RequestsData(object):
-    """Model: RequestsData"""
+    """Model: RequestsData
+
+    Requests data of one day is stored as a base file and segment files. New data of every
+    interval is appended as a segment file via ``add()``, ``save()`` merges all segments into
+    the base file. Data will not be loaded until ``data`` is accessed.
+
+    Base file contains a header and the data, header records the last merged segment, so
+    segments left by a crash during ``save()`` will not be merged twice. Pickled files of
+    older versions are loaded, the base file is replaced by the storage format when saved.
+    """
+    format_version = 2
 
     def __init__(self, date, db_dir):
         self.date = date
-        self.db_file_path = os.path.join(db_dir, '%s.pickle' % date)
+        self.db_file_path = os.path.join(db_dir, date + EXTENSION)
+        self.legacy_file_path = os.path.join(db_dir, date + LEGACY_EXTENSION)
+        self.segments_dir = os.path.join(db_dir, '%s.segments' % date)
+        self.segments = self.list_segments()
+        self._data = None
+        # Increased every time new data added
+        self.revision = 0
+
+    def list_segments(self):
+        """List sequence numbers of segments"""
+        if not os.path.isdir(self.segments_dir):
+            return []
+        return sorted(set(int(os.path.splitext(name)[0]) for name in os.listdir(self.segments_dir)
+                          if name.endswith((EXTENSION, LEGACY_EXTENSION)) and not name.startswith('.')))
+
+    def get_segment_path(self, seq):
+        """Path of segment, the pickled one if it was written by older versions"""
+        legacy_path = os.path.join(self.segments_dir, '%08d%s' % (seq, LEGACY_EXTENSION))
+        if os.path.exists(legacy_path):
+            return legacy_path
+        return os.path.join(self.segments_dir, '%08d%s' % (seq, EXTENSION))
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+    def load_base(self, header_only=False):
+        """Load base file
+
+        :returns: (header, data), data will be None if ``header_only``
+        """
         if os.path.exists(self.db_file_path):
-            with open(self.db_file_path, 'rb') as fp:
-                self.data = pickle.load(fp)
+            if header_only:
+                return read_requests_data_header(self.db_file_path), None
+            return read_requests_data(self.db_file_path)
+        if not os.path.exists(self.legacy_file_path):
+            return {'last_segment': 0}, {}
+        with open(self.legacy_file_path, 'rb') as fp:
+            header = pickle.load(fp)
+            # Files saved by older versions contain data only
+            if 'version' not in header:
+                return {'last_segment': 0}, header
+            return header, None if header_only else pickle.load(fp)
+
+    def load_segment(self, seq):
+        segment_path = self.get_segment_path(seq)
+        if segment_path.endswith(LEGACY_EXTENSION):
+            with open(segment_path, 'rb') as fp:
+                return pickle.load(fp)
+        return read_requests_data(segment_path)[1]
+
+    def load(self):
+        header, data = self.load_base()
+        for seq in self.segments:
+            if seq <= header['last_segment']:
+                continue
+            merge_requests_data_to(data, self.load_segment(seq))
+        return data
+
+    def add(self, food):
+        """Add new requests data, which will be written to a new segment"""
+        self.write_segment(food)
+        self.merge(food)
+
+    def write_segment(self, food):
+        """Write new requests data to a new segment, it must be merged to loaded data by
+        ``merge()`` later. Data is loaded first, so the new segment will not be loaded again."""
+        self.data
+        if self.segments:
+            seq = self.segments[-1] + 1
         else:
-            self.data = {}
+            seq = self.load_base(header_only=True)[0]['last_segment'] + 1
+        makedir_if_none_exists(self.segments_dir)
+        write_requests_data(self.get_segment_path(seq), food)
+        self.segments.append(seq)
+
+    def merge(self, food):
+        """Merge new requests data to loaded data"""
+        self.revision += 1
+        merge_requests_data_to(self.data, food)
+
+    def get_signature(self):
+        """Signature of stored files, it changes whenever stored data changed"""
+        signature = []
+        paths = [self.db_file_path, self.legacy_file_path] + \
+            [self.get_segment_path(seq) for seq in self.list_segments()]
+        for path in paths:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            signature.append((os.path.basename(path), file_stat.st_size, file_stat.st_mtime_ns))
+        return tuple(signature)
 
     def save(self):
-        with open(self.db_file_path, 'wb') as fp:
-            pickle.dump(self.data, fp)
+        """Merge all segments into base file, pickled base file is replaced"""
+        data = self.data
+        if not self.segments and os.path.exists(self.db_file_path):
+            return
+        last_segment = self.segments[-1] if self.segments else 0
+        write_requests_data(self.db_file_path, data,
+                            {'version': self.format_version, 'last_segment': last_segment})
+        remove_if_exists(self.legacy_file_path)
+        for seq in self.segments:
+            remove_if_exists(self.get_segment_path(seq))
+        self.segments = []
+
+
+class RollupData(object):
+    """Model: RollupData
+
+    Merged requests data of a period(like a week), stored with signatures of days in the
+    period, it is only valid when data of all days are unchanged.
+    """
+    format_version = 2
+
+    def __init__(self, name, db_dir):
+        self.name = name
+        self.db_file_path = os.path.join(db_dir, 'rollups', name + EXTENSION)
+
+    def make_header(self, signature):
+        # Signature is compared after a JSON round trip, tuples become lists
+        return json.loads(json.dumps({'version': self.format_version, 'signature': signature}))
+
+    def load(self, signature):
+        """Load data, returns None if not found or days were changed"""
+        try:
+            header = read_requests_data_header(self.db_file_path)
+            if header != self.make_header(signature):
+                return None
+            return read_requests_data(self.db_file_path)[1]
+        except (OSError, InvalidStorageFile):
+            return None
+
+    def save(self, signature, data):
+        makedir_if_none_exists(os.path.dirname(self.db_file_path))
+        write_requests_data(self.db_file_path, data, self.make_header(signature))
 
 
 # Utils for requests data
 
 def merge_urls_data_to(to, food={}):
     """Merge urls data"""
+    if isinstance(to, TopURLsAggregation):
+        to.merge_from(food)
+        return
+
     if not to:
         to.update(food)
+        return
 
     for url, data in food.items():
         if url not in to:
@@ -62,24 +247,62 @@ def merge_urls_data_to(to, food={}):
             to[url] = to[url].merge_with(data)
 
 
+def copy_url_group_data(data):
+    """Copy data of url group, so merging to it will not modify the original one"""
+    urls = data['urls']
+    return dict(data, urls=urls.copy() if isinstance(urls, TopURLsAggregation) else dict(urls))
+
+
 def merge_requests_data_to(to, food={}):
     """Merge a small analyzed result to a big one, this function will modify the 
-    original ``to``"""
+    original ``to``, ``food`` will never be modified by merging to ``to`` later."""
     if not to:
         to.update(food)
+        to['requests_counter'] = dict(food['requests_counter'])
+        if 'datetime_range' in food:
+            to['datetime_range'] = list(food['datetime_range'])
+        to['data_details'] = dict((group_name, copy_url_group_data(urls))
+                                  for group_name, urls in food['data_details'].items())
+        return
 
     to['requests_counter']['normal'] += food['requests_counter']['normal']
     to['requests_counter']['slow'] += food['requests_counter']['slow']
     to['total_slow_duration'] += food['total_slow_duration']
+    merge_time_series_to(to, food)
 
     for group_name, urls in food['data_details'].items():
         if group_name not in to['data_details']:
-            to['data_details'][group_name] = urls
+            to['data_details'][group_name] = copy_url_group_data(urls)
         else:
             to_urls = to['data_details'][group_name]
+            # Urls data loaded from older versions are plain dicts
+            if isinstance(urls['urls'], TopURLsAggregation) and \
+                    not isinstance(to_urls['urls'], TopURLsAggregation):
+                to_urls['urls'] = TopURLsAggregation.from_dict(to_urls['urls'], urls['urls'].limit)
             to_urls['duration_agr_data'] = to_urls['duration_agr_data'].merge_with(
                     urls['duration_agr_data'])
+            merge_time_series_to(to_urls, urls)
 
             # Merge urls data
             merge_urls_data_to(to_urls['urls'], urls['urls'])
 
+
+def merge_time_series_to(to, food):
+    """Merge ``time_series`` of ``food`` dict to ``to``, data saved by older versions has
+    no time series."""
+    if food.get('time_series') is None:
+        return
+    if to.get('time_series') is None:
+        to['time_series'] = food['time_series']
+    else:
+        to['time_series'] = to['time_series'].merge_with(food['time_series'])
+
+
+def union_datetime_range(to, food):
+    """Merge the ``datetime_range`` of an analyzed result to another one: extend ``to`` to
+    cover ``food``, the ranges may overlap and be merged in any order, like ranges of rotated
+    files or different hosts."""
+    if food[0] and (to[0] is None or food[0] < to[0]):
+        to[0] = food[0]
+    if food[1] and (to[1] is None or food[1] > to[1]):
+        to[1] = food[1]
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Parsers for custom uwsgi log formats: "logformat" strings and JSON lines"""
+import re
+import json
+import datetime
+
+from uwsgi_sloth.analyzer import UWSGILogParser
+from uwsgi_sloth.settings import FILTER_METHODS, FILTER_STATUS
+
+
+class InvalidLogFormat(Exception):
+    pass
+
+
+# Regular expressions of uwsgi logformat variables, other variables match any text
+VARIABLE_PATTERNS = {
+    'method': r'[A-Z]+',
+    'uri': r'[^ "]*',
+    'status': r'\d{3}',
+    'msecs': r'\d+',
+    'micros': r'\d+',
+    'ltime': r'\d{2}/[A-Z][a-z]{2}/\d{4}:\d{2}:\d{2}:\d{2}(?: [+-]\d{4})?',
+    'ctime': r'[A-Z][a-z]{2} [A-Z][a-z]{2} +\d{1,2} \d{2}:\d{2}:\d{2} \d{4}',
+    'time': r'\d+',
+    'epoch': r'\d+',
+    'tmsecs': r'\d+',
+    'tmicros': r'\d+',
+}
+TIME_VARIABLES = ('ltime', 'ctime', 'time', 'epoch', 'tmsecs', 'tmicros')
+TIMESTAMP_DIVISORS = {'tmsecs': 1000, 'tmicros': 1000000}
+DURATION_VARIABLES = ('msecs', 'micros')
+RE_VARIABLE = re.compile(r'%\((\w+)\)')
+# Errors of parsing values in lines which passed the format check, like a time out of range or
+# a JSON value of wrong type, such lines are ignored
+VALUE_ERRORS = (KeyError, ValueError, TypeError, AttributeError, OverflowError, OSError)
+
+
+class CustomLogParser(UWSGILogParser):
+    """Base class for parsers of custom formats, results are the same as ``UWSGILogParser``.
+    Request datetime can be any of uwsgi time variables, all of them are parsed to local
+    datetime without timezone, in seconds."""
+
+    def parse_time(self, name, value):
+        """Parse value of time variable ``name``, results are cached by second"""
+        if isinstance(value, (int, float)):
+            value = int(value) // TIMESTAMP_DIVISORS.get(name, 1)
+        elif name == 'tmsecs':
+            value = value[:-3]
+        elif name == 'tmicros':
+            value = value[:-6]
+        try:
+            return self.datetime_cache[value]
+        except KeyError:
+            pass
+
+        if name == 'ctime':
+            result = self.parse_datetime(value)
+        elif name == 'ltime':
+            result = self.parse_ltime(value)
+        else:
+            result = datetime.datetime.fromtimestamp(int(value))
+
+        if len(self.datetime_cache) >= self.MAX_DATETIME_CACHE_SIZE:
+            self.datetime_cache.clear()
+        self.datetime_cache[value] = result
+        return result
+
+    def parse_ltime(self, value):
+        """Parse time like "29/Apr/2014:00:13:10 +0800", timezone is ignored"""
+        text = value.decode('ascii', 'replace') if isinstance(value, bytes) else value
+        try:
+            return datetime.datetime(int(text[7:11]), self.MONTHS[text[3:6]], int(text[:2]),
+                                     int(text[12:14]), int(text[15:17]), int(text[18:20]))
+        except KeyError:
+            raise ValueError('Invalid ltime: %s' % text)
+
+
+class LogFormatParser(CustomLogParser):
+    """Parser for log written by a custom uwsgi ``logformat``, like:
+
+        "%(addr) [%(ltime)] %(method) %(uri) => %(status) in %(msecs) msecs"
+
+    The format is compiled into one regular expression, "method", "uri", a duration
+    variable("msecs" or "micros") and a time variable("ltime", "ctime", "time", "epoch",
+    "tmsecs" or "tmicros") are required, "status" is optional.
+    """
+
+    def __init__(self, log_format):
+        super(LogFormatParser, self).__init__()
+        self.log_format = log_format
+        self.re_line, names = self.compile_format(log_format)
+
+        # Indexes of fields in groups of matched line
+        self.method_index = names.index('method')
+        self.uri_index = names.index('uri')
+        self.status_index = names.index('status') if 'status' in names else None
+        self.duration_name = [name for name in names if name in DURATION_VARIABLES][0]
+        self.duration_index = names.index(self.duration_name)
+        self.time_name = [name for name in names if name in TIME_VARIABLES][0]
+        self.time_index = names.index(self.time_name)
+
+    @staticmethod
+    def compile_format(log_format):
+        """Compile logformat string to a bytes regex
+
+        :returns: (regex, names of groups)
+        """
+        pattern = []
+        names = []
+        parts = RE_VARIABLE.split(log_format)
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                pattern.append(re.escape(part))
+            elif part in VARIABLE_PATTERNS and part not in names and not (
+                    part in TIME_VARIABLES and set(names) & set(TIME_VARIABLES)) and not (
+                    part in DURATION_VARIABLES and set(names) & set(DURATION_VARIABLES)):
+                pattern.append('(%s)' % VARIABLE_PATTERNS[part])
+                names.append(part)
+            else:
+                pattern.append('.*?')
+
+        missing = [name for name in ('method', 'uri') if name not in names]
+        if not set(names) & set(DURATION_VARIABLES):
+            missing.append('msecs')
+        if not set(names) & set(TIME_VARIABLES):
+            missing.append('ltime')
+        if missing:
+            raise InvalidLogFormat('Variables missing in log format: %s' % ', '.join(
+                '%%(%s)' % name for name in missing))
+        return re.compile(''.join(pattern).encode('utf-8')), names
+
+    def parse(self, line):
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        matched = self.re_line.search(line)
+        if not matched:
+            return
+        values = matched.groups()
+        method = values[self.method_index]
+        if method not in self.FILTER_METHODS_BYTES:
+            return
+        status = None
+        if self.status_index is not None:
+            status = values[self.status_index]
+            if status not in self.FILTER_STATUS_BYTES:
+                return
+            status = status.decode('ascii')
+
+        try:
+            request_datetime = self.parse_time(self.time_name, values[self.time_index])
+        except VALUE_ERRORS:
+            return
+        resp_time = int(values[self.duration_index])
+        if self.duration_name == 'micros':
+            resp_time //= 1000
+        url = values[self.uri_index].replace(b'//', b'/').decode('utf-8', 'replace')
+        return {
+            'method': method.decode('ascii'),
+            'url': url,
+            'url_path': url.split('?')[0],
+            'resp_time': resp_time,
+            'status': status,
+            'request_datetime': request_datetime,
+        }
+
+    def parse_line_datetime(self, line):
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        matched = self.re_line.search(line)
+        if not matched:
+            return
+        try:
+            return self.parse_time(self.time_name, matched.group(self.time_index + 1))
+        except VALUE_ERRORS:
+            return
+
+
+class JSONLogParser(CustomLogParser):
+    """Parser for JSON lines, keys are names of uwsgi variables, like this logformat:
+
+        {"method": "%(method)", "uri": "%(uri)", "status": %(status), "msecs": %(msecs),
+         "time": %(time)}
+
+    Lines which are not JSON objects are ignored.
+    """
+    # Status may be either a number or a string
+    FILTER_STATUS_VALUES = frozenset(FILTER_STATUS) | \
+        frozenset(int(status) for status in FILTER_STATUS)
+
+    def __init__(self):
+        super(JSONLogParser, self).__init__()
+        self.json_decoder = json.JSONDecoder()
+
+    def parse(self, line):
+        record = self.load_record(line)
+        if record is None:
+            return
+        try:
+            method = record.get('method')
+            if method not in FILTER_METHODS:
+                return
+            status = record.get('status')
+            if status is not None:
+                # Values of other types are unhashable or never equal to filtered status
+                if not isinstance(status, (str, int, float)) or \
+                        status not in self.FILTER_STATUS_VALUES:
+                    return
+                status = str(status)
+
+            if 'msecs' in record:
+                resp_time = int(record['msecs'])
+            else:
+                resp_time = int(record['micros']) // 1000
+            request_datetime = self.get_datetime(record)
+            url = record['uri'].replace('//', '/')
+        except VALUE_ERRORS:
+            return
+        if request_datetime is None:
+            return
+        return {
+            'method': method,
+            'url': url,
+            'url_path': url.split('?')[0],
+            'resp_time': resp_time,
+            'status': status,
+            'request_datetime': request_datetime,
+        }
+
+    def load_record(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if not line.startswith('{'):
+            return
+        try:
+            # Trailing characters like line terminators are ignored
+            return self.json_decoder.raw_decode(line)[0]
+        except ValueError:
+            return
+
+    def get_datetime(self, record):
+        for name in TIME_VARIABLES:
+            value = record.get(name)
+            if value is not None:
+                return self.parse_time(name, value)
+
+    def parse_line_datetime(self, line):
+        record = self.load_record(line)
+        if record is None:
+            return
+        try:
+            return self.get_datetime(record)
+        except VALUE_ERRORS:
+            return
+
+
+def make_log_parser(log_format=None):
+    """Make parser for ``log_format``: None or "default" for default uwsgi log format, "json"
+    for JSON lines, otherwise a uwsgi logformat string."""
+    if not log_format or log_format == 'default':
+        return UWSGILogParser()
+    elif log_format == 'json':
+        return JSONLogParser()
+    return LogFormatParser(log_format)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Opt-in profiling: counters and timers of analyzing stages, and cProfile output.
+
+Stages of analyzing lines are measured by replacing methods of the objects being profiled
+with timed ones, so nothing is changed and nothing costs when profiling is disabled.
+"""
+import io
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+
+# Time of nested stages is excluded from their parents in reports
+NESTED_STAGES = {
+    'analyze_line': ('parse', 'classify'),
+    'parse': ('parse_datetime', ),
+}
+# Stages of analyzing lines are reported first, in this order
+LINE_STAGES = ('read', 'parse', 'parse_datetime', 'classify', 'analyze_line')
+# Stage "analyze_line" without parsing and classifying is aggregating
+STAGE_LABELS = {'analyze_line': 'aggregate'}
+# (name, label) of counters in reports
+COUNTERS = (
+    ('lines_read', 'lines read'),
+    ('lines_matched', 'matched'),
+    ('lines_filtered', 'filtered'),
+    ('urls_classified', 'classified'),
+    ('classify_cache_hits', 'classify cache hits'),
+    ('classify_cache_misses', 'misses'),
+)
+PSTATS_LIMIT = 20
+
+
+class StageProfiler(object):
+    """Counters and timers of stages, only used by one thread.
+
+    Timers and counters are reset in place by ``reset()``, so timed methods made by ``wrap()``
+    keep working after reset.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.stage_names = []
+        # [classifier, cache hits, cache misses] when reset
+        self.classifiers = []
+        self.started_at = time.perf_counter()
+
+    def add_stage(self, name):
+        if name not in self.timers:
+            self.timers[name] = 0.0
+            self.stage_names.append(name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        self.add_stage(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+
+    def wrap(self, obj, method_name, stage, counter=None):
+        """Replace method of ``obj`` with a timed one, calls are counted by ``counter``"""
+        self.add_stage(stage)
+        if counter:
+            self.counters.setdefault(counter, 0)
+        func = getattr(obj, method_name)
+        timers, counters, clock = self.timers, self.counters, time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timers[stage] += clock() - start
+                if counter:
+                    counters[counter] += 1
+
+        setattr(obj, method_name, timed)
+
+    def iter_timed(self, iterable, stage, idle_item=None):
+        """Iterate with time of getting items counted as ``stage``, time of getting
+        ``idle_item``(like "no new line" of tailer) is counted as "idle" instead."""
+        self.add_stage(stage)
+        self.add_stage('idle')
+        timers, clock = self.timers, time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            timers['idle' if idle_item is not None and item is idle_item else stage] += \
+                clock() - start
+            yield item
+
+    def instrument_analyzer(self, analyzer):
+        """Measure stages of ``analyzer.analyze_line``: parse, parse_datetime, classify and
+        the rest(aggregate)"""
+        self.wrap(analyzer, 'analyze_line', 'analyze_line', counter='lines_read')
+
+        log_parser = analyzer.log_parser
+        # Custom parsers parse time by "parse_time", which calls "parse_datetime"
+        self.wrap(log_parser, 'parse_time' if hasattr(log_parser, 'parse_time') else 'parse_datetime',
+                  'parse_datetime')
+        self.add_stage('parse')
+        self.counters.setdefault('lines_matched', 0)
+        parse = log_parser.parse
+        timers, counters, clock = self.timers, self.counters, time.perf_counter
+
+        def timed_parse(line):
+            start = clock()
+            result = parse(line)
+            timers['parse'] += clock() - start
+            if result is not None:
+                counters['lines_matched'] += 1
+            return result
+
+        log_parser.parse = timed_parse
+        # Only slow requests are classified, unless request metrics are enabled
+        self.wrap(analyzer.url_classifier, 'classify', 'classify', counter='urls_classified')
+        classifier = analyzer.url_classifier
+        self.classifiers.append([classifier, classifier.cache_hits, classifier.cache_misses])
+
+    def get_counters(self):
+        counters = dict(self.counters)
+        if 'lines_read' in counters:
+            counters['lines_filtered'] = counters['lines_read'] - counters.get('lines_matched', 0)
+        if self.classifiers:
+            counters['classify_cache_hits'] = sum(c.cache_hits - hits for c, hits, _ in self.classifiers)
+            counters['classify_cache_misses'] = sum(c.cache_misses - misses
+                                                    for c, _, misses in self.classifiers)
+        return counters
+
+    def get_stage_times(self):
+        """Time of stages, time of nested stages is excluded
+
+        :returns: list of (label, seconds)
+        """
+        timers = self.timers
+        names = [name for name in LINE_STAGES if name in timers] + \
+            [name for name in self.stage_names if name not in LINE_STAGES]
+        return [(STAGE_LABELS.get(name, name),
+                 timers[name] - sum(timers.get(child, 0) for child in NESTED_STAGES.get(name, ())))
+                for name in names]
+
+    def format_report(self):
+        elapsed = time.perf_counter() - self.started_at
+        counters = self.get_counters()
+        parts = []
+        for name, label in COUNTERS:
+            if name in counters:
+                parts.append('%s %s' % (label, counters[name]))
+        if 'lines_read' in counters and elapsed:
+            parts[0] += '(%.0f/s)' % (counters['lines_read'] / elapsed)
+        stages = ', '.join('%s %.3fs(%.1f%%)' % (label, seconds, seconds * 100 / elapsed)
+                           for label, seconds in self.get_stage_times() if seconds)
+        report = 'in %.2fs: %s' % (elapsed, stages or 'no stages')
+        if parts:
+            report = '%s; %s' % (', '.join(parts), report)
+        return report
+
+    def reset(self):
+        for name in self.timers:
+            self.timers[name] = 0.0
+        for name in self.counters:
+            self.counters[name] = 0
+        for item in self.classifiers:
+            item[1], item[2] = item[0].cache_hits, item[0].cache_misses
+        self.started_at = time.perf_counter()
+
+
+@contextmanager
+def profile_stage(profiler, name):
+    """Measure stage ``name`` if ``profiler`` is not None"""
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+def start_cprofile():
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def dump_cprofile(profile, file_path, limit=PSTATS_LIMIT):
+    """Stop profiling and dump stats to ``file_path``, which can be read by ``pstats``.
+
+    :returns: text of top ``limit`` functions sorted by cumulative time
+    """
+    profile.disable()
+    profile.dump_stats(file_path)
+    stream = io.StringIO()
+    pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Built-in HTTP server for realtime reports, reports are rendered from in-memory data"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from uwsgi_sloth import __VERSION__
+from uwsgi_sloth.analyzer import format_data
+from uwsgi_sloth.template import render_template
+from uwsgi_sloth.settings import SERVER_CACHE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def make_json_report(data):
+    """Make a JSON serializable report from formatted data"""
+    def agr_result(agr):
+        return {'count': agr.count, 'total': agr.total, 'avg': agr.avg, 'min': agr.min,
+                'max': agr.max}
+
+    url_groups = []
+    for (method, url_schema), d in data['data_details']:
+        group = agr_result(d['duration_agr_data'])
+        group.update(method=method, url_schema=url_schema,
+                     p50=d['duration_agr_data'].p50, p95=d['duration_agr_data'].p95,
+                     p99=d['duration_agr_data'].p99,
+                     urls=[dict(agr_result(url_data), url=url) for url, url_data in d['urls']])
+        url_groups.append(group)
+
+    trend = []
+    if data.get('time_series') is not None and data['time_series'].start is not None:
+        for point in data['time_series'].get_points():
+            trend.append({'datetime': point['datetime'].isoformat(), 'count': point['count'],
+                          'avg': point['avg'], 'max': point['max'], 'p95': point['p95']})
+
+    datetime_range = data.get('datetime_range')
+    if isinstance(datetime_range, (list, tuple)):
+        datetime_range = [value.isoformat() if value else None for value in datetime_range]
+    return {
+        'datetime_range': datetime_range,
+        'requests_counter': data['requests_counter'],
+        'total_slow_duration': data['total_slow_duration'],
+        'slow_rate': data['slow_rate'],
+        'url_groups': url_groups,
+        'trend': trend,
+    }
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """Handler for report pages: "/<name>.html" and JSON API: "/api/<name>.json" """
+    server_version = 'uwsgi-sloth/%s' % '.'.join(map(str, __VERSION__))
+    RE_PATH = re.compile(r'^/(?P<api>api/)?(?P<name>[\w-]+)\.(?P<ext>html|json)$')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/':
+            self.send_response(302)
+            self.send_header('Location', '/today.html')
+            self.end_headers()
+            return
+
+        if path == '/metrics' and self.server.metrics is not None:
+            body = self.server.metrics.render().encode('utf-8')
+            self.send_body(self.server.metrics_content_type, body)
+            return
+
+        matched = self.RE_PATH.match(path)
+        if not matched or bool(matched.group('api')) != (matched.group('ext') == 'json'):
+            self.send_error(404)
+            return
+        page = self.server.get_page(matched.group('name'), matched.group('ext'))
+        if page is None:
+            self.send_error(404)
+            return
+
+        self.send_body(*page)
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class ReportServer(ThreadingMixIn, HTTPServer):
+    """HTTP server for realtime reports, it runs in its own thread.
+
+    :param source: source of report data, an object with methods ``get_report_version(name)``
+                   returning version of report or None, and ``get_report(name)`` returning
+                   (data, version, context) or None. Cached page is used if version not
+                   changed, data returned by ``get_report`` must not be modified later, so
+                   rendering never blocks analyzing.
+    :param html_dir: static HTML files in this directory are served if no report found
+    :param metrics: optional ``RequestMetrics`` served at "/metrics", no lock is needed
+    """
+    daemon_threads = True
+    content_types = {
+        'html': 'text/html; charset=utf-8',
+        'json': 'application/json',
+    }
+    metrics_content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, server_address, source, html_dir=None, domain=None, metrics=None):
+        HTTPServer.__init__(self, server_address, ReportRequestHandler)
+        self.source = source
+        self.metrics = metrics
+        self.html_dir = html_dir
+        self.domain = domain
+        # {(name, ext): (version, rendered time, body)}
+        self.page_cache = {}
+        self.format_caches = {}
+        # Pages are rendered one at a time, caches are not shared by threads
+        self.render_lock = threading.Lock()
+
+    def get_page(self, name, ext):
+        """Get (content type, body) of page, returns None if not found"""
+        with self.render_lock:
+            version = self.source.get_report_version(name)
+            if version is not None:
+                body = self.get_cached_page(name, ext, version)
+                if body is None:
+                    report = self.source.get_report(name)
+                    if report is not None:
+                        body = self.render_report(name, ext, *report)
+                if body is not None:
+                    return self.content_types[ext], body
+
+        # Fallback to static HTML files, like reports of older days
+        if ext == 'html' and self.html_dir:
+            file_path = os.path.join(self.html_dir, '%s.html' % name)
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as fp:
+                    return self.content_types[ext], fp.read()
+        return None
+
+    def get_cached_page(self, name, ext, version):
+        """Rendered page will be reused until data changed, but a page will not be rendered
+        more than once in ``SERVER_CACHE_SECONDS``."""
+        cached = self.page_cache.get((name, ext))
+        if cached and (cached[0] == version or time.time() - cached[1] < SERVER_CACHE_SECONDS):
+            return cached[2]
+        return None
+
+    def render_report(self, name, ext, data, version, context):
+        """Render report and cache the rendered page"""
+        now = time.time()
+        data = format_data(data, cache=self.format_caches.setdefault(name, {}))
+        data.update(context)
+        if ext == 'json':
+            body = json.dumps(make_json_report(data)).encode('utf-8')
+        else:
+            data.update(domain=self.domain)
+            body = render_template('realtime.html', data).encode('utf-8')
+        self.page_cache[(name, ext)] = (version, now, body)
+        return body
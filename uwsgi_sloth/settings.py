@@ -8,8 +8,27 @@ FILTER_STATUS = ('200', )
 
 LIMIT_URL_GROUPS = 200
 LIMIT_PER_URL_GROUP = 20
+# Number of hosts shown for every url group in reports merged from exports of many hosts
+LIMIT_HOSTS_PER_URL_GROUP = 10
 DEFAULT_MIN_MSECS = 200
 
+# Percentiles of url groups are estimated by sketches, relative error of percentiles is lower
+# than SKETCH_RELATIVE_ACCURACY, and every sketch holds SKETCH_MAX_BUCKETS buckets at most.
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_MAX_BUCKETS = 512
+
+# Only urls with largest total durations are kept for every url group, memory of one group
+# is bounded to 2 * MAX_URLS_PER_GROUP urls, 0 means no limit.
+MAX_URLS_PER_GROUP = 1000
+
+# Max number of url paths cached by URLClassifier
+URL_CLASSIFY_CACHE_SIZE = 10000
+
+# Slow requests are also aggregated by time for trend charts, buckets are TIME_SERIES_BUCKET_SECONDS
+# wide at first, width will be doubled when a series has more than TIME_SERIES_MAX_BUCKETS buckets.
+TIME_SERIES_BUCKET_SECONDS = 60
+TIME_SERIES_MAX_BUCKETS = 240
+
 STATIC_PATH_BOOTSTRAP = 'https://maxcdn.bootstrapcdn.com/bootstrap/3.1.1/css/bootstrap.min.css'
 STATIC_PATH_JQUERY = 'https://code.jquery.com/jquery-1.7.2.min.js'
 
@@ -17,3 +36,31 @@ STATIC_PATH_SORTABLE_CSS = 'https://cdnjs.cloudflare.com/ajax/libs/sortable/0.8.
 STATIC_PATH_SORTABLE = 'https://cdnjs.cloudflare.com/ajax/libs/sortable/0.8.0/js/sortable.min.js'
 
 REALTIME_UPDATE_INTERVAL = 5 * 60
+
+# Realtime data of recent requests is kept in a sliding window of REALTIME_WINDOW_SLOTS slots,
+# every slot holds data of REALTIME_SLOT_SECONDS, reports of REALTIME_WINDOWS(in minutes) are
+# rendered from it.
+REALTIME_WINDOW_SLOTS = 60
+REALTIME_SLOT_SECONDS = 60
+REALTIME_WINDOWS = (5, 15, 60)
+
+# Pages of the built-in HTTP server are rendered again when data changed, but not more than
+# once in SERVER_CACHE_SECONDS.
+SERVER_CACHE_SECONDS = 1
+
+# Metrics of the built-in HTTP server("/metrics"): upper bounds of duration histogram buckets in
+# seconds, and max number of url groups in labels, other groups are counted as "(other)".
+METRICS_BUCKETS = (0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+METRICS_MAX_GROUPS = 500
+
+# Requests data of every interval is appended to a segment file, segments of one day will be
+# merged when there are this many segments.
+MAX_SEGMENTS_PER_DAY = 12
+
+# Failed writing of a snapshot by "uwsgi-sloth start" is retried after this many seconds, until
+# written or stopping, snapshots are written in order.
+WRITER_RETRY_SECONDS = 10
+
+# Lines in uwsgi log are written after requests finished, so they are not strictly sorted by
+# datetime, seeking by datetime will go back this many seconds for safety.
+SEEK_DATETIME_SLACK = 60
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""Binary storage format for requests data and other stored models.
+
+A storage file is a JSON header followed by sections of fixed-width numeric arrays, so it
+can be read by ``array``/``mmap`` only, without unpickling any object:
+
+    magic(8 bytes) | version(uint32) | header length(uint32) | header(JSON) | sections
+
+Requests data is stored by columns: a string table of methods, url schemas and urls, then
+one array for every field of url groups, urls, sketches and time series. Urls of a url group
+are stored contiguously.
+
+Url groups are not loaded selectively: reports, merging and rollups all need every url group,
+so a file is always loaded as a whole, with its arrays read once.
+"""
+import gc
+import sys
+import json
+import mmap
+import math
+import struct
+import datetime
+from array import array
+
+from uwsgi_sloth.utils import atomic_write
+from uwsgi_sloth.structures import ValuesAggregation, TopURLsAggregation, QuantileSketch, TimeSeries
+
+STORAGE_MAGIC = b'SLOTHDB\x00'
+STORAGE_VERSION = 1
+# Version and header length are little-endian uint32
+PREAMBLE_FORMAT = '<II'
+PREAMBLE_SIZE = len(STORAGE_MAGIC) + struct.calcsize(PREAMBLE_FORMAT)
+SECTION_ALIGNMENT = 8
+STRING_SEPARATOR = '\n'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Fields of an aggregation table, values of "total", "min" and "max" are stored as int64 if
+# all of them are integers, otherwise as double with NaN for None.
+AGGREGATION_FIELDS = ('count', 'total', 'min', 'max')
+# Integer arrays are stored in the narrowest type of these
+INT_TYPECODES = ('b', 'h', 'i')
+
+
+class InvalidStorageFile(Exception):
+    pass
+
+
+def is_storage_file(file_path):
+    try:
+        with open(file_path, 'rb') as fp:
+            return fp.read(len(STORAGE_MAGIC)) == STORAGE_MAGIC
+    except OSError:
+        return False
+
+
+def pack_numbers(values):
+    """Pack numbers to the narrowest integer array which holds them, or a double array if
+    there are floats or None"""
+    try:
+        result = array('q', values)
+    except TypeError:
+        return array('d', [float('nan') if value is None else value for value in values])
+    except OverflowError:
+        return array('d', values)
+    if result:
+        low, high = min(result), max(result)
+        for typecode in INT_TYPECODES:
+            limit = 1 << (array(typecode).itemsize * 8 - 1)
+            if -limit <= low and high < limit:
+                return array(typecode, result.tolist())
+    return result
+
+
+def pack_floats(values):
+    """Pack floats, they are packed as integers if all of them are integral"""
+    if all(value.is_integer() for value in values):
+        return pack_numbers([int(value) for value in values])
+    return array('d', values)
+
+
+def unpack_numbers(values):
+    """Unpack array from ``pack_numbers`` to a list"""
+    values = values.tolist()
+    if values and isinstance(values[0], float):
+        values = [None if math.isnan(value) else value for value in values]
+    return values
+
+
+def format_datetime(value):
+    return value.strftime(DATETIME_FORMAT) if value else None
+
+
+def parse_datetime(value):
+    return datetime.datetime.strptime(value, DATETIME_FORMAT) if value else None
+
+
+class StorageWriter(object):
+    """Writer of storage file, add arrays by ``add_section()`` and then ``write()``"""
+
+    def __init__(self, kind, header=None):
+        self.kind = kind
+        self.header = header or {}
+        self.sections = []
+
+    def add_section(self, name, values):
+        """Add a section, ``values`` is an ``array`` or bytes"""
+        self.sections.append((name, values))
+
+    def iter_chunks(self):
+        sections = {}
+        offset = 0
+        for name, values in self.sections:
+            typecode = values.typecode if isinstance(values, array) else 'B'
+            size = len(values) * values.itemsize if isinstance(values, array) else len(values)
+            sections[name] = [offset, size, typecode]
+            offset += size + (-size) % SECTION_ALIGNMENT
+
+        header = json.dumps({'kind': self.kind, 'byteorder': sys.byteorder, 'header': self.header,
+                             'sections': sections}, sort_keys=True).encode('utf-8')
+        header += b' ' * ((-PREAMBLE_SIZE - len(header)) % SECTION_ALIGNMENT)
+        yield STORAGE_MAGIC + struct.pack(PREAMBLE_FORMAT, STORAGE_VERSION, len(header)) + header
+        for _, values in self.sections:
+            data = values.tobytes() if isinstance(values, array) else values
+            yield data
+            if len(data) % SECTION_ALIGNMENT:
+                yield b'\x00' * ((-len(data)) % SECTION_ALIGNMENT)
+
+    def write(self, file_path):
+        """Write to file atomically"""
+        atomic_write(self.iter_chunks(), file_path)
+
+    def tobytes(self):
+        return b''.join(self.iter_chunks())
+
+
+class StorageFile(object):
+    """Reader of storage file, the file is mapped into memory and sections are read when
+    needed.
+
+    :param buffer: read from this bytes instead of the file, ``file_path`` is only used in
+                   error messages then
+    """
+
+    def __init__(self, file_path, kind=None, buffer=None):
+        self.file_path = file_path
+        if buffer is not None:
+            self.buffer = buffer
+        else:
+            with open(file_path, 'rb') as fp:
+                try:
+                    self.buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    raise InvalidStorageFile('Empty file: %s' % file_path)
+        try:
+            self.load_header(kind)
+        except BaseException:
+            self.close()
+            raise
+
+    def load_header(self, kind):
+        buf = self.buffer
+        if len(buf) < PREAMBLE_SIZE or buf[:len(STORAGE_MAGIC)] != STORAGE_MAGIC:
+            raise InvalidStorageFile('Not a storage file: %s' % self.file_path)
+        version, header_size = struct.unpack(PREAMBLE_FORMAT, buf[len(STORAGE_MAGIC):PREAMBLE_SIZE])
+        if version != STORAGE_VERSION:
+            raise InvalidStorageFile('Unsupported storage version %s: %s' % (version, self.file_path))
+        try:
+            meta = json.loads(buf[PREAMBLE_SIZE:PREAMBLE_SIZE + header_size].decode('utf-8'))
+        except ValueError:
+            raise InvalidStorageFile('Broken header: %s' % self.file_path)
+        if kind is not None and meta['kind'] != kind:
+            raise InvalidStorageFile('Expected a "%s" file, got "%s": %s' % (
+                kind, meta['kind'], self.file_path))
+        self.kind = meta['kind']
+        self.header = meta['header']
+        self.sections = meta['sections']
+        self.swap_bytes = meta['byteorder'] != sys.byteorder
+        self.data_offset = PREAMBLE_SIZE + header_size
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_array(self, name, start=0, stop=None):
+        """Read items ``[start:stop]`` of an array section"""
+        offset, size, typecode = self.sections[name]
+        result = array(typecode)
+        itemsize = result.itemsize
+        length = size // itemsize
+        stop = length if stop is None else min(stop, length)
+        if start >= stop:
+            return result
+        begin = self.data_offset + offset + start * itemsize
+        if begin + (stop - start) * itemsize > len(self.buffer):
+            raise InvalidStorageFile('Truncated file: %s' % self.file_path)
+        result.frombytes(self.buffer[begin:begin + (stop - start) * itemsize])
+        if self.swap_bytes:
+            result.byteswap()
+        return result
+
+    def read_bytes(self, name, start=0, stop=None):
+        offset, size, _ = self.sections[name]
+        stop = size if stop is None else min(stop, size)
+        begin = self.data_offset + offset
+        return self.buffer[begin + start:begin + stop]
+
+
+def write_storage_file(file_path, kind, header):
+    """Write a storage file which contains a header only"""
+    StorageWriter(kind, header).write(file_path)
+
+
+def read_storage_header(file_path, kind):
+    with StorageFile(file_path, kind) as storage:
+        return storage.header
+
+
+# Requests data
+
+class RequestsDataWriter(StorageWriter):
+    """Writer of requests data, see ``RequestsDataFile`` for the layout"""
+    kind = 'requests_data'
+
+    def __init__(self, data, header=None):
+        super(RequestsDataWriter, self).__init__(self.kind, header)
+        self.sketches = []
+        self.series = []
+        self.add_data(data)
+
+    def add_data(self, data):
+        groups = list(data.get('data_details', {}).items())
+        strings = []
+        urls_starts, urls_counts, urls_limits, urls_floors, group_series = [], [], [], [], []
+        url_aggs, url_errors = [], []
+        for (method, url_schema), group_data in groups:
+            strings.append(method)
+            strings.append(url_schema)
+        for _, group_data in groups:
+            urls = group_data['urls']
+            urls_starts.append(len(url_aggs))
+            urls_counts.append(len(urls))
+            if isinstance(urls, TopURLsAggregation):
+                urls_limits.append(urls.limit)
+                urls_floors.append(urls.floor)
+                errors = urls.errors
+            else:
+                # Plain dict from older versions
+                urls_limits.append(-1)
+                urls_floors.append(0)
+                errors = {}
+            for url, agr in urls.items():
+                strings.append(url)
+                url_aggs.append(agr)
+                url_errors.append(errors.get(url, 0))
+            group_series.append(self.add_series(group_data.get('time_series')))
+
+        encoded = [value.encode('utf-8') for value in strings]
+        offsets = [0]
+        position = 0
+        for value in encoded:
+            position += len(value) + 1
+            offsets.append(position)
+        self.add_section('strings', STRING_SEPARATOR.encode('ascii').join(encoded))
+        self.add_section('string_offsets', pack_numbers(offsets))
+
+        self.add_aggregations('group', [group_data['duration_agr_data'] for _, group_data in groups])
+        self.add_section('group_urls_start', pack_numbers(urls_starts))
+        self.add_section('group_urls_count', pack_numbers(urls_counts))
+        self.add_section('group_urls_limit', pack_numbers(urls_limits))
+        self.add_section('group_urls_floor', pack_numbers(urls_floors))
+        self.add_section('group_series', pack_numbers(group_series))
+        self.add_aggregations('url', url_aggs)
+        self.add_section('url_error', pack_numbers(url_errors))
+        top_series = self.add_series(data.get('time_series'))
+        # Sketches of time series buckets are appended to the sketch table
+        self.add_series_sections()
+        self.add_sketches()
+
+        self.header = dict(self.header, data={
+            'exists': bool(data),
+            'requests_counter': data.get('requests_counter'),
+            'total_slow_duration': data.get('total_slow_duration'),
+            'datetime_range': [format_datetime(value) for value in data['datetime_range']]
+                              if 'datetime_range' in data else None,
+            'time_series': top_series,
+            'groups': len(groups),
+            'urls': len(url_aggs),
+        })
+
+    def add_aggregations(self, prefix, aggs):
+        self.add_section('%s_count' % prefix, pack_numbers([agr.count for agr in aggs]))
+        self.add_section('%s_total' % prefix, pack_numbers([agr.total for agr in aggs]))
+        self.add_section('%s_min' % prefix, pack_numbers([agr.min for agr in aggs]))
+        self.add_section('%s_max' % prefix, pack_numbers([agr.max for agr in aggs]))
+        self.add_section('%s_sketch' % prefix, pack_numbers([self.add_sketch(agr.sketch) for agr in aggs]))
+
+    def add_sketch(self, sketch):
+        """Returns index of sketch, -1 for None"""
+        if sketch is None:
+            return -1
+        self.sketches.append(sketch)
+        return len(self.sketches) - 1
+
+    def add_sketches(self):
+        sketches = self.sketches
+        starts, bucket_indexes, bucket_counts = [], [], []
+        for sketch in sketches:
+            starts.append(len(bucket_indexes))
+            bucket_indexes.extend(sketch.buckets.keys())
+            bucket_counts.extend(sketch.buckets.values())
+        self.add_section('sketch_accuracy', array('d', [s.relative_accuracy for s in sketches]))
+        self.add_section('sketch_max_buckets', pack_numbers([s.max_buckets for s in sketches]))
+        self.add_section('sketch_zero_count', pack_numbers([s.zero_count for s in sketches]))
+        self.add_section('sketch_count', pack_numbers([s.count for s in sketches]))
+        self.add_section('sketch_buckets_start', pack_numbers(starts))
+        self.add_section('sketch_buckets_count', pack_numbers([len(s.buckets) for s in sketches]))
+        self.add_section('sketch_bucket_index', pack_numbers(bucket_indexes))
+        self.add_section('sketch_bucket_count', pack_numbers(bucket_counts))
+
+    def add_series(self, series):
+        """Returns index of time series, -1 for None"""
+        if series is None:
+            return -1
+        self.series.append(series)
+        return len(self.series) - 1
+
+    def add_series_sections(self):
+        starts, sketch_starts = [], []
+        counts, totals, maxes = [], [], []
+        for series in self.series:
+            starts.append(len(counts))
+            counts.extend(series.counts)
+            totals.extend(series.totals)
+            maxes.extend(series.maxes)
+            if series.sketches is None:
+                sketch_starts.append(-1)
+            else:
+                sketch_starts.append(len(self.sketches))
+                self.sketches.extend(series.sketches)
+        self.add_section('series_bucket_seconds', pack_numbers([s.bucket_seconds for s in self.series]))
+        self.add_section('series_max_buckets', pack_numbers([s.max_buckets for s in self.series]))
+        self.add_section('series_start', pack_numbers([s.start for s in self.series]))
+        self.add_section('series_buckets_start', pack_numbers(starts))
+        self.add_section('series_buckets_count', pack_numbers([len(s.counts) for s in self.series]))
+        self.add_section('series_sketches_start', pack_numbers(sketch_starts))
+        self.add_section('series_counts', pack_numbers(counts))
+        self.add_section('series_totals', pack_floats(totals))
+        self.add_section('series_maxes', pack_floats(maxes))
+
+
+class RequestsDataFile(StorageFile):
+    """Reader of requests data file.
+
+    Url groups are rows of "group_*" arrays, urls of group ``i`` are rows
+    ``[group_urls_start[i], group_urls_start[i] + group_urls_count[i])`` of "url_*" arrays.
+    Strings are methods and url schemas of all groups, then urls in the same order as rows.
+    Sketches and time series are referenced by indexes, -1 for None.
+    """
+
+    def __init__(self, file_path, buffer=None):
+        super(RequestsDataFile, self).__init__(file_path, RequestsDataWriter.kind, buffer)
+        self.data_header = self.header.pop('data')
+        self.groups_count = self.data_header['groups']
+        self.sketch_cache = {}
+
+    def read_strings(self, start, stop):
+        """Read strings ``[start:stop]`` of the string table"""
+        offsets = self.read_array('string_offsets', start, stop + 1)
+        if len(offsets) < 2:
+            return []
+        blob = self.read_bytes('strings', offsets[0], offsets[-1] - 1).decode('utf-8')
+        strings = blob.split(STRING_SEPARATOR)
+        if len(strings) == stop - start:
+            return strings
+        # Some strings contain the separator
+        base = offsets[0]
+        blob = blob.encode('utf-8')
+        return [blob[offsets[i] - base:offsets[i + 1] - base - 1].decode('utf-8')
+                for i in range(len(offsets) - 1)]
+
+    def get_url_groups(self):
+        """Keys of all url groups in stored order"""
+        names = self.read_strings(0, self.groups_count * 2)
+        return list(zip(names[::2], names[1::2]))
+
+    def load(self):
+        """Load requests data"""
+        header = self.data_header
+        if not header['exists']:
+            return {}
+        data = {
+            'requests_counter': header['requests_counter'],
+            'total_slow_duration': header['total_slow_duration'],
+            'data_details': self.load_url_groups(),
+        }
+        if header['datetime_range'] is not None:
+            data['datetime_range'] = [parse_datetime(value) for value in header['datetime_range']]
+        if header['time_series'] >= 0:
+            data['time_series'] = self.load_series(header['time_series'])
+        return data
+
+    def load_url_groups(self):
+        # Millions of objects are created without reference cycles, garbage collection
+        # would be triggered many times for nothing
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load_url_groups()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load_url_groups(self):
+        keys = self.get_url_groups()
+        if not keys:
+            return {}
+
+        groups = dict((name, self.read_array('group_%s' % name)) for name in
+                      AGGREGATION_FIELDS + ('sketch', 'urls_start', 'urls_count', 'urls_limit',
+                                            'urls_floor', 'series'))
+        group_aggs = self.make_aggregations(groups, range(len(keys)))
+        floors = unpack_numbers(groups['urls_floor'])
+        url_rows = self.read_url_rows(0, self.data_header['urls'])
+
+        data_details = {}
+        for i, agr in enumerate(group_aggs):
+            start, count = groups['urls_start'][i], groups['urls_count'][i]
+            rows = [column[start:start + count] for column in url_rows]
+            urls_list, url_aggs, errors = rows[0], self.make_url_aggregations(rows), rows[-1]
+            limit = groups['urls_limit'][i]
+            if limit < 0:
+                urls = dict(zip(urls_list, url_aggs))
+            else:
+                urls = TopURLsAggregation(limit)
+                urls.update(zip(urls_list, url_aggs))
+                urls.floor = floors[i]
+                urls.errors = dict((url, error) for url, error in zip(urls_list, errors) if error)
+            group_data = {'urls': urls, 'duration_agr_data': agr}
+            if groups['series'][i] >= 0:
+                group_data['time_series'] = self.load_series(groups['series'][i])
+            data_details[keys[i]] = group_data
+        return data_details
+
+    def read_url_rows(self, start, stop):
+        """Read url rows as lists: urls, columns of aggregations, sketches and errors"""
+        base = self.groups_count * 2
+        rows = [self.read_strings(base + start, base + stop)]
+        for name in AGGREGATION_FIELDS:
+            rows.append(unpack_numbers(self.read_array('url_%s' % name, start, stop)))
+        rows.append(self.read_array('url_sketch', start, stop).tolist())
+        rows.append(unpack_numbers(self.read_array('url_error', start, stop)))
+        return rows
+
+    def make_url_aggregations(self, rows):
+        new = ValuesAggregation.__new__
+        aggs = []
+        append = aggs.append
+        for count, total, min_value, max_value in zip(*rows[1:5]):
+            agr = new(ValuesAggregation)
+            agr.count = count
+            agr.total = total
+            agr.min = min_value
+            agr.max = max_value
+            agr.sketch = None
+            append(agr)
+        # Urls have no sketches usually
+        for agr, sketch in zip(aggs, rows[5]):
+            if sketch >= 0:
+                agr.sketch = self.load_sketch(sketch)
+        return aggs
+
+    def make_aggregations(self, columns, indexes):
+        values = [unpack_numbers(columns[name]) for name in AGGREGATION_FIELDS]
+        aggs = []
+        for i in indexes:
+            agr = ValuesAggregation.__new__(ValuesAggregation)
+            agr.count, agr.total, agr.min, agr.max = [column[i] for column in values]
+            sketch = columns['sketch'][i]
+            agr.sketch = self.load_sketch(sketch) if sketch >= 0 else None
+            aggs.append(agr)
+        return aggs
+
+    def load_sketch(self, index):
+        columns = self.sketch_cache.get('columns')
+        if columns is None:
+            columns = self.sketch_cache['columns'] = dict(
+                (name, self.read_array('sketch_%s' % name).tolist()) for name in
+                ('accuracy', 'max_buckets', 'zero_count', 'count', 'buckets_start', 'buckets_count'))
+        sketch = QuantileSketch(columns['accuracy'][index], columns['max_buckets'][index])
+        sketch.zero_count = columns['zero_count'][index]
+        sketch.count = columns['count'][index]
+        start = columns['buckets_start'][index]
+        stop = start + columns['buckets_count'][index]
+        sketch.buckets = dict(zip(self.read_array('sketch_bucket_index', start, stop),
+                                  self.read_array('sketch_bucket_count', start, stop)))
+        return sketch
+
+    def load_series(self, index):
+        def value(name):
+            return self.read_array('series_%s' % name, index, index + 1)[0]
+
+        series = TimeSeries(value('bucket_seconds'), value('max_buckets'))
+        series.start = unpack_numbers(self.read_array('series_start', index, index + 1))[0]
+        start = value('buckets_start')
+        stop = start + value('buckets_count')
+        series.counts = array('l', self.read_array('series_counts', start, stop).tolist())
+        series.totals = array('d', self.read_array('series_totals', start, stop).tolist())
+        series.maxes = array('d', self.read_array('series_maxes', start, stop).tolist())
+        sketches_start = value('sketches_start')
+        if sketches_start >= 0:
+            series.sketches = [self.load_sketch(sketches_start + i) for i in range(stop - start)]
+        return series
+
+
+def write_requests_data(file_path, data, header=None):
+    """Write requests data to file atomically, ``header`` is an optional JSON serializable dict"""
+    RequestsDataWriter(data, header).write(file_path)
+
+
+def read_requests_data(file_path, buffer=None):
+    """Read requests data from file, or from ``buffer`` if given
+
+    :returns: (header, data)
+    """
+    with RequestsDataFile(file_path, buffer) as storage:
+        return storage.header, storage.load()
+
+
+def read_requests_data_header(file_path):
+    with RequestsDataFile(file_path) as storage:
+        return storage.header
@@ -1,15 +1,100 @@
 # -*- coding: utf-8 -*-
 """Useful data structures"""
+import math
+import datetime
+from array import array
+
+from uwsgi_sloth.settings import SKETCH_RELATIVE_ACCURACY, SKETCH_MAX_BUCKETS, MAX_URLS_PER_GROUP, \
+                                 TIME_SERIES_BUCKET_SECONDS, TIME_SERIES_MAX_BUCKETS
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch with relative accuracy, based on DDSketch: values are counted
+    in logarithmic buckets, so the memory is decided by the range of values instead of the
+    number of values.
+
+    When there are more than ``max_buckets`` buckets, lowest buckets will be collapsed into
+    one, accuracy of high quantiles will not be affected.
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'max_buckets', 'buckets',
+                 'zero_count', 'count')
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_buckets=SKETCH_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add_value(self, value):
+        self.count += 1
+        # Non-positive values are counted as zero
+        if value <= 0:
+            self.zero_count += 1
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        """Collapse lowest buckets"""
+        indexes = sorted(self.buckets)
+        to_index = indexes[len(indexes) - self.max_buckets]
+        self.buckets[to_index] = sum(self.buckets.pop(i) for i in indexes if i <= to_index)
+
+    def get_quantile(self, q):
+        """Get estimated value of quantile ``q``(0 <= q <= 1), relative error of the result is
+        lower than ``relative_accuracy``."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def merge_with(self, other):
+        """Merge this ``QuantileSketch`` with another one"""
+        if self.relative_accuracy != other.relative_accuracy:
+            raise ValueError('Can not merge sketches with different relative accuracy')
+        result = QuantileSketch(self.relative_accuracy, max(self.max_buckets, other.max_buckets))
+        result.buckets = dict(self.buckets)
+        for index, count in other.buckets.items():
+            result.buckets[index] = result.buckets.get(index, 0) + count
+        result.zero_count = self.zero_count + other.zero_count
+        result.count = self.count + other.count
+        if len(result.buckets) > result.max_buckets:
+            result.collapse()
+        return result
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
 
 class ValuesAggregation(object):
-    """For response time analyze"""
+    """For response time analyze
 
-    def __init__(self, values=[]):
+    :param with_sketch: whether to keep a ``QuantileSketch`` for percentiles
+    """
+    # There may be millions of aggregations, use slots to save memory
+    __slots__ = ('min', 'max', 'total', 'count', 'sketch')
+
+    def __init__(self, values=[], with_sketch=False):
         self.min = None
         self.max = None
         self.total = 0
         self.count = 0
+        self.sketch = QuantileSketch() if with_sketch else None
         # Init with values
         for value in values:
             self.add_value(value)
@@ -21,6 +106,8 @@ class ValuesAggregation(object):
             self.max = value
         if self.min is None or value < self.min:
             self.min = value
+        if self.sketch is not None:
+            self.sketch.add_value(value)
 
     def add_values(self, values):
         for value in values:
@@ -39,8 +126,38 @@ class ValuesAggregation(object):
         result.count = self.count + other.count
         result.min = min(self.min, other.min)
         result.max = max(self.max, other.max)
+        # Percentiles are only available when both have sketches
+        if self.sketch is not None and other.sketch is not None:
+            result.sketch = self.sketch.merge_with(other.sketch)
         return result
 
+    def get_percentile(self, percent):
+        """Get estimated percentile, returns None if no sketch available"""
+        if self.sketch is None or not self.count:
+            return None
+        return min(max(self.sketch.get_quantile(percent / 100.0), self.min), self.max)
+
+    @property
+    def p50(self):
+        return self.get_percentile(50)
+
+    @property
+    def p95(self):
+        return self.get_percentile(95)
+
+    @property
+    def p99(self):
+        return self.get_percentile(99)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        # Aggregations pickled by older versions are plain ``__dict__`` without sketch
+        self.sketch = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def get_result(self):
         return {
             'min': self.min,
@@ -48,3 +165,226 @@ class ValuesAggregation(object):
             'avg': self.avg,
         }
 
+
+
+class TopURLsAggregation(dict):
+    """Aggregations of urls in one url group: {url: ValuesAggregation}, only urls with largest
+    total durations are kept so memory is bounded.
+
+    It works like the "Space-Saving" algorithm: urls will be pruned to ``limit`` when there are
+    more than ``2 * limit`` urls. ``floor`` is the largest total duration of pruned urls, a new
+    url may have been pruned before, so ``floor`` is recorded as its error and counted when
+    ranking urls for pruning. Urls whose total durations are greater than
+    ``group total / limit`` are guaranteed to be kept.
+
+    :param limit: max number of urls kept, 0 means no limit
+    """
+
+    def __init__(self, limit=MAX_URLS_PER_GROUP):
+        super(TopURLsAggregation, self).__init__()
+        self.limit = limit
+        self.floor = 0
+        self.errors = {}
+
+    def add_value(self, url, value):
+        agr = self.get(url)
+        if agr is None:
+            agr = self[url] = ValuesAggregation()
+            if self.floor:
+                self.errors[url] = self.floor
+        agr.add_value(value)
+        if self.limit and len(self) > 2 * self.limit:
+            self.prune()
+
+    def prune(self):
+        """Prune urls to ``limit``"""
+        errors = self.errors
+        urls = sorted(self, key=lambda url: self[url].total + errors.get(url, 0), reverse=True)
+        for url in urls[self.limit:]:
+            self.floor = max(self.floor, self.pop(url).total + errors.pop(url, 0))
+
+    def merge_from(self, other):
+        """Merge another urls aggregation into this one, this will modify the original object"""
+        other_floor = getattr(other, 'floor', 0)
+        other_errors = getattr(other, 'errors', {})
+        if self.floor or other_floor:
+            errors = {}
+            for url in set(self) | set(other):
+                error = self.errors.get(url, 0) + other_errors.get(url, 0)
+                # Url which is not in one side may have been pruned by that side
+                error += (self.floor if url not in self else 0) + (other_floor if url not in other else 0)
+                if error:
+                    errors[url] = error
+            self.errors = errors
+            self.floor += other_floor
+
+        for url, data in other.items():
+            if url not in self:
+                self[url] = data
+            else:
+                self[url] = self[url].merge_with(data)
+        if self.limit and len(self) > 2 * self.limit:
+            self.prune()
+
+    def copy(self):
+        result = TopURLsAggregation(self.limit)
+        result.update(self)
+        result.floor = self.floor
+        result.errors = dict(self.errors)
+        return result
+
+    @classmethod
+    def from_dict(cls, urls, limit=MAX_URLS_PER_GROUP):
+        """Make an aggregation from plain {url: ValuesAggregation} dict"""
+        result = cls(limit)
+        result.update(urls)
+        if result.limit and len(result) > 2 * result.limit:
+            result.prune()
+        return result
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def datetime_to_timestamp(value):
+    """Seconds since epoch of a naive datetime, it is faster than ``calendar.timegm``"""
+    return (value.toordinal() - EPOCH_ORDINAL) * 86400 + value.hour * 3600 + \
+        value.minute * 60 + value.second
+
+
+def timestamp_to_datetime(value):
+    return EPOCH + datetime.timedelta(seconds=value)
+
+
+class TimeSeries(object):
+    """Values aggregated in time buckets, counts/totals/maxes of buckets are stored in arrays.
+
+    When the time range needs more than ``max_buckets`` buckets, width of buckets will be
+    doubled by merging adjacent buckets, so the memory is bounded by ``max_buckets``.
+
+    :param with_sketch: whether to keep a ``QuantileSketch`` for every bucket
+    """
+    __slots__ = ('bucket_seconds', 'max_buckets', 'start', 'counts', 'totals', 'maxes', 'sketches')
+
+    def __init__(self, bucket_seconds=TIME_SERIES_BUCKET_SECONDS, max_buckets=TIME_SERIES_MAX_BUCKETS,
+                 with_sketch=False):
+        self.bucket_seconds = bucket_seconds
+        self.max_buckets = max_buckets
+        # Timestamp of the first bucket
+        self.start = None
+        self.counts = array('l')
+        self.totals = array('d')
+        self.maxes = array('d')
+        self.sketches = [] if with_sketch else None
+
+    @property
+    def end(self):
+        """Timestamp after the last bucket"""
+        return self.start + len(self.counts) * self.bucket_seconds
+
+    def add_value(self, timestamp, value):
+        """Add value at ``timestamp``(seconds since epoch)"""
+        if self.start is None:
+            self.start = timestamp - timestamp % self.bucket_seconds
+        index = (timestamp - self.start) // self.bucket_seconds
+        if index < 0 or index >= len(self.counts):
+            index = self.extend_to(timestamp)
+        self.counts[index] += 1
+        self.totals[index] += value
+        if value > self.maxes[index]:
+            self.maxes[index] = value
+        if self.sketches is not None:
+            self.sketches[index].add_value(value)
+
+    def extend_to(self, timestamp):
+        """Extend buckets to cover ``timestamp``, returns index of the bucket"""
+        while True:
+            start = min(self.start, timestamp - timestamp % self.bucket_seconds)
+            end = max(self.end, timestamp - timestamp % self.bucket_seconds + self.bucket_seconds)
+            if (end - start) // self.bucket_seconds <= self.max_buckets:
+                break
+            self.downsample()
+
+        head = (self.start - start) // self.bucket_seconds
+        tail = (end - self.end) // self.bucket_seconds
+        self.counts = array('l', [0] * head) + self.counts + array('l', [0] * tail)
+        self.totals = array('d', [0] * head) + self.totals + array('d', [0] * tail)
+        self.maxes = array('d', [0] * head) + self.maxes + array('d', [0] * tail)
+        if self.sketches is not None:
+            self.sketches = [QuantileSketch() for _ in range(head)] + self.sketches + \
+                [QuantileSketch() for _ in range(tail)]
+        self.start = start
+        return (timestamp - start) // self.bucket_seconds
+
+    def downsample(self):
+        """Double the width of buckets"""
+        bucket_seconds = self.bucket_seconds * 2
+        start = self.start - self.start % bucket_seconds
+        offset = (self.start - start) // self.bucket_seconds
+        size = (len(self.counts) + offset + 1) // 2
+        counts, totals, maxes = array('l', [0] * size), array('d', [0] * size), array('d', [0] * size)
+        sketches = [None] * size if self.sketches is not None else None
+        for i in range(len(self.counts)):
+            j = (i + offset) // 2
+            counts[j] += self.counts[i]
+            totals[j] += self.totals[i]
+            maxes[j] = max(maxes[j], self.maxes[i])
+            if sketches is not None:
+                sketch = self.sketches[i]
+                sketches[j] = sketch if sketches[j] is None else sketches[j].merge_with(sketch)
+        self.bucket_seconds, self.start = bucket_seconds, start
+        self.counts, self.totals, self.maxes, self.sketches = counts, totals, maxes, sketches
+
+    def merge_with(self, other):
+        """Merge this ``TimeSeries`` with another one, bucket widths of both must be the same
+        or be different by powers of two."""
+        result = TimeSeries(self.bucket_seconds, self.max_buckets,
+                            with_sketch=self.sketches is not None and other.sketches is not None)
+        for series in (self, other):
+            if series.start is None:
+                continue
+            while result.bucket_seconds < series.bucket_seconds:
+                if result.start is None:
+                    result.bucket_seconds *= 2
+                else:
+                    result.downsample()
+            for i, count in enumerate(series.counts):
+                if not count:
+                    continue
+                timestamp = series.start + i * series.bucket_seconds
+                if result.start is None:
+                    result.start = timestamp - timestamp % result.bucket_seconds
+                index = (timestamp - result.start) // result.bucket_seconds
+                if index < 0 or index >= len(result.counts):
+                    index = result.extend_to(timestamp)
+                result.counts[index] += count
+                result.totals[index] += series.totals[i]
+                result.maxes[index] = max(result.maxes[index], series.maxes[i])
+                if result.sketches is not None:
+                    result.sketches[index] = result.sketches[index].merge_with(series.sketches[i])
+        return result
+
+    def get_points(self):
+        """Get all buckets as dicts, ordered by time"""
+        points = []
+        for i, count in enumerate(self.counts):
+            point = {
+                'datetime': timestamp_to_datetime(self.start + i * self.bucket_seconds),
+                'count': count,
+                'total': self.totals[i],
+                'avg': self.totals[i] / count if count else 0,
+                'max': self.maxes[i],
+                'p95': None,
+            }
+            if count and self.sketches is not None:
+                point['p95'] = min(self.sketches[i].get_quantile(0.95), self.maxes[i])
+            points.append(point)
+        return points
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
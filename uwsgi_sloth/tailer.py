@@ -3,6 +3,9 @@
 import os
 import re
 import time
+import ctypes
+import ctypes.util
+import select
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,34 +17,103 @@ class NoNewLine(object):
 no_new_line = NoNewLine()
 
 
+class PollingWatcher(object):
+    """Wait for changes of file by sleeping"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Wait for changes of file using inotify, only available on Linux.
+
+    The directory of file is watched, so creating a new file after rotation is also noticed.
+    """
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, file_path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        directory = os.path.dirname(os.path.abspath(file_path))
+        mask = self.IN_MODIFY | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno))
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # Events are not needed, just drain them
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(file_path):
+    """Create a file watcher, use inotify if possible"""
+    try:
+        return InotifyWatcher(file_path)
+    except (OSError, AttributeError, TypeError) as e:
+        logger.info('inotify is not available(%s), fallback to polling.' % e)
+        return PollingWatcher()
+
+
 class Tailer(object):
     """Implements tailing and heading functionality like GNU tail and head
-    commands.
+    commands. File is read in binary mode, all lines are bytes.
     """
-    line_terminators = ('\r\n', '\n', '\r')
+    line_terminators = (b'\r\n', b'\n', b'\r')
     DEFAULT_BLOCK_SIZE = 4096
-    MAX_UNCHANGED_STATS = 5
+    FOLLOW_BLOCK_SIZE = 1024 * 1024
 
     def __init__(self, file, read_size=DEFAULT_BLOCK_SIZE, end=False):
         if isinstance(file, str):
-            file = open(file, 'r')
+            file = open(file, 'rb')
 
         self.should_stop_follow = False
         self.read_size = read_size
+        # Data which has been read but not returned as a line by ``follow``
+        self.buffer = b''
         self.file = file
         self.start_pos = self.file.tell()
         if end:
             self.seek_end()
     
     def splitlines(self, data):
-        return re.split('|'.join(self.line_terminators), data)
+        return re.split(b'|'.join(self.line_terminators), data)
 
     def seek_end(self):
         self.seek(0, 2)
 
     def seek(self, pos, whence=0):
+        self.buffer = b''
         self.file.seek(pos, whence)
 
+    def tell(self):
+        """Position of the first byte not returned by ``follow``"""
+        return self.file.tell() - len(self.buffer)
+
     def read(self, read_size=None):
         if read_size:
             read_str = self.file.read(read_size)
@@ -60,7 +132,7 @@ class Tailer(object):
         bytes_read, read_str = self.read(self.read_size)
 
         start = 0
-        if bytes_read and read_str[0] in self.line_terminators:
+        if bytes_read and read_str[0:1] in self.line_terminators:
             # The first charachter is a line terminator, don't count this one
             start += 1
 
@@ -68,7 +140,7 @@ class Tailer(object):
             # Scan forwards, counting the newlines in this bufferfull
             i = start
             while i < bytes_read:
-                if read_str[i] in self.line_terminators:
+                if read_str[i:i + 1] in self.line_terminators:
                     self.seek(pos + i + 1)
                     return self.file.tell()
                 i += 1
@@ -98,11 +170,11 @@ class Tailer(object):
 
         bytes_read, read_str = self.read(read_size)
 
-        if bytes_read and read_str[-1] in self.line_terminators:
+        if bytes_read and read_str[-1:] in self.line_terminators:
             # The last charachter is a line terminator, don't count this one
             bytes_read -= 1
 
-            if read_str[-2:] == '\r\n' and '\r\n' in self.line_terminators:
+            if read_str[-2:] == b'\r\n' and b'\r\n' in self.line_terminators:
                 # found crlf
                 bytes_read -= 1
 
@@ -110,7 +182,7 @@ class Tailer(object):
             # Scan backward, counting the newlines in this bufferfull
             i = bytes_read - 1
             while i >= 0:
-                if read_str[i] in self.line_terminators:
+                if read_str[i:i + 1] in self.line_terminators:
                     self.seek(pos + i + 1)
                     return self.file.tell()
                 i -= 1
@@ -127,6 +199,37 @@ class Tailer(object):
 
         return None
   
+    def seek_datetime(self, target, get_datetime):
+        """\
+        Binary search for the position of first line whose datetime is greater than
+        ``target``, lines must be sorted by datetime. The file position will be at the
+        beginning of a line not after that line.
+
+        ``get_datetime`` is a function which returns datetime of given line, or None if
+        line has no datetime.
+        """
+        self.seek_end()
+        low, high = 0, self.file.tell()
+
+        while high - low > self.read_size:
+            middle = (low + high) // 2
+            self.seek(middle)
+            line_datetime = None
+            if self.seek_line_forward() is not None:
+                # Skip lines which have no datetime
+                while line_datetime is None and self.file.tell() < high:
+                    line_datetime = get_datetime(self.file.readline())
+
+            if line_datetime is not None and line_datetime <= target:
+                low = middle
+            else:
+                high = middle
+
+        self.seek(low)
+        if low:
+            self.seek_line()
+        return self.file.tell()
+
     def tail(self, lines=10):
         """\
         Return the last lines of the file.
@@ -166,48 +269,73 @@ class Tailer(object):
 
     def follow(self, delay=1.0):
         """\
-        Iterator generator that returns lines as data is added to the file.
+        Iterator generator that returns lines as data is added to the file, ``no_new_line``
+        will be returned every time reaching the end of file.
 
-        Based on: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/157035
+        Data is read in big blocks, waiting for new data by inotify if possible. When the file
+        was rotated(inode changed) or truncated, the rest of old file will be read before
+        following the new one.
         """
-        # TODO: Handle log file rotation
         self.trailing = True
-        unchanged_stats = 0
-        
-        while not self.should_stop_follow:
-            where = self.file.tell()
-            line = self.file.readline()
-            if line:    
-                if self.trailing and line in self.line_terminators:
-                    # This is just the line terminator added to the end of the file
-                    # before a new line, ignore.
+        watcher = create_watcher(self.file.name)
+        try:
+            while not self.should_stop_follow:
+                lines = self.read_lines()
+                if lines:
                     self.trailing = False
+                    for line in lines:
+                        yield line
                     continue
 
-                if line[-1] in self.line_terminators:
-                    line = line[:-1]
-                    if line[-1:] == '\r\n' and '\r\n' in self.line_terminators:
-                        # found crlf
-                        line = line[:-1]
-
-                self.trailing = False
-                unchanged_stats = 0
-                yield line
-            else:
                 self.trailing = True
-                self.seek(where)
                 yield no_new_line
-                # Try to catch up rotated log file
-                unchanged_stats += 1
-                if unchanged_stats >= self.MAX_UNCHANGED_STATS and \
-                        where != os.stat(self.file.name).st_size:
-                    logger.info('Reopen log file because file may has been rotated.')
-                    self.reopen_file()
+                if self.should_stop_follow:
+                    break
 
-                time.sleep(delay)
+                if self.is_rotated():
+                    # Read the rest of old file
+                    self.trailing = False
+                    lines = self.read_lines()
+                    while lines:
+                        for line in lines:
+                            yield line
+                        lines = self.read_lines()
+                    if self.buffer:
+                        yield self.buffer
+                    logger.info('Reopen log file because file has been rotated.')
+                    self.reopen_file()
+                    continue
+                watcher.wait(delay)
+        finally:
+            watcher.close()
+
+    def read_lines(self):
+        """Read lines from current position in big blocks, incomplete last line will be kept
+        in buffer."""
+        lines = []
+        while not lines:
+            data = self.file.read(self.FOLLOW_BLOCK_SIZE)
+            if not data:
+                break
+            lines = (self.buffer + data).split(b'\n')
+            self.buffer = lines.pop()
+        return [line[:-1] if line[-1:] == b'\r' else line for line in lines]
+
+    def is_rotated(self):
+        """Whether the file was rotated or truncated"""
+        try:
+            stat = os.stat(self.file.name)
+        except OSError:
+            # File removed, but new file has not been created yet
+            return False
+        fstat = os.fstat(self.file.fileno())
+        return (stat.st_ino, stat.st_dev) != (fstat.st_ino, fstat.st_dev) or \
+            stat.st_size < self.tell()
 
     def reopen_file(self):
-        self.file = open(self.file.name, 'r')
+        self.file.close()
+        self.file = open(self.file.name, 'rb')
+        self.buffer = b''
 
     def stop_follow(self):
         self.should_stop_follow = True
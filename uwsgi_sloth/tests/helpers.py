@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by tests"""
+
+LOG_LINE = ('[pid: 94153|app: 0|req: 51/51] 127.0.0.1 () {40 vars in 880 bytes} '
+            '[%s] %s %s => generated 16432 bytes in %s msecs (HTTP/1.1 %s) '
+            '4 headers in 285 bytes (4 switches on core 0)')
+DATETIME_FORMAT = '%a %b %d %H:%M:%S %Y'
+
+
+def make_log_line(request_datetime, url='/trips/1/', msecs=500, method='GET', status=200):
+    """Make a line of default uwsgi log format, without line terminator"""
+    return LOG_LINE % (request_datetime.strftime(DATETIME_FORMAT), method, url, msecs, status)
+
+
+def analyze_requests(analyzer, requests):
+    """Analyze lines of requests, every request is a tuple of arguments of ``make_log_line``
+
+    :returns: ``analyzer``
+    """
+    for request in requests:
+        analyzer.analyze_line(make_log_line(*request))
+    return analyzer
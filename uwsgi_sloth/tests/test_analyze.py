@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Test code for analyze command"""
+import datetime
+from argparse import Namespace
+from unittest import mock
+
+import pytest
+
+from uwsgi_sloth.commands.analyze import split_file_ranges, analyze_log, analyze_log_parallel, \
+    analyze_files, analyze_single_file, expand_file_paths
+from uwsgi_sloth.cache import ResultCache, make_cache_options, get_file_info
+from uwsgi_sloth.analyzer import format_data
+from uwsgi_sloth.tests.helpers import make_log_line
+
+def make_line(i):
+    """Line of ``i``th request, with line terminator"""
+    return make_log_line(datetime.datetime(2014, 6, 24, 22, i % 60, 2),
+                         '/trips/%s/?query=3' % (i % 7), (i * 37) % 900) + '\n'
+
+
+def make_log_file(tmpdir, name='uwsgi.log', lines=range(500)):
+    log_file = tmpdir.join(name)
+    log_file.write(''.join(make_line(i) for i in lines))
+    return str(log_file)
+
+
+def test_split_file_ranges(tmpdir):
+    file_path = make_log_file(tmpdir)
+    ranges = split_file_ranges(file_path, 4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0
+    with open(file_path, 'rb') as fp:
+        content = fp.read()
+    assert ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert content[start - 1:start] == b'\n'
+
+
+def test_analyze_log_parallel(tmpdir):
+    file_path = make_log_file(tmpdir)
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    with open(file_path, 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+    parallel_data = analyze_log_parallel(file_path, configs, [], 3)
+
+    assert parallel_data['requests_counter'] == data['requests_counter']
+    assert parallel_data['total_slow_duration'] == data['total_slow_duration']
+    assert parallel_data['datetime_range'] == data['datetime_range']
+    assert list(parallel_data['time_series'].counts) == list(data['time_series'].counts)
+    formatted, parallel_formatted = format_data(data), format_data(parallel_data)
+    assert parallel_formatted['trend_chart']['line'] == formatted['trend_chart']['line']
+    assert [(k, v['duration_agr_data'].get_result()) for k, v in parallel_formatted['data_details']] == \
+           [(k, v['duration_agr_data'].get_result()) for k, v in formatted['data_details']]
+
+
+def test_expand_file_paths(tmpdir):
+    for name in ('uwsgi.log.2', 'uwsgi.log', 'uwsgi.log.1'):
+        make_log_file(tmpdir, name)
+    pattern = str(tmpdir.join('uwsgi.log*'))
+    assert expand_file_paths([pattern, str(tmpdir.join('uwsgi.log'))]) == \
+        [str(tmpdir.join(name)) for name in ('uwsgi.log', 'uwsgi.log.1', 'uwsgi.log.2')]
+    with pytest.raises(ValueError):
+        expand_file_paths([str(tmpdir.join('missing.log'))])
+
+
+def test_analyze_files(tmpdir):
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    with open(make_log_file(tmpdir), 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+    # Rotated files, passed in reversed order
+    file_paths = [make_log_file(tmpdir, 'uwsgi.log.%s' % i, range(i * 100, i * 100 + 100))
+                  for i in reversed(range(5))]
+    cache = ResultCache(str(tmpdir.join('cache')), make_cache_options(200, 1000, []))
+    for _ in range(2):
+        files_data = analyze_files(file_paths, configs, [], 2, cache=cache)
+        assert files_data['requests_counter'] == data['requests_counter']
+        assert files_data['total_slow_duration'] == data['total_slow_duration']
+        assert files_data['datetime_range'] == data['datetime_range']
+    for file_path in file_paths:
+        assert cache.lookup(file_path, get_file_info(file_path)) == (mock.ANY, None)
+
+    # Modified file will be analyzed again
+    make_log_file(tmpdir, 'uwsgi.log.0', range(10))
+    assert cache.lookup(file_paths[-1], get_file_info(file_paths[-1])) == (None, 0)
+
+
+def test_analyze_appended_file(tmpdir):
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    with open(make_log_file(tmpdir), 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+
+    cache = ResultCache(str(tmpdir.join('cache')), make_cache_options(200, 1000, []))
+    file_path = make_log_file(tmpdir, 'appended.log', range(300))
+    # The incomplete last line will not be cached
+    with open(file_path, 'a') as fp:
+        fp.write(make_line(300)[:50])
+    analyze_files([file_path], configs, [], 1, cache=cache)
+
+    with open(file_path, 'a') as fp:
+        fp.write(''.join(make_line(i) for i in range(300, 500))[50:])
+    cached_data, offset = cache.lookup(file_path, get_file_info(file_path))
+    assert offset == len(''.join(make_line(i) for i in range(300)))
+    appended_data = analyze_files([file_path], configs, [], 2, cache=cache)
+    assert appended_data['requests_counter'] == data['requests_counter']
+    assert appended_data['total_slow_duration'] == data['total_slow_duration']
+    assert appended_data['datetime_range'] == data['datetime_range']
+
+
+def test_analyze_file_without_last_terminator(tmpdir):
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    cache = ResultCache(str(tmpdir.join('cache')), make_cache_options(200, 1000, []))
+    log_file = tmpdir.join('uwsgi.log')
+    file_path = str(log_file)
+    log_lines = [make_line(i) for i in range(500)]
+    # Analyzed again without changes, then appended
+    for lines in (300, 300, 500):
+        log_file.write(''.join(log_lines[:lines]).rstrip('\n'))
+        data = analyze_single_file(file_path, configs, [], 1)
+        # Cached results are the same as analyzing without cache
+        cached_data = analyze_files([file_path], configs, [], 1, cache=cache)
+        assert data['requests_counter']['normal'] == lines
+        assert cached_data['requests_counter'] == data['requests_counter']
+        assert cached_data['total_slow_duration'] == data['total_slow_duration']
+        assert cached_data['datetime_range'] == data['datetime_range']
+
+
+def test_analyze_overlapped_files(tmpdir):
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    # Range of the second file is inside range of the first one, like logs of other hosts
+    file_paths = [make_log_file(tmpdir, 'host1.log', range(60)),
+                  make_log_file(tmpdir, 'host2.log', range(10, 20))]
+    with open(file_paths[0], 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+    assert analyze_files(file_paths, configs, [], 1)['datetime_range'] == data['datetime_range']
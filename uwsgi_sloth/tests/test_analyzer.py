@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 """Test code for ananlyzer"""
-from uwsgi_sloth.analyzer import UWSGILogParser, URLClassifier
+import datetime
+from unittest import mock
 
+from uwsgi_sloth.analyzer import UWSGILogParser, URLClassifier, LogAnalyzer, RealtimeLogAnalyzer, \
+    format_data
+from uwsgi_sloth.utils import parse_url_rules
+from uwsgi_sloth.tests.helpers import make_log_line
 
-class TestUWSGILogParser(object):
 
+class TestUWSGILogParser(object):
     @classmethod
     def setup_class(cls):
         cls.parser = UWSGILogParser()
@@ -20,6 +25,23 @@ class TestUWSGILogParser(object):
         assert valid_result['url'] == '/trips/hot/?query=3'
         assert valid_result['url_path'] == '/trips/hot/'
         assert valid_result['resp_time'] == 55
+        assert valid_result['request_datetime'] == datetime.datetime(2014, 6, 24, 22, 46, 2)
+        assert self.parser.parse(self.invalid_log_line) is None
+
+    def test_parse_filtered(self):
+        assert self.parser.parse(self.valid_log_line.replace('HTTP/1.1 200', 'HTTP/1.1 404')) is None
+        assert self.parser.parse(self.valid_log_line.replace('] GET', '] HEAD')) is None
+
+    def test_parse_bytes(self):
+        assert self.parser.parse(self.valid_log_line.encode('utf-8')) == \
+            self.parser.parse(self.valid_log_line)
+        assert self.parser.parse(b'INVALID LOG LINE') is None
+        invalid_utf8_line = self.valid_log_line.encode('utf-8').replace(b'hot', b'h\xff\xfe')
+        assert self.parser.parse(invalid_utf8_line)['url_path'] == '/trips/h\ufffd\ufffd/'
+
+    def test_parse_datetime(self):
+        assert self.parser.parse_datetime('Tue Jun  4 22:46:02 2014') == \
+            datetime.datetime(2014, 6, 4, 22, 46, 2)
 
 
 class TestURLClassifier(object):
@@ -34,3 +56,101 @@ class TestURLClassifier(object):
     def test_classify_trailing_digits(self):
         path = self.url_classifier.classify('/trips/hot/42')
         assert path == '/trips/hot/(\d+)/'
+
+    def test_classify_cache(self):
+        url_classifier = URLClassifier(cache_size=2)
+        for path in ('/a/1/', '/a/1/', '/b/2/', '/c/3/', '/a/1/'):
+            assert url_classifier.classify(path).endswith('/(\d+)/')
+        assert url_classifier.cache_hits == 1
+        assert url_classifier.cache_misses == 4
+        assert len(url_classifier.cache) == 2
+
+
+class TestURLClassifierUserRules(object):
+    rules = [
+        r'^club/(?P<place>\w+)/(?P<year>\d+)/signup/$',
+        r'^club/(?P<place>\w+)/',
+        r'^club/signup/success/$',
+    ]
+
+    def test_combined_rules(self):
+        url_classifier = URLClassifier(parse_url_rules(self.rules))
+        assert url_classifier.re_combined_rules is not None
+        assert url_classifier.classify('/club/beijing/2014/signup/') == self.rules[0]
+        assert url_classifier.classify('/club/beijing/') == self.rules[1]
+        assert url_classifier.classify('/club/signup/success/') == self.rules[1]
+        assert url_classifier.classify('/trips/42/') == '/trips/(\d+)/'
+
+    def test_uncombinable_rules(self):
+        url_classifier = URLClassifier(parse_url_rules([r'^(?P<a>\w)(?P=a)/$', r'^foo/']))
+        assert url_classifier.re_combined_rules is None
+        assert url_classifier.classify('/xx/') == r'^(?P<a>\w)(?P=a)/$'
+        assert url_classifier.classify('/foo/') == r'^foo/'
+
+
+def test_format_data():
+    analyzer = LogAnalyzer(min_msecs=0)
+    request_datetime = datetime.datetime(2014, 6, 24, 22, 46, 2)
+    for i in range(100):
+        path = '/trips/%s/' % (i % 3) if i % 2 else '/other/'
+        analyzer.analyze_line(make_log_line(request_datetime, '%s?query=%s' % (path, i), i))
+    raw_data = analyzer.get_data()
+    cache = {}
+    data = format_data(raw_data, limit_per_url_group=2, limit_url_groups=3, cache=cache)
+    assert data['requests_counter'] == {'normal': 100, 'slow': 100}
+    assert [k for k, v in data['data_details']] == [('GET', '/trips/(\\d+)/'), ('GET', '/other/')]
+    urls = data['data_details'][0][1]['urls']
+    assert [url for url, _ in urls] == ['/trips/0/?query=99', '/trips/1/?query=97']
+    # raw data is not modified
+    assert isinstance(raw_data['data_details'][('GET', '/other/')]['urls'], dict)
+
+    # Top urls are reused when url group has no new requests
+    assert format_data(raw_data, 2, 3, cache=cache)['data_details'][0][1]['urls'] is urls
+    analyzer.analyze_line(make_log_line(request_datetime, '/trips/1/?query=1', 1))
+    assert format_data(raw_data, 2, 3, cache=cache)['data_details'][0][1]['urls'] is not urls
+
+
+def test_realtime_log_analyzer_window():
+    now = datetime.datetime.now().replace(microsecond=0)
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    # One request every minute in last 90 minutes, every fourth one is slow
+    for i in reversed(range(90)):
+        request_datetime = now - datetime.timedelta(minutes=i)
+        analyzer.analyze_line(make_log_line(request_datetime, '/trips/%s/' % i,
+                                            500 if i % 4 == 0 else 50))
+
+    for minutes in (5, 15, 60):
+        data = analyzer.get_window_data(minutes * 60, now)
+        assert data['requests_counter']['normal'] == minutes
+        assert data['requests_counter']['slow'] == len([i for i in range(minutes) if i % 4 == 0])
+
+    # Merging slots must not modify them
+    assert analyzer.get_window_data(15 * 60, now)['requests_counter'] == {'normal': 15, 'slow': 4}
+    assert sum(data['requests_counter']['normal'] for data in analyzer.data.values()) == 90
+
+
+def test_realtime_log_analyzer_snapshot():
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    analyzer.analyze_line(make_log_line(now))
+
+    days_data, slots = analyzer.take_snapshot()
+    assert analyzer.data == {}
+    assert days_data[analyzer.today_name]['requests_counter'] == {'normal': 1, 'slow': 1}
+
+    # Snapshot is not modified by analyzing
+    analyzer.analyze_line(make_log_line(now, '/trips/2/'))
+    assert days_data[analyzer.today_name]['requests_counter'] == {'normal': 1, 'slow': 1}
+    assert analyzer.get_window_data(300, now, slots=slots)['requests_counter'] == \
+        {'normal': 1, 'slow': 1}
+    assert analyzer.get_window_data(300, now)['requests_counter'] == {'normal': 2, 'slow': 2}
+
+
+def test_realtime_log_analyzer_future_lines():
+    future = datetime.datetime.now() + datetime.timedelta(days=2)
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    with mock.patch.object(analyzer, 'tick', wraps=analyzer.tick) as tick:
+        for i in range(10):
+            analyzer.analyze_line(make_log_line(future, '/trips/%s/' % i))
+        # Ticked only once for requests of the same future day
+        assert tick.call_count == 1
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Test code for compressed log files"""
+import io
+import bz2
+import gzip
+import lzma
+from argparse import Namespace
+
+import pytest
+
+from uwsgi_sloth.compression import detect_compression, open_decompressed, iter_line_blocks
+from uwsgi_sloth.commands.analyze import analyze_log
+from uwsgi_sloth.tests.test_analyze import make_log_file
+
+COMPRESSORS = {
+    'gzip': gzip.compress,
+    'bz2': bz2.compress,
+    'xz': lzma.compress,
+}
+
+
+def test_detect_compression():
+    for name, compress in COMPRESSORS.items():
+        fp = io.BufferedReader(io.BytesIO(compress(b'foo\n')))
+        assert detect_compression(fp) == name
+        assert fp.tell() == 0
+    assert detect_compression(io.BytesIO(b'[pid: 94153|app: 0|req: 51/51]')) is None
+    assert detect_compression(io.BytesIO(b'')) is None
+
+
+def test_iter_line_blocks():
+    content = b''.join(b'line %d\n' % i for i in range(1000)) + b'last'
+    fp = open_decompressed(io.BytesIO(gzip.compress(content)), 'gzip')
+    lines = [line for lines in iter_line_blocks(fp, block_size=100) for line in lines]
+    assert lines == content.split(b'\n')
+
+
+@pytest.mark.parametrize('name', sorted(COMPRESSORS))
+def test_analyze_compressed_log(tmpdir, name):
+    file_path = make_log_file(tmpdir)
+    with open(file_path, 'rb') as fp:
+        content = fp.read()
+    compressed_path = tmpdir.join('uwsgi.log.compressed')
+    compressed_path.write_binary(COMPRESSORS[name](content))
+
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    with open(file_path, 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+    with open(str(compressed_path), 'rb') as fp:
+        compressed_data = analyze_log(fp, configs, [])
+
+    assert compressed_data['requests_counter'] == data['requests_counter']
+    assert compressed_data['total_slow_duration'] == data['total_slow_duration']
+    assert compressed_data['datetime_range'] == data['datetime_range']
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Test code for exports and merging exports of many hosts"""
+import json
+import datetime
+from argparse import Namespace
+
+import pytest
+
+from uwsgi_sloth.analyzer import LogAnalyzer
+from uwsgi_sloth.export import write_export, read_export, make_export_header, InvalidExport
+from uwsgi_sloth.commands.merge import merge_exports, merge
+from uwsgi_sloth.tests.helpers import analyze_requests
+
+
+def make_export(tmpdir, host, count, resp_time):
+    """Export of a host, every host has its own directory"""
+    request_datetime = datetime.datetime(2014, 6, 24, 12, count)
+    data = analyze_requests(LogAnalyzer(min_msecs=200), [
+        (request_datetime, '/trips/%s/' % i, resp_time) for i in range(count)]).get_data()
+    file_path = str(tmpdir.mkdir(host).join('2014-06-24.export'))
+    write_export(file_path, data, make_export_header(host, {'min_msecs': 200},
+                                                     data['datetime_range']))
+    return file_path
+
+
+def test_export(tmpdir):
+    file_path = make_export(tmpdir, 'web-1', 3, 300)
+    header, data = read_export(file_path)
+    assert header['host'] == 'web-1'
+    assert header['datetime_range'] == ['2014-06-24T12:03:00', '2014-06-24T12:03:00']
+    assert data['requests_counter'] == {'normal': 3, 'slow': 3}
+
+    tmpdir.join('invalid.export').write('invalid')
+    with pytest.raises(InvalidExport):
+        read_export(str(tmpdir.join('invalid.export')))
+
+    # Pickled exports are not loaded
+    tmpdir.join('pickled.export').write_binary(
+        json.dumps(dict(header, version=1)).encode('utf-8') + b'\n')
+    with pytest.raises(InvalidExport):
+        read_export(str(tmpdir.join('pickled.export')))
+
+
+def test_merge_exports(tmpdir):
+    file_paths = [make_export(tmpdir, 'web-%s' % i, i, 100 * i) for i in range(1, 5)]
+    tmpdir.join('invalid.export').write('invalid')
+    data, breakdown, options = merge_exports(file_paths + [str(tmpdir.join('invalid.export'))])
+    assert data['requests_counter'] == {'normal': 10, 'slow': 9}
+    assert data['datetime_range'] == [datetime.datetime(2014, 6, 24, 12, 1),
+                                      datetime.datetime(2014, 6, 24, 12, 4)]
+    assert options == {'min_msecs': 200}
+    assert [host['host'] for host in breakdown.get_hosts()] == ['web-4', 'web-3', 'web-2', 'web-1']
+    hosts = breakdown.get_url_group_hosts(('GET', '/trips/(\\d+)/'), limit=2)
+    assert [(host['host'], host['count'], host['total']) for host in hosts] == \
+        [('web-4', 4, 1600), ('web-3', 3, 900)]
+
+    output = tmpdir.join('report.html')
+    merge(Namespace(filepath=[str(tmpdir.join('web-*', '*.export'))], output=output.open('w'),
+                    domain=None, limit_url_groups=200, limit_per_url_group=20))
+    assert 'web-4' in output.read()
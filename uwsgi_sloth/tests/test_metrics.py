@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""Test code for metrics"""
+import datetime
+
+from uwsgi_sloth.metrics import RequestMetrics, escape_label_value
+
+
+def test_metrics():
+    metrics = RequestMetrics(buckets=(0.1, 1), max_groups=2)
+    now = datetime.datetime.now().replace(microsecond=0)
+    metrics.observe('GET', '/users/', 50, False, now)
+    metrics.observe('GET', '/users/', 100, False, now)
+    metrics.observe('GET', '/users/', 1500, True, now)
+    metrics.observe('POST', '/users/', 300, True, now)
+    # Groups exceed max_groups are counted as "(other)"
+    metrics.observe('GET', '/trips/', 300, True, now)
+    metrics.observe('GET', '/posts/', 300, True, now)
+
+    lines = metrics.render().splitlines()
+    assert 'uwsgi_sloth_requests_total{method="GET",group="/users/"} 3' in lines
+    assert 'uwsgi_sloth_requests_total{method="GET",group="(other)"} 2' in lines
+    assert 'uwsgi_sloth_slow_requests_total{method="GET",group="/users/"} 1' in lines
+    assert 'uwsgi_sloth_slow_requests_duration_seconds_total{method="GET",group="/users/"} 1.5' in lines
+    assert not any('/trips/' in line for line in lines)
+
+    # Buckets are cumulative
+    name = 'uwsgi_sloth_request_duration_seconds'
+    assert '%s_bucket{method="GET",group="/users/",le="0.1"} 2' % name in lines
+    assert '%s_bucket{method="GET",group="/users/",le="1"} 2' % name in lines
+    assert '%s_bucket{method="GET",group="/users/",le="+Inf"} 3' % name in lines
+    assert '%s_sum{method="GET",group="/users/"} 1.65' % name in lines
+    assert '%s_count{method="GET",group="/users/"} 3' % name in lines
+    assert lines[-1] == 'uwsgi_sloth_last_request_timestamp_seconds %r' % float(
+        now.timestamp())
+
+
+def test_escape_label_value():
+    assert escape_label_value('/a\\\\d"\n') == '/a\\\\\\\\d\\"\\n'
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Test code for models"""
+import os
+import pickle
+import datetime
+
+from uwsgi_sloth.analyzer import new_url_group_data
+from uwsgi_sloth.models import SavePoint, RequestsData, merge_requests_data_to
+from uwsgi_sloth.commands.migrate import list_legacy_dates, migrate_db_dir
+
+
+def make_requests_data(url, resp_time):
+    url_group_data = new_url_group_data()
+    url_group_data['duration_agr_data'].add_value(resp_time)
+    url_group_data['urls'].add_value(url, resp_time)
+    return {
+        'requests_counter': {'normal': 2, 'slow': 1},
+        'total_slow_duration': resp_time,
+        'data_details': {('GET', url): url_group_data}
+    }
+
+
+def test_merge_requests_data_to_empty():
+    data = {}
+    merge_requests_data_to(data, make_requests_data('/a/', 300))
+    merge_requests_data_to(data, make_requests_data('/a/', 500))
+    assert data['requests_counter'] == {'normal': 4, 'slow': 2}
+    assert data['total_slow_duration'] == 800
+    assert data['data_details'][('GET', '/a/')]['duration_agr_data'].count == 2
+
+
+def test_requests_data(tmpdir):
+    db_dir = str(tmpdir)
+    requests_data = RequestsData('2014-06-24', db_dir)
+    requests_data.add(make_requests_data('/a/', 300))
+    requests_data.add(make_requests_data('/b/', 500))
+    assert requests_data.segments == [1, 2]
+    assert requests_data.data['total_slow_duration'] == 800
+
+    # Data is loaded from segments
+    requests_data = RequestsData('2014-06-24', db_dir)
+    assert requests_data.data['total_slow_duration'] == 800
+    requests_data.add(make_requests_data('/a/', 100))
+    assert requests_data.data['total_slow_duration'] == 900
+    requests_data.save()
+    assert requests_data.segments == []
+    assert os.listdir(requests_data.segments_dir) == []
+
+    # Continue adding segments after saved
+    requests_data = RequestsData('2014-06-24', db_dir)
+    requests_data.add(make_requests_data('/c/', 100))
+    assert requests_data.segments == [4]
+    assert RequestsData('2014-06-24', db_dir).data['total_slow_duration'] == 1000
+
+
+def test_requests_data_crashed_when_saving(tmpdir):
+    db_dir = str(tmpdir)
+    requests_data = RequestsData('2014-06-24', db_dir)
+    requests_data.add(make_requests_data('/a/', 300))
+    with open(requests_data.get_segment_path(1), 'rb') as fp:
+        segment = fp.read()
+    requests_data.save()
+    # Segment was not removed
+    with open(requests_data.get_segment_path(1), 'wb') as fp:
+        fp.write(segment)
+    assert RequestsData('2014-06-24', db_dir).data['total_slow_duration'] == 300
+
+
+def test_requests_data_legacy(tmpdir):
+    db_dir = str(tmpdir)
+    with open(os.path.join(db_dir, '2014-06-24.pickle'), 'wb') as fp:
+        pickle.dump(make_requests_data('/a/', 300), fp)
+    requests_data = RequestsData('2014-06-24', db_dir)
+    requests_data.add(make_requests_data('/a/', 300))
+    requests_data.save()
+    assert RequestsData('2014-06-24', db_dir).data['total_slow_duration'] == 600
+
+
+def test_migrate(tmpdir):
+    db_dir = str(tmpdir)
+    save_point = SavePoint(db_dir)
+    save_point.set_last_datetime(datetime.datetime(2014, 6, 24, 12))
+    with open(save_point.legacy_file_path, 'wb') as fp:
+        pickle.dump(save_point.data, fp)
+    os.makedirs(os.path.join(db_dir, '2014-06-24.segments'))
+    with open(os.path.join(db_dir, '2014-06-24.segments', '00000001.pickle'), 'wb') as fp:
+        pickle.dump(make_requests_data('/a/', 300), fp)
+    with open(os.path.join(db_dir, '2014-06-23.pickle'), 'wb') as fp:
+        pickle.dump(make_requests_data('/a/', 100), fp)
+
+    assert list_legacy_dates(db_dir) == ['2014-06-23', '2014-06-24']
+    assert migrate_db_dir(db_dir) == 2
+    assert not [name for name in os.listdir(db_dir) if name.endswith('.pickle')]
+    assert os.listdir(os.path.join(db_dir, '2014-06-24.segments')) == []
+    assert SavePoint(db_dir).get_last_datetime() == datetime.datetime(2014, 6, 24, 12)
+    assert RequestsData('2014-06-24', db_dir).data['total_slow_duration'] == 300
+    assert RequestsData('2014-06-23', db_dir).data['total_slow_duration'] == 100
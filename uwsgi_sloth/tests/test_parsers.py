@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Test code for parsers of custom log formats"""
+import json
+import datetime
+
+import pytest
+
+from uwsgi_sloth.analyzer import UWSGILogParser, LogAnalyzer
+from uwsgi_sloth.parsers import LogFormatParser, JSONLogParser, InvalidLogFormat, make_log_parser
+
+LOG_FORMAT = '%(addr) - %(user) [%(ltime)] "%(method) %(uri) %(proto)" %(status) %(size) %(msecs)ms'
+LOG_LINE = '127.0.0.1 - - [24/Jun/2014:22:46:02 +0800] "%s //trips/42/?page=1 HTTP/1.1" %s 1024 %sms\n'
+
+
+def test_log_format_parser():
+    parser = LogFormatParser(LOG_FORMAT)
+    result = parser.parse((LOG_LINE % ('GET', 200, 355)).encode('utf-8'))
+    assert result == {
+        'method': 'GET',
+        'url': '/trips/42/?page=1',
+        'url_path': '/trips/42/',
+        'resp_time': 355,
+        'status': '200',
+        'request_datetime': datetime.datetime(2014, 6, 24, 22, 46, 2),
+    }
+    assert parser.parse(LOG_LINE % ('GET', 200, 355)) == result
+    assert parser.parse_line_datetime(LOG_LINE % ('GET', 200, 355)) == result['request_datetime']
+
+    # Filtered or invalid lines
+    assert parser.parse(LOG_LINE % ('HEAD', 200, 355)) is None
+    assert parser.parse(LOG_LINE % ('GET', 404, 355)) is None
+    assert parser.parse('INVALID LOG LINE') is None
+
+
+def test_log_format_parser_variables():
+    parser = LogFormatParser('%(time) %(method) %(uri) %(micros)')
+    result = parser.parse(b'1403621162 POST /trips/ 355000')
+    assert result['resp_time'] == 355
+    assert result['status'] is None
+    assert result['request_datetime'] == datetime.datetime.fromtimestamp(1403621162)
+
+    parser = LogFormatParser('[%(ctime)] %(method) %(uri) %(msecs)')
+    assert parser.parse(b'[Tue Jun  3 22:46:02 2014] GET /trips/ 1')['request_datetime'] == \
+        datetime.datetime(2014, 6, 3, 22, 46, 2)
+
+    for log_format in ('%(method) %(uri) %(msecs)', '%(ltime) %(uri) %(msecs)'):
+        with pytest.raises(InvalidLogFormat):
+            LogFormatParser(log_format)
+
+
+def test_log_format_parser_invalid_time():
+    lines = [
+        ('%(tmsecs) %(method) %(uri) %(msecs)', b'12 GET /trips/ 1'),
+        ('%(tmicros) %(method) %(uri) %(msecs)', b'12345 GET /trips/ 1'),
+        ('%(time) %(method) %(uri) %(msecs)', b'9' * 30 + b' GET /trips/ 1'),
+        ('%(epoch) %(method) %(uri) %(msecs)', b'9' * 400 + b' GET /trips/ 1'),
+        ('[%(ltime)] %(method) %(uri) %(msecs)', b'[24/Foo/2014:22:46:02 +0800] GET /trips/ 1'),
+    ]
+    for log_format, line in lines:
+        parser = LogFormatParser(log_format)
+        assert parser.parse(line) is None
+        assert parser.parse_line_datetime(line) is None
+
+
+def test_json_log_parser():
+    parser = JSONLogParser()
+    record = {'method': 'GET', 'uri': '/trips/42/?page=1', 'status': 200, 'msecs': 355,
+              'time': 1403621162}
+    result = parser.parse(json.dumps(record).encode('utf-8') + b'\n')
+    assert result == {
+        'method': 'GET',
+        'url': '/trips/42/?page=1',
+        'url_path': '/trips/42/',
+        'resp_time': 355,
+        'status': '200',
+        'request_datetime': datetime.datetime.fromtimestamp(1403621162),
+    }
+    assert parser.parse(json.dumps(dict(record, status=404))) is None
+    assert parser.parse(json.dumps(dict(record, msecs='invalid'))) is None
+    assert parser.parse('*** Starting uWSGI ***') is None
+    assert parser.parse('{invalid json') is None
+    for invalid in ({'status': [200]}, {'status': {'code': 200}}, {'time': 10 ** 30},
+                    {'time': [1]}, {'time': None, 'tmsecs': '12'}, {'uri': 42}):
+        assert parser.parse(json.dumps(dict(record, **invalid))) is None
+
+    del record['time']
+    record['ltime'] = '24/Jun/2014:22:46:02 +0800'
+    assert parser.parse(json.dumps(record))['request_datetime'] == \
+        datetime.datetime(2014, 6, 24, 22, 46, 2)
+
+
+def test_analyze_with_log_format():
+    analyzer = LogAnalyzer(log_parser=make_log_parser(LOG_FORMAT))
+    for i in range(3):
+        analyzer.analyze_line((LOG_LINE % ('GET', 200, 200 * i)).encode('utf-8'))
+    data = analyzer.get_data()
+    assert data['requests_counter'] == {'normal': 3, 'slow': 2}
+    assert list(data['data_details'].keys()) == [('GET', '/trips/(\\d+)/')]
+    assert isinstance(make_log_parser('default'), UWSGILogParser)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Test code for profiling"""
+from argparse import Namespace
+
+from uwsgi_sloth.commands.analyze import analyze_log
+from uwsgi_sloth.profiling import StageProfiler, profile_stage, start_cprofile, dump_cprofile
+from uwsgi_sloth.tests.test_analyze import make_log_file
+
+
+def test_profile_analyze_log(tmpdir):
+    file_path = make_log_file(tmpdir)
+    with open(file_path, 'ab') as fp:
+        fp.write(b'not a request\n')
+    configs = Namespace(min_msecs=200, max_urls_per_group=1000, log_format=None)
+    with open(file_path, 'rb') as fp:
+        data = analyze_log(fp, configs, [])
+    profiler = StageProfiler()
+    with open(file_path, 'rb') as fp:
+        profiled_data = analyze_log(fp, configs, [], profiler)
+
+    assert profiled_data['requests_counter'] == data['requests_counter']
+    assert profiled_data['total_slow_duration'] == data['total_slow_duration']
+    counters = profiler.get_counters()
+    assert counters['lines_read'] == 501
+    assert counters['lines_matched'] == 500
+    assert counters['lines_filtered'] == 1
+    assert counters['urls_classified'] == data['requests_counter']['slow']
+    assert counters['classify_cache_hits'] + counters['classify_cache_misses'] == \
+        counters['urls_classified']
+    stages = dict(profiler.get_stage_times())
+    assert set(stages) >= set(['read', 'parse', 'parse_datetime', 'classify', 'aggregate'])
+    assert all(seconds >= 0 for seconds in stages.values())
+    assert 'lines read 501' in profiler.format_report()
+
+    profiler.reset()
+    assert profiler.get_counters()['lines_read'] == 0
+    assert profiler.get_counters()['classify_cache_hits'] == 0
+    assert all(seconds == 0 for _, seconds in profiler.get_stage_times())
+
+
+def test_profile_stage(tmpdir):
+    with profile_stage(None, 'render'):
+        pass
+
+    profiler = StageProfiler()
+    profile = start_cprofile()
+    with profile_stage(profiler, 'render'):
+        sum(range(1000))
+    stats_path = str(tmpdir.join('profile.pstats'))
+    assert 'function calls' in dump_cprofile(profile, stats_path)
+    assert tmpdir.join('profile.pstats').check()
+    assert dict(profiler.get_stage_times())['render'] > 0
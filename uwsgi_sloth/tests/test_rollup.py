@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Test code for rollup command"""
+import datetime
+
+from uwsgi_sloth.analyzer import RealtimeLogAnalyzer
+from uwsgi_sloth.models import RequestsData, RollupData
+from uwsgi_sloth.commands.rollup import split_periods, merge_tree, rollup_periods
+from uwsgi_sloth.tests.helpers import analyze_requests
+
+
+def make_day_data(date, count):
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    analyzer.tick(datetime.datetime.combine(date, datetime.time(23, 59)))
+    request_datetime = datetime.datetime.combine(date, datetime.time(12))
+    analyze_requests(analyzer, [(request_datetime, '/trips/%s/' % i, 300) for i in range(count)])
+    return analyzer.get_data(date.isoformat())
+
+
+def test_split_periods():
+    periods = split_periods(datetime.date(2014, 5, 28), datetime.date(2014, 7, 9))
+    assert [(name, str(first_date), str(last_date)) for name, first_date, last_date in periods] == [
+        (None, '2014-05-28', '2014-05-28'),
+        (None, '2014-05-29', '2014-05-29'),
+        (None, '2014-05-30', '2014-05-30'),
+        (None, '2014-05-31', '2014-05-31'),
+        ('month_2014-06', '2014-06-01', '2014-06-30'),
+        (None, '2014-07-01', '2014-07-01'),
+        (None, '2014-07-02', '2014-07-02'),
+        (None, '2014-07-03', '2014-07-03'),
+        (None, '2014-07-04', '2014-07-04'),
+        (None, '2014-07-05', '2014-07-05'),
+        (None, '2014-07-06', '2014-07-06'),
+        # Week is not complete
+        (None, '2014-07-07', '2014-07-07'),
+        (None, '2014-07-08', '2014-07-08'),
+        (None, '2014-07-09', '2014-07-09')]
+    assert split_periods(datetime.date(2014, 7, 7), datetime.date(2014, 7, 13))[0][0] == 'week_2014-W28'
+
+
+def test_merge_tree():
+    datas = [make_day_data(datetime.date(2014, 6, 1), i) for i in range(1, 6)] + [{}]
+    assert merge_tree(datas)['requests_counter'] == {'normal': 15, 'slow': 15}
+    assert merge_tree([{}]) is None
+
+
+def test_rollup_periods(tmpdir):
+    db_dir = str(tmpdir)
+    first_date = datetime.date(2014, 6, 2)
+    for i in range(10):
+        date = first_date + datetime.timedelta(days=i)
+        day_requests_data = RequestsData(date.isoformat(), db_dir)
+        day_requests_data.add(make_day_data(date, i + 1))
+        day_requests_data.save()
+
+    periods = split_periods(first_date, first_date + datetime.timedelta(days=10))
+    assert periods[0][0] == 'week_2014-W23'
+    for workers in (1, 2):
+        data = rollup_periods(periods, db_dir, workers)
+        assert data['requests_counter'] == {'normal': 55, 'slow': 55}
+        assert data['data_details'][('GET', '/trips/(\\d+)/')]['duration_agr_data'].count == 55
+
+    # Cached rollup is invalid after data of a day changed
+    day_requests_data = RequestsData(first_date.isoformat(), db_dir)
+    signature = tuple((day.date, day.get_signature()) for day in (
+        RequestsData((first_date + datetime.timedelta(days=i)).isoformat(), db_dir) for i in range(7)))
+    assert RollupData('week_2014-W23', db_dir).load(signature)['requests_counter']['normal'] == 28
+    day_requests_data.add(make_day_data(first_date, 1))
+    assert rollup_periods(periods, db_dir)['requests_counter'] == {'normal': 56, 'slow': 56}
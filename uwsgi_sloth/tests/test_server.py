@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Test code for built-in HTTP server"""
+import json
+import datetime
+import threading
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+import pytest
+
+from uwsgi_sloth.analyzer import RealtimeLogAnalyzer
+from uwsgi_sloth.commands.start import RealtimeReportSource
+from uwsgi_sloth.server import ReportServer
+from uwsgi_sloth.metrics import RequestMetrics
+from uwsgi_sloth.tests.helpers import analyze_requests
+
+
+@pytest.fixture
+def server(tmpdir):
+    metrics = RequestMetrics()
+    analyzer = RealtimeLogAnalyzer(min_msecs=200, metrics=metrics)
+    source = RealtimeReportSource(analyzer, {})
+    tmpdir.join('day_2014-06-24.html').write('old report')
+    server = ReportServer(('127.0.0.1', 0), source, html_dir=str(tmpdir), metrics=metrics)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    server.analyzer = analyzer
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def analyze_lines(server, count):
+    now = datetime.datetime.now()
+    with server.source.lock:
+        analyze_requests(server.analyzer, [(now, '/trips/%s/' % i) for i in range(count)])
+
+
+def get(server, path):
+    return urlopen('http://127.0.0.1:%s%s' % (server.server_address[1], path)).read()
+
+
+def test_server(server, monkeypatch):
+    monkeypatch.setattr('uwsgi_sloth.server.SERVER_CACHE_SECONDS', 0)
+    with pytest.raises(HTTPError):
+        get(server, '/today.html')
+
+    analyze_lines(server, 3)
+    assert b'3 / 3' in get(server, '/today.html')
+    report = json.loads(get(server, '/api/latest_5mins.json').decode('utf-8'))
+    assert report['requests_counter'] == {'normal': 3, 'slow': 3}
+    assert report['url_groups'][0]['url_schema'] == '/trips/(\\d+)/'
+
+    # Pages are rendered again after data changed
+    analyze_lines(server, 2)
+    report = json.loads(get(server, '/api/today.json').decode('utf-8'))
+    assert report['requests_counter'] == {'normal': 5, 'slow': 5}
+
+    assert get(server, '/day_2014-06-24.html') == b'old report'
+    for path in ('/latest_120mins.html', '/api/today.html', '/../secret.html'):
+        with pytest.raises(HTTPError):
+            get(server, path)
+
+
+def test_server_metrics(server):
+    analyze_lines(server, 3)
+    response = urlopen('http://127.0.0.1:%s/metrics' % server.server_address[1])
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    body = response.read().decode('utf-8')
+    assert 'uwsgi_sloth_requests_total{method="GET",group="/trips/(\\\\d+)/"} 3' in body
+
+
+def test_server_cached_page(server, monkeypatch):
+    monkeypatch.setattr('uwsgi_sloth.server.SERVER_CACHE_SECONDS', 0)
+    analyze_lines(server, 3)
+    body = get(server, '/today.html')
+
+    # Cached page is used without getting report again if data not changed
+    def get_report(name):
+        raise AssertionError('report got again')
+    monkeypatch.setattr(server.source, 'get_report', get_report)
+    assert get(server, '/today.html') == body
+
+
+def test_report_source_detached(server):
+    source = server.source
+    analyze_lines(server, 3)
+    with source.lock:
+        days_data, _ = source.analyzer.take_snapshot()
+        source.pending_days.append(days_data)
+    analyze_lines(server, 2)
+    version = source.get_report_version('today')
+    data, report_version, _ = source.get_report('today')
+    assert report_version == version
+    assert data['requests_counter'] == {'normal': 5, 'slow': 5}
+    window_data = source.get_report('latest_5mins')[0]
+
+    # Reports are not modified by analyzing
+    analyze_lines(server, 4)
+    assert data['requests_counter'] == {'normal': 5, 'slow': 5}
+    assert sum(d['duration_agr_data'].count for d in data['data_details'].values()) == 5
+    assert window_data['requests_counter'] == {'normal': 5, 'slow': 5}
+    assert source.get_report_version('today') != version
+    assert source.get_report('today')[0]['requests_counter'] == {'normal': 9, 'slow': 9}
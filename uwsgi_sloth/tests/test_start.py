@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Test code for start command"""
+import os
+import datetime
+
+from uwsgi_sloth.analyzer import RealtimeLogAnalyzer
+from uwsgi_sloth.commands.start import RealtimeReportSource, ReportWriter, HTMLRender, \
+    load_days_requests_data
+from uwsgi_sloth.models import RequestsData, SavePoint
+from uwsgi_sloth.tests.helpers import make_log_line, analyze_requests
+
+
+def test_report_writer_retry(tmpdir, monkeypatch):
+    monkeypatch.setattr('uwsgi_sloth.commands.start.WRITER_RETRY_SECONDS', 0)
+    db_dir, html_dir = str(tmpdir.mkdir('data')), str(tmpdir.mkdir('html'))
+    now = datetime.datetime.now()
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    analyzer.analyze_line(make_log_line(now))
+    source = RealtimeReportSource(analyzer, {})
+    days_data, slots = analyzer.take_snapshot()
+    source.pending_days.append(days_data)
+    writer = ReportWriter(source, HTMLRender(html_dir), SavePoint(db_dir), db_dir, html_dir)
+
+    # Merging fails once after the segment was written
+    failures = [IOError('failed')]
+    merge = RequestsData.merge
+
+    def failing_merge(self, food):
+        if failures:
+            raise failures.pop()
+        merge(self, food)
+
+    monkeypatch.setattr(RequestsData, 'merge', failing_merge)
+    writer.write_until_done({
+        'now': now,
+        'days_data': days_data,
+        'slots': slots,
+        'result_date_names': analyzer.get_result_date_names(),
+        'last_analyzed_datetime': analyzer.last_analyzed_datetime,
+        'file_position': (0, os.stat(db_dir)),
+    })
+
+    assert not failures
+    assert source.pending_days == []
+    requests_data = source.days_requests_data[analyzer.today_name]
+    assert requests_data.data['requests_counter'] == {'normal': 1, 'slow': 1}
+    # Segment is not written twice by retrying
+    assert RequestsData(analyzer.today_name, db_dir).data['requests_counter'] == \
+        {'normal': 1, 'slow': 1}
+
+
+def test_restart_report(tmpdir):
+    db_dir = str(tmpdir.mkdir('data'))
+    now = datetime.datetime.now()
+    analyzer = analyze_requests(RealtimeLogAnalyzer(min_msecs=200),
+                                [(now, '/trips/%s/' % i) for i in range(3)])
+    days_data, _ = analyzer.take_snapshot()
+    RequestsData(analyzer.today_name, db_dir).add(days_data[analyzer.today_name])
+
+    # Restarted, data stored before restarting is in reports
+    analyzer = RealtimeLogAnalyzer(min_msecs=200)
+    source = RealtimeReportSource(
+        analyzer, load_days_requests_data(analyzer.get_result_date_names(), db_dir))
+    assert analyzer.yesterday_name not in source.days_requests_data
+    assert source.get_report('today')[0]['requests_counter'] == {'normal': 3, 'slow': 3}
+    assert source.get_report('day_%s' % analyzer.today_name) is not None
+    assert source.get_report('yesterday') is None
+
+    analyzer.analyze_line(make_log_line(now, msecs=100))
+    assert source.get_report('today')[0]['requests_counter'] == {'normal': 4, 'slow': 3}
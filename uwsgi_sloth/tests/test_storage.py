@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Test code for storage format"""
+import datetime
+from array import array
+
+import pytest
+
+from uwsgi_sloth.analyzer import LogAnalyzer
+from uwsgi_sloth.structures import ValuesAggregation
+from uwsgi_sloth.storage import pack_numbers, write_requests_data, read_requests_data, \
+    StorageWriter, StorageFile, InvalidStorageFile
+from uwsgi_sloth.tests.helpers import analyze_requests
+
+
+def make_data():
+    start = datetime.datetime(2014, 6, 24, 12)
+    return analyze_requests(LogAnalyzer(min_msecs=200, max_urls_per_group=2), [
+        (start + datetime.timedelta(seconds=50 * (i + 1)), '/trips/%s/?q=%s' % (i, i % 4), 100 * i,
+         'POST' if i % 3 else 'GET') for i in range(30)]).get_data()
+
+
+def test_pack_numbers():
+    assert pack_numbers([1, -1, 100]).typecode == 'b'
+    assert pack_numbers([1, 40000]).typecode == 'i'
+    assert pack_numbers([1, 2 ** 40]).typecode == 'q'
+    assert pack_numbers([1, 0.5]).typecode == 'd'
+    assert pack_numbers([]).typecode == 'q'
+
+
+def test_requests_data(tmpdir):
+    data = make_data()
+    file_path = str(tmpdir.join('data.db'))
+    write_requests_data(file_path, data, {'last_segment': 3})
+    header, loaded = read_requests_data(file_path)
+    assert header == {'last_segment': 3}
+    assert loaded['requests_counter'] == data['requests_counter']
+    assert loaded['total_slow_duration'] == data['total_slow_duration']
+    assert loaded['datetime_range'] == data['datetime_range']
+    assert loaded['time_series'].get_points() == data['time_series'].get_points()
+    assert set(loaded['data_details']) == set(data['data_details'])
+    for key, group_data in data['data_details'].items():
+        loaded_group = loaded['data_details'][key]
+        agr, loaded_agr = group_data['duration_agr_data'], loaded_group['duration_agr_data']
+        assert (loaded_agr.count, loaded_agr.total, loaded_agr.min, loaded_agr.max, loaded_agr.p95) == \
+            (agr.count, agr.total, agr.min, agr.max, agr.p95)
+        urls, loaded_urls = group_data['urls'], loaded_group['urls']
+        assert (loaded_urls.limit, loaded_urls.floor, loaded_urls.errors) == \
+            (urls.limit, urls.floor, urls.errors)
+        assert dict((url, agr.total) for url, agr in loaded_urls.items()) == \
+            dict((url, agr.total) for url, agr in urls.items())
+        assert loaded_group['time_series'].counts == group_data['time_series'].counts
+
+
+def test_requests_data_legacy_urls(tmpdir):
+    """Urls data of older versions are plain dicts, urls may contain the string separator"""
+    file_path = str(tmpdir.join('data.db'))
+    data = {
+        'requests_counter': {'normal': 1, 'slow': 1},
+        'total_slow_duration': 300,
+        'data_details': {('GET', '/a/'): {'duration_agr_data': ValuesAggregation([300]),
+                                          'urls': {'/a/?q=\n': ValuesAggregation([300.5])}}},
+    }
+    write_requests_data(file_path, data)
+    group_data = read_requests_data(file_path)[1]['data_details'][('GET', '/a/')]
+    assert type(group_data['urls']) is dict
+    assert group_data['urls']['/a/?q=\n'].total == 300.5
+    assert 'time_series' not in group_data
+    write_requests_data(file_path, {})
+    assert read_requests_data(file_path)[1] == {}
+
+
+def test_invalid_storage_file(tmpdir):
+    file_path = tmpdir.join('data.db')
+    file_path.write('not a storage file')
+    with pytest.raises(InvalidStorageFile):
+        read_requests_data(str(file_path))
+
+    StorageWriter('savepoint', {'offset': 1}).write(str(file_path))
+    with pytest.raises(InvalidStorageFile):
+        read_requests_data(str(file_path))
+    with StorageFile(str(file_path), 'savepoint') as storage:
+        assert storage.header == {'offset': 1}
+
+    writer = StorageWriter('test')
+    writer.add_section('values', array('h', [1, 2, 3]))
+    file_path.write_binary(writer.tobytes()[:-8])
+    with StorageFile(str(file_path)) as storage:
+        with pytest.raises(InvalidStorageFile):
+            storage.read_array('values')
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-from uwsgi_sloth.structures import ValuesAggregation
+import pickle
+
+import datetime
+
+from uwsgi_sloth.structures import ValuesAggregation, QuantileSketch, TopURLsAggregation, TimeSeries, \
+    datetime_to_timestamp, timestamp_to_datetime
 
 def test_ValuesAggregation():
     agr = ValuesAggregation()
@@ -18,3 +23,115 @@ def test_ValuesAggregation():
         'min': 1
     }
 
+
+
+def test_QuantileSketch():
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    values = list(range(1, 10001))
+    for value in values:
+        sketch.add_value(value)
+    for q in (0, 0.5, 0.95, 0.99, 1):
+        expected = values[int(q * (len(values) - 1))]
+        assert abs(sketch.get_quantile(q) - expected) <= expected * 0.01
+
+    # Merged sketch is the same as the one built from all values
+    sketch1, sketch2 = QuantileSketch(), QuantileSketch()
+    for value in values:
+        (sketch1 if value % 3 else sketch2).add_value(value)
+    merged = sketch1.merge_with(sketch2)
+    assert merged.count == sketch.count
+    assert merged.get_quantile(0.99) == sketch.get_quantile(0.99)
+
+    # Collapse lowest buckets when reaching max_buckets
+    small_sketch = QuantileSketch(max_buckets=10)
+    for value in values:
+        small_sketch.add_value(value)
+    assert len(small_sketch.buckets) == 10
+    assert small_sketch.get_quantile(1) == sketch.get_quantile(1)
+
+
+def test_ValuesAggregation_percentiles():
+    agr = ValuesAggregation(values=range(1, 101), with_sketch=True)
+    assert abs(agr.p50 - 50) <= 1
+    assert abs(agr.p99 - 99) <= 1
+    assert ValuesAggregation(values=range(1, 101)).p99 is None
+
+    merged = agr.merge_with(ValuesAggregation(values=range(101, 201), with_sketch=True))
+    assert abs(merged.p50 - 100) <= 1
+    assert agr.merge_with(ValuesAggregation(values=range(1, 10))).p50 is None
+
+
+def test_ValuesAggregation_pickle():
+    agr = ValuesAggregation(values=range(1, 101), with_sketch=True)
+    loaded = pickle.loads(pickle.dumps(agr))
+    assert loaded.get_result() == agr.get_result()
+    assert loaded.p95 == agr.p95
+
+    # Pickled by older versions which has no slots and sketch
+    old_pickled = (b'\x80\x02cuwsgi_sloth.structures\nValuesAggregation\nq\x00)\x81q\x01}q\x02(X\x03'
+                   b'\x00\x00\x00minq\x03K\x01X\x03\x00\x00\x00maxq\x04K\x05X\x05\x00\x00\x00totalq'
+                   b'\x05K\x06X\x05\x00\x00\x00countq\x06K\x02ub.')
+    loaded = pickle.loads(old_pickled)
+    assert loaded.get_result() == {'min': 1, 'max': 5, 'avg': 3.0}
+    assert loaded.sketch is None
+
+
+def test_TopURLsAggregation():
+    heavy_urls = ['/heavy/%s/' % i for i in range(5)]
+    urls1, urls2 = TopURLsAggregation(limit=10), TopURLsAggregation(limit=10)
+    for i in range(4000):
+        urls = urls1 if i % 2 else urls2
+        # Lots of unique urls requested by crawlers
+        urls.add_value('/crawler/%s/' % i, 10)
+        if i % 40 == 0:
+            urls.add_value(heavy_urls[i % 200 // 40], 1000)
+        assert len(urls) <= 20
+
+    urls1.merge_from(urls2)
+    assert len(urls1) <= 20
+    assert urls1.floor > 0
+    top_urls = sorted(urls1, key=lambda url: urls1[url].total, reverse=True)[:5]
+    assert sorted(top_urls) == heavy_urls
+    assert urls1[heavy_urls[0]].count == 20
+
+    # No limit
+    urls = TopURLsAggregation(limit=0)
+    for i in range(100):
+        urls.add_value('/%s/' % i, i)
+    assert len(urls) == 100
+    assert pickle.loads(pickle.dumps(urls)).limit == 0
+
+
+def test_TimeSeries():
+    dt = datetime.datetime(2014, 6, 24, 22, 0, 30)
+    assert timestamp_to_datetime(datetime_to_timestamp(dt)) == dt
+
+    series = TimeSeries(bucket_seconds=60, max_buckets=10, with_sketch=True)
+    start = datetime_to_timestamp(dt)
+    for i in range(5 * 60):
+        series.add_value(start + i, i)
+    assert series.bucket_seconds == 60
+    assert list(series.counts) == [30, 60, 60, 60, 60, 30]
+    assert series.get_points()[0]['datetime'] == datetime.datetime(2014, 6, 24, 22, 0)
+
+    # Buckets are merged when time range grows, values added earlier are also counted
+    series.add_value(start + 20 * 60, 1000)
+    series.add_value(start - 60, 0)
+    assert series.bucket_seconds == 240
+    assert len(series.counts) <= 10
+    assert sum(series.counts) == 302
+    assert max(series.maxes) == 1000
+    assert sum(series.totals) == sum(range(300)) + 1000
+    assert sum(sketch.count for sketch in series.sketches) == 302
+
+    other = TimeSeries(bucket_seconds=60, max_buckets=10, with_sketch=True)
+    for i in range(5 * 60):
+        other.add_value(start + 3600 + i, i)
+    merged = series.merge_with(other)
+    assert merged.bucket_seconds == 480
+    assert sum(merged.counts) == 602
+    assert sum(merged.totals) == sum(series.totals) + sum(other.totals)
+
+    loaded = pickle.loads(pickle.dumps(merged))
+    assert list(loaded.counts) == list(merged.counts)
+    assert [p['p95'] for p in loaded.get_points()] == [p['p95'] for p in merged.get_points()]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Test code for tailer"""
+import datetime
+
+from uwsgi_sloth.tailer import Tailer, no_new_line
+from uwsgi_sloth.analyzer import UWSGILogParser
+from uwsgi_sloth.tests.helpers import make_log_line
+
+
+def test_seek_datetime(tmpdir):
+    start_datetime = datetime.datetime(2014, 6, 24, 22, 0, 0)
+    log_file = tmpdir.join('uwsgi.log')
+    lines = []
+    for i in range(1000):
+        request_datetime = start_datetime + datetime.timedelta(seconds=i)
+        lines.append(make_log_line(request_datetime, '/trips/%s/' % i, 55) + '\n')
+        if i % 10 == 0:
+            lines.append('*** uwsgi message ***\n')
+    log_file.write(''.join(lines))
+
+    parser = UWSGILogParser()
+    for seconds in (-10, 0, 1, 500, 998, 999, 2000):
+        target = start_datetime + datetime.timedelta(seconds=seconds)
+        tailer = Tailer(str(log_file), read_size=256)
+        tailer.seek_datetime(target, parser.parse_line_datetime)
+        skipped = log_file.read()[:tailer.tell()]
+        assert skipped.endswith('\n') or not skipped
+
+        # All lines after target are not skipped
+        rest_datetimes = [parser.parse_line_datetime(line) for line in tailer.file]
+        rest_datetimes = [d for d in rest_datetimes if d]
+        expected = [start_datetime + datetime.timedelta(seconds=i) for i in range(1000)]
+        expected = [d for d in expected if d > target]
+        assert rest_datetimes[len(rest_datetimes) - len(expected):] == expected
+        # Skipped most lines before target
+        assert len(rest_datetimes) - len(expected) < 10
+        tailer.close()
+
+
+def read_until_no_new_line(lines_iter):
+    lines = []
+    for line in lines_iter:
+        if line is no_new_line:
+            return lines
+        lines.append(line)
+
+
+def test_follow(tmpdir):
+    log_file = tmpdir.join('uwsgi.log')
+    log_file.write('line 1\nline 2\r\nline')
+    tailer = Tailer(str(log_file), read_size=4)
+    lines_iter = tailer.follow(delay=0.01)
+    assert read_until_no_new_line(lines_iter) == [b'line 1', b'line 2']
+    assert tailer.trailing
+    assert tailer.tell() == len('line 1\nline 2\r\n')
+
+    log_file.write(' 3\nline 4\n', mode='a')
+    assert read_until_no_new_line(lines_iter) == [b'line 3', b'line 4']
+
+    # Rotate log file, lines written to old file after rotating should not be lost
+    log_file.rename(tmpdir.join('uwsgi.log.1'))
+    tmpdir.join('uwsgi.log.1').write('line 5\nline 6', mode='a')
+    tmpdir.join('uwsgi.log').write('new line 1\n')
+    assert read_until_no_new_line(lines_iter) == [b'line 5', b'line 6', b'new line 1']
+
+    # Truncated
+    tmpdir.join('uwsgi.log').write('new\n')
+    assert read_until_no_new_line(lines_iter) == [b'new']
+    tailer.stop_follow()
+    assert list(lines_iter) == []
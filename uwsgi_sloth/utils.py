@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import re
+import tempfile
 
 def parse_url_rules(urls_fp):
     """URL rules from given fp"""
@@ -17,6 +18,22 @@ def makedir_if_none_exists(d):
         os.makedirs(d)
 
 
+def atomic_write(chunks, file_path):
+    """Write chunks of bytes to file atomically, the file will never be half written"""
+    fd, tmp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                         prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        os.unlink(tmp_file_path)
+        raise
+
+
 def total_seconds(td):
     """Return timedelta's total seconds"""
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 1e6) / 1e6